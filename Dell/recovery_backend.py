@@ -35,22 +35,35 @@ import tempfile
 import subprocess
 import tarfile
 import shutil
+import threading
+import sqlite3
+import zlib
 import datetime
-import distutils.dir_util
+import functools
+import inspect
 import lsb_release
-from hashlib import md5
 
 from Dell.recovery_common import (DOMAIN, LOCALEDIR,
                                   walk_cleanup, create_new_uuid, white_tree,
                                   black_tree, fetch_output, check_version,
                                   DBUS_BUS_NAME, DBUS_INTERFACE_NAME,
-                                  RestoreFailed, CreateFailed,
-                                  regenerate_md5sum, PermissionDeniedByPolicy)
-from Dell.recovery_threading import ProgressByPulse, ProgressBySize
+                                  RestoreFailed, CreateFailed, VerifyFailed,
+                                  UnknownJob,
+                                  regenerate_manifests, parse_xorriso_progress,
+                                  MEDIA_MANIFESTS, JSON_MANIFEST, verify_manifest,
+                                  PermissionDeniedByPolicy)
+from Dell.recovery_io import (HASH_WORKERS, copy_file, copy_file_hashed,
+                              extract_tar, move_tree, DigestMap, DigestCache)
+from Dell.recovery_fish import CatalogEntry, FishCache, FishCatalog
+from Dell.recovery_image import (IsoImage, DirectoryImage, ImageError,
+                                 ImageCache, initrd_contains, read_lines)
+from Dell.recovery_threading import (ProgressByPulse, ByteProgress, ProgressEmitter,
+                                     JobQueue)
 from Dell.recovery_xml import BTOxml
 
 import fcntl
 import select
+from concurrent.futures import ThreadPoolExecutor
 
 #Translation support
 from gettext import gettext as _
@@ -58,19 +71,65 @@ from gettext import bindtextdomain, textdomain
 
 from debian_bundle import debian_support
 
-def safe_tar_extract(filename, destination):
-    """Safely extracts a tarball into destination"""
-    logging.debug('safe_tar_extract: %s to %s', (filename, destination))
-
-    rfd = tarfile.open(filename)
-    dangerous_file = False
-    for name in rfd.getnames():
-        if name.startswith('..') or name.startswith('/'):
-            dangerous_file = True
-            break
-    if not dangerous_file:
-        rfd.extractall(destination)
-    rfd.close()
+#most progress signals sent a second for any one job
+PROGRESS_RATE = 2
+
+#digests listed on generated media, all worked out in the same read of a file.
+#md5sum.txt is always there, the others are turned on with Backend.media_digests
+MEDIA_DIGESTS = ('md5',)
+#whether a JSON_MANIFEST goes on generated media too, see Backend.json_manifest
+MEDIA_JSON_MANIFEST = False
+
+#what probing an image finds out, as it is for images that can't be read
+IMAGE_UNKNOWN = {'bto_version': '', 'bto_date': '', 'distributor': '',
+                 'distributor_str': 'Unknown Base Image', 'dell_recovery': ''}
+
+#initrds of BTO compatible images have the bootstrap in them
+INITRD_PATHS = ('/casper/initrd.lz', '/casper/initrd', '/casper/initrd.gz')
+INITRD_BOOTSTRAP = 'scripts/casper-bottom/99dell_bootstrap'
+
+#where images normally carry dell-recovery, before searching all of them
+DELL_RECOVERY_DEBS = ('/debs', '/debs/main')
+DELL_RECOVERY_MANIFESTS = ('/casper/filesystem.manifest',)
+
+#how many D-Bus calls run at once, off the main loop
+BACKEND_WORKERS = 4
+
+#how many builds submitted with submit_build run at once
+JOB_WORKERS = 2
+
+#keywords that threaded methods get their D-Bus reply callbacks on
+ASYNC_CALLBACKS = ('reply_handler', 'error_handler')
+
+def threaded(expand=False):
+    """Runs a D-Bus method on the backend's worker threads.
+
+    The caller gets its reply once the method finishes, and the main loop
+    is free to serve other calls in the meantime. Set expand for methods
+    that return more than one value. This goes beneath
+    @dbus.service.method, which has to be given
+    async_callbacks=ASYNC_CALLBACKS. Local calls still run synchronously.
+    """
+    def decorate(function):
+        """Wraps function, keeping its arguments visible to dbus-python"""
+        signature = inspect.signature(function)
+        parameters = list(signature.parameters.values())
+        parameters += [inspect.Parameter(name, inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                                         default=None)
+                       for name in ASYNC_CALLBACKS]
+
+        @functools.wraps(function)
+        def dispatch(self, *args, **kwargs):
+            """Hands the call over to a worker if it came in over D-Bus"""
+            reply_handler = kwargs.pop(ASYNC_CALLBACKS[0], None)
+            error_handler = kwargs.pop(ASYNC_CALLBACKS[1], None)
+            if reply_handler is None:
+                return function(self, *args, **kwargs)
+            self._run_async(functools.partial(function, self, *args, **kwargs),
+                            reply_handler, error_handler, expand)
+        dispatch.__signature__ = signature.replace(parameters=parameters)
+        return dispatch
+    return decorate
 
 class Backend(dbus.service.Object):
     '''Backend manager.
@@ -93,14 +152,43 @@ class Backend(dbus.service.Object):
         self.main_loop = None
         self._timeout = False
         self.dbus_name = None
-        self.xml_obj = BTOxml()
+        #the BTOxml, digests and progress of a build are kept per thread, so
+        #calls and jobs running side by side don't share them
+        self._local = threading.local()
+        #digests of source files and extracted FISH, kept between runs
+        self.digest_cache = DigestCache()
+        self.fish_cache = FishCache()
+        self.fish_catalog = FishCatalog()
+        #checksum manifests to put on generated media
+        self.media_digests = MEDIA_DIGESTS
+        self.json_manifest = MEDIA_JSON_MANIFEST
+        #what earlier probes of base images and RPs found
+        self.image_cache = ImageCache()
 
         # cached D-BUS interfaces for _check_polkit_privilege()
         self.dbus_info = None
         self.polkit = None
-        self.progress_thread = None
         self.enforce_polkit = True
 
+        #mounts made for jobs, by mountpoint, and the lock mounts are made under
+        self._job_mounts = set()
+        self._mount_lock = threading.Lock()
+
+        #long running calls are served from here so the main loop stays free
+        self.workers = ThreadPoolExecutor(max_workers=BACKEND_WORKERS)
+        self._pending = 0
+        self._exit_requested = False
+
+        #builds queued up through submit_build
+        self.jobs = JobQueue(JOB_WORKERS)
+        self.jobs.state_changed = self._job_state_changed
+
+        #all progress goes out on the bus through here
+        self.progress_emitter = ProgressEmitter(PROGRESS_RATE)
+        self.progress_emitter.progress = functools.partial(self._emit,
+                                                           self.report_progress)
+        self.progress_emitter.job_progress = self._job_progress
+
         #Enable translation for strings used
         bindtextdomain(DOMAIN, LOCALEDIR)
         textdomain(DOMAIN)
@@ -128,9 +216,9 @@ class Backend(dbus.service.Object):
         if send_usr1:
             os.kill(os.getppid(), signal.SIGUSR1)
 
-        # run until we time out
+        # run until we time out, calls still being worked on count as activity
         while not self._timeout:
-            if timeout:
+            if timeout and not self._busy():
                 self._timeout = True
             self.main_loop.run()
 
@@ -143,6 +231,7 @@ class Backend(dbus.service.Object):
 
         '''
         backend = Backend()
+        dbus.mainloop.glib.threads_init()
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         if session_bus:
             backend.bus = dbus.SessionBus()
@@ -166,6 +255,123 @@ class Backend(dbus.service.Object):
 
         self._timeout = False
 
+    def _busy(self):
+        '''Checks whether any call or job is still being worked on.'''
+        return self._pending or self.jobs.busy()
+
+    def _exit_if_idle(self):
+        '''Leaves the main loop once an exit was requested and nothing is
+           being worked on any more.'''
+        if self._exit_requested and not self._busy():
+            self.main_loop.quit()
+        return False
+
+    def _new_context(self, job=None, scratch=None):
+        '''Gives whatever runs on this thread from now on a BTOxml, digests
+           and progress state of its own.'''
+        self._local.xml_obj = BTOxml()
+        self._local.digests = DigestMap()
+        self._local.progress_thread = None
+        self._local.job = job
+        self._local.scratch = scratch
+        #what request_mount mounted for the job, unmounted when it ends
+        self._local.mounts = []
+        #set while assemble_image hands its BTOxml on to create_fn
+        self._local.assembling = False
+
+    def _context(self):
+        '''The state of the call or job running on this thread.'''
+        if not hasattr(self._local, 'xml_obj'):
+            self._new_context()
+        return self._local
+
+    @property
+    def xml_obj(self):
+        '''The bto.xml of the build running on this thread.'''
+        return self._context().xml_obj
+
+    @property
+    def digests(self):
+        '''Digests of the files staged for the image of the build running on
+           this thread, worked out as they were copied.'''
+        return self._context().digests
+
+    @property
+    def progress_thread(self):
+        '''The pulsing progress of the build running on this thread.'''
+        return self._context().progress_thread
+
+    @progress_thread.setter
+    def progress_thread(self, thread):
+        self._context().progress_thread = thread
+
+    def _job_key(self):
+        '''Which job progress from this thread belongs to, '' outside jobs.'''
+        job = self._context().job
+        return job.id if job is not None else ''
+
+    def _mkdtemp(self, directory=None):
+        '''Makes a working directory, in directory if given.  Inside a job it
+           goes in the job's own scratch directory and is removed along with
+           it, otherwise it is removed on exit.'''
+        scratch = self._context().scratch
+        path = tempfile.mkdtemp(dir=directory or scratch)
+        if scratch is None:
+            atexit.register(walk_cleanup, path)
+        return path
+
+    def _in_context(self, context, function, *args):
+        '''Runs function on this thread with the state of the call or job
+           that handed it over, see _context_of.'''
+        self._local.__dict__.update(context)
+        return function(*args)
+
+    def _context_of(self):
+        '''The state of the call or job on this thread, for the threads it
+           farms work out to.'''
+        return dict(self._context().__dict__)
+
+    def _in_new_context(self, function):
+        '''Runs function with state of its own on this thread.'''
+        self._new_context()
+        return function()
+
+    def _run_async(self, function, reply_handler, error_handler, expand=False):
+        '''Runs function on a worker thread and replies from the main loop
+           once it is done.'''
+        self._reset_timeout()
+        self._pending += 1
+        future = self.workers.submit(self._in_new_context, function)
+        future.add_done_callback(lambda done: GLib.idle_add(
+            self._complete_async, done, reply_handler, error_handler, expand))
+
+    def _complete_async(self, future, reply_handler, error_handler, expand):
+        '''Sends the result of a threaded call back to its caller.'''
+        self._pending -= 1
+        error = future.exception()
+        if error is not None:
+            error_handler(error)
+        elif expand:
+            reply_handler(*future.result())
+        elif future.result() is None:
+            reply_handler()
+        else:
+            reply_handler(future.result())
+        return self._exit_if_idle()
+
+    def _emit(self, signal, *args):
+        '''Sends a signal from the main loop, whichever thread it comes
+           from.'''
+        if threading.current_thread() is threading.main_thread():
+            signal(*args)
+            return
+
+        def emit():
+            '''Runs once, on the main loop'''
+            signal(*args)
+            return False
+        GLib.idle_add(emit)
+
     def _check_polkit_privilege(self, sender, conn, privilege):
         '''Verify that sender has a given PolicyKit privilege.
 
@@ -233,13 +439,22 @@ class Backend(dbus.service.Object):
         if os.path.isdir(recovery):
             return recovery
 
+        #jobs must not pick up each other's mounts halfway through being made
+        with self._mount_lock:
+            return self._mount(recovery, type, sender, conn)
+
+    def _mount(self, recovery, type, sender, conn):
+        '''Finds or makes a mount of recovery for request_mount, must hold
+           the mount lock'''
         #check for an existing mount
         command = subprocess.Popen(['mount'], stdout=subprocess.PIPE,
                                    universal_newlines=True)
         output = command.communicate()[0].split('\n')
         for line in output:
             processed_line = line.split()
-            if len(processed_line) > 0 and processed_line[0] == recovery:
+            #a job's mounts go away with it, so only it may use them
+            if len(processed_line) > 0 and processed_line[0] == recovery and \
+               processed_line[2] not in self._job_mounts:
                 return processed_line[2]
 
         #if not already, mounted, produce a mount point
@@ -265,10 +480,17 @@ class Backend(dbus.service.Object):
                 except IndexError:
                     mntdir = ''
                     logging.warning("IndexError when operating on output string")
+                if mntdir in self._job_mounts:
+                    logging.warning("%s is only mounted for another job" % recovery)
+                    mntdir = ''
             else:
                 mntdir = ''
                 logging.warning("Unable to mount recovery partition")
                 logging.warning(output)
+        elif self._context().job is not None:
+            #the service outlives its jobs, so they don't keep mounts around
+            self._context().mounts.append(mntdir)
+            self._job_mounts.add(mntdir)
         else:
             atexit.register(self._unmount_drive, mntdir)
         return mntdir
@@ -321,78 +543,192 @@ class Backend(dbus.service.Object):
             logging.debug("_test_for_new_dell_recovery: RP Distro %s doesn't match our distro %s, not injecting updated package", rp_distro, package_distro)
 
 
-    def _process_driver_fish(self, driver_fish, assembly_tmp):
-        """Processes a driver FISH archive"""
-        logging.debug("_process_driver_fish: assmebly_tmp: %s" % assembly_tmp)
-        length = len(driver_fish)
-        for fishie in driver_fish:
-            logging.debug(" processing %s" % fishie)
-            self.report_progress(_('Processing FISH packages'),
-                                 driver_fish.index(fishie)/length*100)
-            if os.path.isfile(fishie):
-                with open(fishie, 'rb') as fish:
-                    md5sum = md5(fish.read()).hexdigest()
-                self.xml_obj.append_fish('driver', os.path.basename(fishie), md5sum)
-            dest = None
-            if fishie.endswith('.deb'):
-                dest = os.path.join(assembly_tmp, 'debs')
-                logging.debug("  Copying debian archive fishie %s", fishie)
-            elif fishie.endswith('.pdf'):
-                dest = os.path.join(assembly_tmp, 'docs')
-                logging.debug("  Copying document fishie fishie %s", fishie)
-            elif fishie.endswith('.py') or fishie.endswith('.sh'):
-                dest = os.path.join(assembly_tmp, 'scripts', 'chroot-scripts', 'fish')
-                logging.debug("  Copying python or shell fishie %s", fishie)
-            elif os.path.exists(fishie) and tarfile.is_tarfile(fishie):
-                nested = False
-                rfd = tarfile.open(fishie)
-                for member in rfd.getmembers():
-                    name = member.get_info(encoding='UTF-8', errors='strict')['name']
-                    if name.endswith('.html'):
-                        nested = name
-                        break
-                if nested:
-                    archive_tmp = tempfile.mkdtemp()
-                    atexit.register(walk_cleanup, archive_tmp)
-                    safe_tar_extract(fishie, archive_tmp)
-                    children = []
-                    for child in os.listdir(archive_tmp):
-                        if child != name:
-                            children.append(os.path.join(archive_tmp,child))
-                    logging.debug("  Extracting nested archive %s", fishie)
-                    self._process_driver_fish(children, assembly_tmp)
+    def _load_bto_xml(self, mntdir):
+        """Starts the BTOxml of this call off from the bto.xml an image
+           carries, when it has one"""
+        if os.path.exists(os.path.join(mntdir, 'bto.xml')):
+            self.xml_obj.load_bto_xml(os.path.join(mntdir, 'bto.xml'))
+
+    def _copy_fish(self, fishie, dest):
+        """Copies a FISH package, hashing it on the way unless its digests
+           are already cached.
+           Returns the destination and its digests"""
+        digests = self.digest_cache.lookup(fishie, self.media_digests)
+        if digests is None:
+            path_stat = os.stat(fishie)
+            target, digests = copy_file_hashed(fishie, dest, self.media_digests)
+            self.digest_cache.add(fishie, digests, path_stat)
+        else:
+            target = copy_file(fishie, dest)
+        return (target, digests)
+
+    def _prepare_driver_fish(self, fishie, assembly_tmp):
+        """Does the heavy lifting for a driver FISH package: hashing it and
+           copying or extracting it into a staging directory of its own.
+           Safe to run for several packages at once.
+           Returns the list of steps _merge_driver_fish needs to apply"""
+        logging.debug(" processing %s" % fishie)
+        steps = []
+        dest = None
+        if fishie.endswith('.deb'):
+            dest = 'debs'
+            logging.debug("  Copying debian archive fishie %s", fishie)
+        elif fishie.endswith('.pdf'):
+            dest = 'docs'
+            logging.debug("  Copying document fishie fishie %s", fishie)
+        elif fishie.endswith('.py') or fishie.endswith('.sh'):
+            dest = os.path.join('scripts', 'chroot-scripts', 'fish')
+            logging.debug("  Copying python or shell fishie %s", fishie)
+        elif os.path.exists(fishie) and tarfile.is_tarfile(fishie):
+            #inspect, check, hash and extract in one pass over the archive
+            staging = self._mkdtemp(os.path.dirname(assembly_tmp))
+            path_stat = os.stat(fishie)
+            digests = self.digest_cache.lookup(fishie, self.media_digests)
+            cached = None
+            if digests is not None:
+                cached = self.fish_cache.fetch(digests['md5'], staging)
+            if cached is not None:
+                logging.debug("  Reusing cached extraction of %s", fishie)
+                names = cached['names']
+            else:
+                if digests is None:
+                    digests, names = extract_tar(fishie, staging, self.media_digests)
+                    self.digest_cache.add(fishie, digests, path_stat)
                 else:
-                    safe_tar_extract(fishie, assembly_tmp)
-                    logging.debug(":  Extracting tar fishie %s", fishie)
-                    pre_package = os.path.join(assembly_tmp, 'prepackage.dell')
-                    if os.path.exists(pre_package):
-                        os.remove(pre_package)
+                    names = extract_tar(fishie, staging)[1]
+                #unsafe tarballs leave nothing behind worth caching
+                if names is not None:
+                    try:
+                        self.fish_cache.store(digests['md5'], staging, names)
+                    except (IOError, OSError) as err:
+                        logging.warning("Unable to cache %s: %s", fishie, err)
+            steps.append(('fish', os.path.basename(fishie), digests['md5']))
+            if names is None:
+                logging.warning("  Not extracting unsafe tar fishie %s", fishie)
+                names = []
+            nested = False
+            for name in names:
+                if name.endswith('.html'):
+                    nested = name
+                    break
+            if nested:
+                logging.debug("  Extracted nested archive %s", fishie)
+                for child in sorted(os.listdir(staging)):
+                    if child != nested:
+                        steps.extend(self._prepare_driver_fish(
+                                        os.path.join(staging, child),
+                                        assembly_tmp))
             else:
-                logging.debug("  ignoring fishie %s", fishie)
-
-            #If we just do a flat copy
-            if dest is not None:
-                if not os.path.isdir(dest):
-                    os.makedirs(dest)
-                distutils.file_util.copy_file(fishie, dest,
-                                              verbose=1, update=0)
+                logging.debug(":  Extracted tar fishie %s", fishie)
+                steps.append(('tree', staging))
+        else:
+            if os.path.isfile(fishie):
+                steps.append(('fish', os.path.basename(fishie),
+                              self.digest_cache.hash_file(fishie, self.media_digests)['md5']))
+            logging.debug("  ignoring fishie %s", fishie)
+
+        #If we just do a flat copy, hash it on the way through
+        if dest is not None:
+            staging = self._mkdtemp(os.path.dirname(assembly_tmp))
+            os.makedirs(os.path.join(staging, dest))
+            target, digests = self._copy_fish(fishie, os.path.join(staging, dest))
+            steps.append(('tree', staging))
+            steps.append(('digests', os.path.relpath(target, staging), digests))
+            steps.append(('fish', os.path.basename(fishie), digests['md5']))
+        return steps
+
+    def _merge_driver_fish(self, steps, assembly_tmp):
+        """Applies the steps of a prepared driver FISH package to the image
+           and bto.xml, this has to happen in the order the packages came in"""
+        for step in steps:
+            if step[0] == 'fish':
+                self.xml_obj.append_fish('driver', step[1], step[2])
+            elif step[0] == 'tree':
+                move_tree(step[1], assembly_tmp)
+                pre_package = os.path.join(assembly_tmp, 'prepackage.dell')
+                if os.path.exists(pre_package):
+                    os.remove(pre_package)
+            elif step[0] == 'digests':
+                self.digests.add(os.path.join(assembly_tmp, step[1]), step[2])
 
+    def _process_driver_fish(self, driver_fish, assembly_tmp):
+        """Processes driver FISH archives.
+           Packages are hashed and unpacked in parallel, but land in the
+           image and bto.xml in the order they were given"""
+        logging.debug("_process_driver_fish: assmebly_tmp: %s" % assembly_tmp)
+        length = len(driver_fish)
+        done = [0]
+        lock = threading.Lock()
+        job = self._job_key()
+        #the packages belong to this call or job, wherever they are prepared
+        context = self._context_of()
+
+        def prepared(future):
+            """Reports progress as packages finish unpacking"""
+            with lock:
+                done[0] += 1
+                self.update_progress(_('Processing FISH packages'),
+                                     done[0]/length*100, job=job)
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            futures = []
+            for fishie in driver_fish:
+                future = pool.submit(self._in_context, context,
+                                     self._prepare_driver_fish, fishie,
+                                     assembly_tmp)
+                future.add_done_callback(prepared)
+                futures.append(future)
+            try:
+                for future in futures:
+                    self._merge_driver_fish(future.result(), assembly_tmp)
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
-    def start_sizable_progress_thread(self, input_str, mnt, w_size):
-        """Initializes the extra progress thread, or resets it
-           if it already exists'"""
-        self.progress_thread = ProgressBySize(input_str, mnt, w_size)
-        self.progress_thread.progress = self.report_progress
-        self.progress_thread.start()
+    def update_progress(self, input_str, percent, rate=0.0, eta=-1.0, job=None):
+        """Sends progress to the UI, coalesced so the bus isn't flooded.
+           Progress belongs to the job running on this thread unless job
+           says otherwise"""
+        if job is None:
+            job = self._job_key()
+        self.progress_emitter.update(input_str, percent, rate, eta, job)
+
+    def _save_digest_cache(self):
+        """Writes out the digest cache, it is only an optimisation so failing
+           to do so is not fatal"""
+        try:
+            self.digest_cache.save()
+        except (IOError, OSError) as err:
+            logging.warning("Unable to save digest cache: %s", err)
+
+    def _remember_image(self, path, info):
+        """Records what a probe found out about an image, failing to write
+           the cache out is not fatal"""
+        self.image_cache.add(path, info)
+        try:
+            self.image_cache.save()
+        except (IOError, OSError) as err:
+            logging.warning("Unable to save image cache: %s", err)
+
+    def start_byte_progress(self, input_str, w_size):
+        """Creates a progress counter for work that reports its own bytes,
+           feed it through its add() or set() methods"""
+        progress = ByteProgress(input_str, w_size)
+        progress.progress = functools.partial(self.update_progress,
+                                              job=self._job_key())
+        return progress
 
     def stop_progress_thread(self):
         """Stops the extra thread for reporting progress"""
         self.progress_thread.join()
+        self.progress_emitter.flush(self._job_key())
 
     def start_pulsable_progress_thread(self, input_str):
         """Starts the extra thread for pulsing progress in the UI"""
         self.progress_thread = ProgressByPulse(input_str)
-        self.progress_thread.progress = self.report_progress
+        self.progress_thread.progress = functools.partial(self.update_progress,
+                                                          job=self._job_key())
         self.progress_thread.start()
     #
     # Client API (through D-BUS)
@@ -416,11 +752,18 @@ class Backend(dbus.service.Object):
         """Closes the backend and cleans up"""
         self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.request_exit')
         self._timeout = True
-        self.main_loop.quit()
+        if self._busy():
+            #let the calls and jobs still running finish before going away
+            logging.debug("request_exit: waiting for %d calls and queued jobs"
+                          % self._pending)
+            self._exit_requested = True
+        else:
+            self.main_loop.quit()
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
         in_signature = 'sasa{ss}ssss', out_signature = '', sender_keyword = 'sender',
-        connection_keyword = 'conn')
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
     def assemble_image(self,
                        base,
                        driver_fish,
@@ -443,18 +786,19 @@ class Backend(dbus.service.Object):
         self._reset_timeout()
 
         base_mnt = self.request_mount(base, "r", sender, conn)
+        #what the base already records is carried over, fish are added to it
+        self._load_bto_xml(base_mnt)
 
-        assembly_tmp = tempfile.mkdtemp()
-        atexit.register(walk_cleanup, assembly_tmp)
+        assembly_tmp = self._mkdtemp()
 
         #copy the base iso/mnt point/etc
         white_pattern = re.compile('')
-        w_size = white_tree("size", white_pattern, base_mnt)
-        self.start_sizable_progress_thread(_('Adding in base image'),
-                                           assembly_tmp,
-                                           w_size)
-        white_tree("copy", white_pattern, base_mnt, assembly_tmp)
-        self.stop_progress_thread()
+        manifest = white_tree("scan", white_pattern, base_mnt)
+        progress = self.start_byte_progress(_('Adding in base image'),
+                                            manifest.data_size)
+        manifest.copy(assembly_tmp, algorithms=self.media_digests, counter=progress.add)
+        progress.finish()
+        self.digests.update(manifest.digests)
 
         #Add in driver FISH content
         if len(driver_fish) > 0:
@@ -470,17 +814,15 @@ class Backend(dbus.service.Object):
             dest = os.path.join(assembly_tmp, 'srv')
             os.makedirs(dest)
             for fishie in application_fish:
-                with open(fishie, 'rb') as fish:
-                    md5sum = md5(fish.read()).hexdigest()
                 new_name = application_fish[fishie]
-                self.xml_obj.append_fish('application', os.path.basename(fishie), md5sum, new_name)
+                target = new_name
                 if fishie.endswith('.zip'):
-                    new_name += '.zip'
+                    target += '.zip'
                 elif os.path.exists(fishie) and tarfile.is_tarfile(fishie):
-                    new_name += '.tgz'
-                distutils.file_util.copy_file(fishie,
-                                              os.path.join(dest, new_name),
-                                              verbose=1, update=0)
+                    target += '.tgz'
+                target, digests = self._copy_fish(fishie, os.path.join(dest, target))
+                self.digests.add(target, digests)
+                self.xml_obj.append_fish('application', os.path.basename(fishie), digests['md5'], new_name)
 
         #If dell-recovery needs to be injected into the image
         if dell_recovery_package:
@@ -495,17 +837,207 @@ class Backend(dbus.service.Object):
                 (out, err) = call.communicate()
             else:
                 logging.debug("Adding manually included dell-recovery package, %s", dell_recovery_package)
-                distutils.file_util.copy_file(dell_recovery_package, dest)
+                copy_file(dell_recovery_package, dest)
+
+        self._save_digest_cache()
 
         function = getattr(Backend, create_fn)
-        function(self, assembly_tmp, version, iso)
+        self._context().assembling = True
+        try:
+            function(self, assembly_tmp, version, iso)
+        finally:
+            self._context().assembling = False
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
-        in_signature = 's', out_signature = 'sssss', sender_keyword = 'sender',
-        connection_keyword = 'conn')
-    def query_iso_information(self, iso, sender=None, conn=None):
-        """Queries what type of ISO this is.  This same method will be used regardless
-           of OS."""
+        in_signature = 's', out_signature = 'a(sss)', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def verify_media(self, path, sender=None, conn=None):
+        """Verifies an RP, ISO or directory against its md5sum.txt.
+           Returns a list of (file, expected, actual) for every file that
+           doesn't match; actual is empty for files that can't be read"""
+        logging.debug("verify_media: path %s" % path)
+
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn,
+                                     'com.dell.recoverymedia.verify_media')
+
+        mntdir = self.request_mount(path, "r", sender, conn)
+        if not mntdir or not os.path.exists(os.path.join(mntdir, 'md5sum.txt')):
+            raise VerifyFailed("%s has no md5sum.txt to verify against." % path)
+
+        progress = self.start_byte_progress(_('Verifying media'), 0)
+        mismatches = verify_manifest(mntdir, progress=progress)
+        progress.finish()
+        for item in mismatches:
+            logging.warning("verify_media: %s expected %s, got %s" % item)
+        return dbus.Array([dbus.Struct(item) for item in mismatches],
+                          signature='(sss)')
+
+    def _probe_image(self, image):
+        """Reads everything the query methods want to know from an opened
+           IsoImage or DirectoryImage in one pass over it"""
+        info = dict(IMAGE_UNKNOWN)
+
+        #BTO images carry bto.xml or bto_version, BTO compatible ones have
+        #the bootstrap in their initrd
+        out = image.read('/bto.xml')
+        if out:
+            #probes can run alongside a build, so they get their own BTOxml
+            xml_obj = BTOxml()
+            xml_obj.load_bto_xml(out.decode('utf-8'))
+            info['bto_version'] = xml_obj.fetch_node_contents('iso')
+            info['bto_date'] = xml_obj.fetch_node_contents('date')
+        else:
+            out = image.read('/bto_version')
+            if out:
+                out = out.decode('utf-8', 'replace').split('\n')
+                if len(out) > 1:
+                    info['bto_version'] = out[0]
+                    info['bto_date'] = out[1]
+            else:
+                for initrd in INITRD_PATHS:
+                    if image.exists(initrd):
+                        if initrd_contains(image.stream(initrd), INITRD_BOOTSTRAP):
+                            info['bto_version'] = '[native]'
+                        break
+
+        #Ubuntu disks have .disk/info
+        out = image.read('/.disk/info')
+        if out:
+            info['distributor_str'] = out.decode('utf-8', 'replace').split('\n')[0]
+            info['distributor'] = "ubuntu"
+
+        #RHEL disks have .discinfo
+        else:
+            out = image.read('/.discinfo')
+            if out:
+                lines = out.decode('utf-8', 'replace').split('\n') + ['', '', '']
+                info['distributor_str'] = '%s %s' % (lines[1], lines[2])
+                info['distributor'] = "redhat"
+
+        info['dell_recovery'] = self._find_dell_recovery(image)
+        return info
+
+    def _find_dell_recovery(self, image):
+        """Finds the newest version of dell-recovery on an image.
+           Package indexes, the debs directory and the live filesystem
+           manifest are where it normally is, the whole image is only
+           searched when it isn't in any of those"""
+        def newer(version, than):
+            '''Checks whether a version is newer than another'''
+            if not than:
+                return True
+            try:
+                return debian_support.version_compare(version, than) > 0
+            except ValueError:
+                return version > than
+
+        def deb_version(fname):
+            '''Version of a dell-recovery package from its file name'''
+            if '_' in fname:
+                return fname.split('_')[1]
+            return '1'
+
+        def in_packages(lines):
+            '''Finds the newest dell-recovery in a Packages index'''
+            found = ''
+            package = ''
+            for line in lines:
+                if line.startswith('Package:'):
+                    package = line.split(':', 1)[1].strip()
+                elif line.startswith('Version:') and package == 'dell-recovery':
+                    version = line.split(':', 1)[1].strip()
+                    if newer(version, found):
+                        found = version
+                elif not line.strip():
+                    package = ''
+            return found
+
+        def in_manifest(lines):
+            '''Finds dell-recovery in a manifest, stopping as soon as it is
+               seen'''
+            for line in lines:
+                fields = line.split()
+                if len(fields) > 1 and fields[0].split(':')[0] == 'dell-recovery':
+                    return fields[1]
+            return ''
+
+        def read_index(fname, parse):
+            '''Parses a text file of the image line by line'''
+            lines = read_lines(image.stream(fname), fname.endswith('.gz'))
+            try:
+                return parse(lines)
+            except zlib.error:
+                logging.debug("_find_dell_recovery: %s is damaged", fname)
+                return ''
+            finally:
+                lines.close()
+
+        found = ''
+
+        #packages that are in an apt repository on the image
+        for dists in ('/dists', '/debs/dists'):
+            if not image.isdir(dists):
+                continue
+            for index in image.walk(dists):
+                if os.path.basename(index) in ('Packages', 'Packages.gz') and \
+                        '/binary-' in index:
+                    version = read_index(index, in_packages)
+                    if version:
+                        logging.debug("_find_dell_recovery: Found %s in %s", version, index)
+                        if newer(version, found):
+                            found = version
+
+        #packages that are added to the image in debs
+        for debs in DELL_RECOVERY_DEBS:
+            if not image.isdir(debs):
+                continue
+            for fname in image.listdir(debs):
+                if 'dell-recovery' in fname and (fname.endswith('.deb') or fname.endswith('.rpm')):
+                    logging.debug("_find_dell_recovery: Found %s/%s", debs, fname)
+                    if newer(deb_version(fname), found):
+                        found = deb_version(fname)
+        if found:
+            return found
+
+        #installed in the live filesystem
+        for manifest in DELL_RECOVERY_MANIFESTS:
+            if image.exists(manifest) and not image.isdir(manifest):
+                found = read_index(manifest, in_manifest)
+                if found:
+                    logging.debug("_find_dell_recovery: Found %s in %s", found, manifest)
+                    return found
+
+        #search everything, packages first and manifests only if there are none
+        logging.debug("_find_dell_recovery: not in any of the usual places, searching %s",
+                      image.path)
+        interesting_files = []
+        for fname in image.walk():
+            if 'dell-recovery' in fname and (fname.endswith('.deb') or fname.endswith('.rpm')):
+                logging.debug("_find_dell_recovery: Found %s", fname)
+                version = deb_version(os.path.basename(fname))
+                if newer(version, found):
+                    found = version
+            elif fname.endswith('.manifest') and fname not in DELL_RECOVERY_MANIFESTS:
+                interesting_files.append(fname)
+                logging.debug("_find_dell_recovery: Appending %s to interesting_files", fname)
+
+        if not found:
+            for fname in interesting_files:
+                if image.isdir(fname):
+                    continue
+                logging.debug("_find_dell_recovery: Checking %s ", fname)
+                version = read_index(fname, in_manifest)
+                if version:
+                    logging.debug("_find_dell_recovery: Found %s in %s", version, fname)
+                    if newer(version, found):
+                        found = version
+        return found
+
+    def _inspect_image(self, path, sender=None, conn=None):
+        """Works out everything there is to know about a base image or RP,
+           opening or mounting it only once and only if it isn't cached"""
         def find_arch(input_str):
             """Finds the architecture in an input string"""
             for item in input_str.split():
@@ -521,224 +1053,123 @@ class Backend(dbus.service.Object):
                     release = float(piece)
                 except ValueError:
                     continue
-                logging.debug("query_iso_information: find_float found %d", release)
+                logging.debug("_inspect_image: find_float found %d", release)
                 return piece
             return ''
-        logging.debug("query_iso_information: iso %s" % iso)
+        logging.debug("_inspect_image: path %s" % path)
 
-        self._reset_timeout()
-        self._check_polkit_privilege(sender, conn,
-                                'com.dell.recoverymedia.query_iso_information')
-
-        (bto_version, bto_date) = self.query_bto_version(iso, sender, conn)
+        info = self.image_cache.lookup(path, IMAGE_UNKNOWN)
+        if info is None:
+            image = None
+            if os.path.isfile(path) and path.endswith('.iso'):
+                try:
+                    image = IsoImage(path)
+                except (ImageError, OSError) as err:
+                    logging.debug("_inspect_image: error reading %s: %s", path, err)
+            else:
+                mntdir = self.request_mount(path, "r", sender, conn)
+                if mntdir:
+                    image = DirectoryImage(mntdir)
+            if image is None:
+                info = dict(IMAGE_UNKNOWN)
+            else:
+                try:
+                    with image:
+                        info = self._probe_image(image)
+                    self._remember_image(path, info)
+                except (ImageError, OSError) as err:
+                    logging.debug("_inspect_image: error reading %s: %s", path, err)
+                    info = dict(IMAGE_UNKNOWN)
+
+        bto_version = info['bto_version']
+        bto_date = info['bto_date']
+        distributor_str = info['distributor_str']
+        info['release'] = find_float(distributor_str)
+        info['arch'] = find_arch(distributor_str)
+        if bto_version and bto_date:
+            info['description'] = "<b>Dell BTO Image</b>, version %s built on %s\n%s" % (bto_version.split('.')[0], bto_date, distributor_str)
+        elif bto_version == '[native]':
+            info['description'] = "<b>Dell BTO Compatible Image</b>\n%s" % distributor_str
+        else:
+            info['description'] = distributor_str
+        return info
 
-        distributor_str = 'Unknown Base Image'
-        distributor = ''
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 's', out_signature = 'a{ss}', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def inspect_image(self, path, sender=None, conn=None):
+        """Inspects a base image or RP in a single pass.
+           Returns bto_version, bto_date, distributor, release, arch,
+           description and dell_recovery, as the query methods would"""
+        logging.debug("inspect_image: path %s" % path)
 
-        #Ubuntu disks have .disk/info
-        if os.path.isfile(iso) and iso.endswith('.iso'):
-            cmd = ['isoinfo', '-J', '-i', iso, '-x', '/.disk/info']
-            invokation = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                          universal_newlines=True)
-            out, err = invokation.communicate()
-            if invokation.returncode is None:
-                invokation.wait()
-            if out:
-                distributor_str = out
-                distributor = "ubuntu"
-            if err:
-                logging.debug("error during isoinfo invokation: %s", err)
-        else:
-            mntdir = self.request_mount(iso, "r", sender, conn)
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn,
+                                     'com.dell.recoverymedia.inspect_image')
 
-            if os.path.exists(os.path.join(mntdir, '.disk', 'info')):
-                with open(os.path.join(mntdir, '.disk', 'info'), 'r') as rfd:
-                    distributor_str = rfd.readline().strip('\n')
-                distributor = "ubuntu"
+        info = self._inspect_image(path, sender, conn)
+        del info['distributor_str']
+        return dbus.Dictionary(info, signature='ss')
 
-            #RHEL disks have .discinfo
-            elif os.path.exists(os.path.join(mntdir, '.discinfo')):
-                with open(os.path.join(mntdir, '.discinfo'), 'r') as rfd:
-                    timestamp = rfd.readline().strip('\n')
-                    distributor_string = rfd.readline().strip('\n')
-                    arch = rfd.readline().strip('\n')
-                distributor = "redhat"
-                distributor_str += ' ' + arch
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 's', out_signature = 'sssss', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded(expand=True)
+    def query_iso_information(self, iso, sender=None, conn=None):
+        """Queries what type of ISO this is.  This same method will be used regardless
+           of OS."""
+        logging.debug("query_iso_information: iso %s" % iso)
 
-        release = find_float(distributor_str)
-        arch = find_arch(distributor_str)
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn,
+                                'com.dell.recoverymedia.query_iso_information')
 
-        if bto_version and bto_date:
-            distributor_str = "<b>Dell BTO Image</b>, version %s built on %s\n%s" % (bto_version.split('.')[0], bto_date, distributor_str)
-        elif bto_version == '[native]':
-            distributor_str = "<b>Dell BTO Compatible Image</b>\n%s" % distributor_str
-        else:
+        info = self._inspect_image(iso, sender, conn)
+        bto_version = info['bto_version']
+        if not (bto_version and info['bto_date']) and bto_version != '[native]':
             bto_version = ''
 
-        self.report_iso_info(bto_version, distributor, release, arch, distributor_str)
+        self._emit(self.report_iso_info, bto_version, info['distributor'],
+                   info['release'], info['arch'], info['description'])
         logging.debug(" returning bto_version %s, distributor %s, release %s, \
-arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distributor_str))
-        return (bto_version, distributor, release, arch, distributor_str)
+arch %s, distributor_str %s" % (bto_version, info['distributor'], info['release'],
+                                info['arch'], info['description']))
+        return (bto_version, info['distributor'], info['release'],
+                info['arch'], info['description'])
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
         in_signature = 's', out_signature = 'ss', sender_keyword = 'sender',
-        connection_keyword = 'conn')
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded(expand=True)
     def query_bto_version(self, recovery, sender=None, conn=None):
         """Queries the BTO version number internally stored in an ISO or RP"""
-
-        def test_initrd(cmd0):
-            """Tests an initrd using the selected command"""
-            cmd1 = ['unlzma']
-            cmd2 = ['cpio', '-it', '--quiet']
-            chain0 = subprocess.Popen(cmd0, stdout=subprocess.PIPE)
-            chain1 = subprocess.Popen(cmd1, stdin=chain0.stdout, stdout=subprocess.PIPE)
-            chain2 = subprocess.Popen(cmd2, stdin=chain1.stdout, stdout=subprocess.PIPE,
-                                      universal_newlines=True)
-            out, err = chain2.communicate()
-            if chain2.returncode is None:
-                chain2.wait()
-            if out:
-                for line in out.split('\n'):
-                    if 'scripts/casper-bottom/99dell_bootstrap' in line:
-                        return '[native]'
-            return ''
         logging.debug("query_bto_version: recovery %s" % recovery)
 
         self._reset_timeout()
         self._check_polkit_privilege(sender, conn,
                                     'com.dell.recoverymedia.query_bto_version')
 
-        #mount the recovery partition
-        version = ''
-        date = ''
-
-        if os.path.isfile(recovery) and recovery.endswith('.iso'):
-            cmd = ['isoinfo', '-J', '-i', recovery, '-x', '/bto.xml']
-            out = fetch_output(cmd)
-            if out:
-                self.xml_obj.load_bto_xml(out)
-                version = self.xml_obj.fetch_node_contents('iso')
-                date = self.xml_obj.fetch_node_contents('date')
-            else:
-                cmd = ['isoinfo', '-J', '-i', recovery, '-x', '/bto_version']
-                out = fetch_output(cmd)
-                if out:
-                    out = out.split('\n')
-                    if len(out) > 1:
-                        version = out[0]
-                        date = out[1]
-                else:
-                    version = test_initrd(['isoinfo', '-J', '-i', recovery, '-x', '/casper/initrd.lz'])
-
-        else:
-            mntdir = self.request_mount(recovery, "r", sender, conn)
-            if os.path.exists(os.path.join(mntdir, 'bto.xml')):
-                self.xml_obj.load_bto_xml(os.path.join(mntdir, 'bto.xml'))
-                version = self.xml_obj.fetch_node_contents('iso')
-                date = self.xml_obj.fetch_node_contents('date')
-            elif os.path.exists(os.path.join(mntdir, 'bto_version')):
-                with open(os.path.join(mntdir, 'bto_version'), 'r') as rfd:
-                    version = rfd.readline().strip('\n')
-                    date = rfd.readline().strip('\n')
-            #no /bto.xml or /bto_version found, check initrd for bootsrap files
-            elif os.path.exists(os.path.join(mntdir, 'casper', 'initrd.lz')):
-                version = test_initrd(['cat', os.path.join(mntdir, 'casper', 'initrd.lz')])
-
-        return (version, date)
+        info = self._inspect_image(recovery, sender, conn)
+        return (info['bto_version'], info['bto_date'])
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
         in_signature = 's', out_signature = 's', sender_keyword = 'sender',
-        connection_keyword = 'conn')
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
     def query_have_dell_recovery(self, recovery, sender=None, conn=None):
         '''Checks if the given image contains the dell-recovery
            package suite'''
-
-        def run_isoinfo_command(cmd):
-            """Returns the output of an isoinfo command"""
-            invokation = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                          universal_newlines=True)
-            out, err = invokation.communicate()
-            if invokation.returncode is None:
-                invokation.wait()
-            if err:
-                logging.debug("error invoking isoinfo: %s", err)
-            return out
-
-        def check_mentions(feed):
-            '''Checks if given file mentions dell-recovery'''
-            for line in feed.split('\n'):
-                if 'dell-recovery' in line:
-                    return line.split()[1]
-            return ''
         logging.debug("query_have_dell_recovery: recovery %s" % recovery)
 
-        found = ''
-
-        #Recovery Partition is an ISO
-        if os.path.isfile(recovery) and recovery.endswith('.iso'):
-            #first find the interesting files
-            cmd = ['isoinfo', '-J', '-i', recovery, '-f']
-            logging.debug("query_have_dell_recovery: Checking %s", recovery)
-            interesting_files = []
-            for fname in run_isoinfo_command(cmd).split('\n'):
-                if 'dell-recovery' in fname and (fname.endswith('.deb') or fname.endswith('.rpm')):
-                    logging.debug("query_have_dell_recovery: Found %s", fname)
-                    if '_' in fname:
-                        new = fname.split('_')[1]
-                        if new > found:
-                            found = new
-                    if not found:
-                        found = '1'
-                elif fname.endswith('.manifest'):
-                    interesting_files.append(fname)
-                    logging.debug("query_have_dell_recovery: Appending %s to interesting_files", fname)
-
-            if not found:
-                for fname in interesting_files:
-                    cmd = ['isoinfo', '-J', '-i', recovery, '-x', fname]
-                    logging.debug("query_have_dell_recovery: Checking %s ", fname)
-                    version = check_mentions(run_isoinfo_command(cmd))
-                    if version:
-                        logging.debug("query_have_dell_recovery: Found %s in %s", version, fname)
-                        if version > found:
-                            found = version
-        #Recovery partition is mount point or directory
-        else:
-            #Search for a flat file first (or a manifest for later)
-            logging.debug("query_have_dell_recovery: Searching mount point %s", recovery)
-            interesting_files = []
-            for root, dirs, files in os.walk(recovery, topdown=False):
-                for fname in files:
-                    if 'dell-recovery' in fname and (fname.endswith('.deb') or fname.endswith('.rpm')):
-                        logging.debug("query_have_dell_recovery: Found in %s", os.path.join(root, fname))
-                        if '_' in fname:
-                            new = fname.split('_')[1]
-                            if new > found:
-                                found = new
-                        if not found:
-                            found = '1'
-                    elif fname.endswith('.manifest'):
-                        interesting_files.append(os.path.join(root, fname))
-                        logging.debug("query_have_dell_recovery: Appending %s to interesting_files", os.path.join(root, fname))
-
-            if not found:
-                for fname in interesting_files:
-                    logging.debug("query_have_dell_recovery: Checking %s ", fname)
-                    with open(fname, 'r') as rfd:
-                        output = rfd.read()
-                    version = check_mentions(output)
-                    if version:
-                        logging.debug("query_have_dell_recovery: Found %s in %s", version, fname)
-                        if version > found:
-                            found = version
-        return found
+        return self._inspect_image(recovery, sender, conn)['dell_recovery']
 
-    @dbus.service.method(DBUS_INTERFACE_NAME,
-        in_signature = 's', out_signature = '', sender_keyword = 'sender',
-        connection_keyword = 'conn')
-    def validate_driver_package(self, package, sender=None, conn=None):
-        """Validates a Dell driver package"""
-        logging.debug ("Validating driver package %s" % package)
+    def _check_driver_package(self, package, our_os):
+        """Checks a Dell driver package against the local OS version.
+           What prepackage.dell says comes from the FISH catalog, so a
+           package is only read the first time it is seen.
+           Returns valid (-1 broken, 0 wrong OS, 1 good), the list of drivers
+           described and an error or warning"""
         valid = 1
         description = ['']
         error_warning = ''
@@ -746,29 +1177,201 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
             valid = -1
             error_warning = 'Bad file name'
         if valid >= 0:
-            rfd = tarfile.open(package)
-            prepackage = False
-            for name in rfd.getnames():
-                if name.endswith('prepackage.dell'):
-                    prepackage = rfd.getmember(name)
-                    break
-            if not prepackage:
+            try:
+                entry = self.fish_catalog.update(package)
+            except (IOError, OSError, tarfile.TarError, sqlite3.Error) as err:
+                logging.debug("Unable to index %s: %s" % (package, err))
+                entry = None
+            if entry is None or not entry.prepackage:
                 valid = -1
                 error_warning = 'Missing or invalid XML descriptor (prepackage.dell)'
         if valid >= 0:
-            tmpdir = tempfile.mkdtemp()
-            atexit.register(walk_cleanup, tmpdir)
-            rfd.extract(prepackage, tmpdir)
-            rfd.close()
-            self.xml_obj.load_bto_xml(os.path.join(tmpdir, 'prepackage.dell'))
-            our_os = lsb_release.get_lsb_information()['RELEASE']
-            package_os = self.xml_obj.fetch_node_contents('os')
-            if our_os != package_os:
+            if our_os != entry.os:
                 valid = 0
-                error_warning = "OS Version of package %s doesn't match local OS version %s" % (package_os, our_os)
-            description = self.xml_obj.fetch_node_contents('driver')
+                error_warning = "OS Version of package %s doesn't match local OS version %s" % (entry.os, our_os)
+            description = entry.description or ['']
+        return (valid, description, error_warning)
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 's', out_signature = '', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def validate_driver_package(self, package, sender=None, conn=None):
+        """Validates a Dell driver package"""
+        logging.debug ("Validating driver package %s" % package)
+        (valid, description, error_warning) = self._check_driver_package(package,
+                                    lsb_release.get_lsb_information()['RELEASE'])
         logging.debug("Validation complete: valid %s" % valid)
-        self.report_package_info(valid, description, error_warning)
+        self._emit(self.report_package_info, valid, description, error_warning)
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 'as', out_signature = 'a(siass)', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def validate_driver_packages(self, packages, sender=None, conn=None):
+        """Validates a list of Dell driver packages at once.
+           Returns (package, valid, description, error_warning) for each of
+           them, in the same order, with the meanings of report_package_info"""
+        logging.debug("Validating %d driver packages" % len(packages))
+        self._reset_timeout()
+        our_os = lsb_release.get_lsb_information()['RELEASE']
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            results = list(pool.map(lambda package:
+                                    self._check_driver_package(package, our_os),
+                                    packages))
+        logging.debug("Validation complete: %d valid" %
+                      len([result for result in results if result[0] > 0]))
+        return dbus.Array([dbus.Struct((package, valid,
+                                        dbus.Array(description, signature='s'),
+                                        error_warning))
+                           for package, (valid, description, error_warning)
+                           in zip(packages, results)], signature='(siass)')
+
+    @staticmethod
+    def _catalog_reply(entries):
+        """Packs CatalogEntries up for a D-Bus reply"""
+        return dbus.Array([dbus.Struct((entry.path, dbus.UInt64(entry.size),
+                                        entry.md5, entry.os,
+                                        dbus.Array(entry.description, signature='s')))
+                           for entry in entries], signature='(stssas)')
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 's', out_signature = 'a(stssas)', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def index_fish_library(self, directory, sender=None, conn=None):
+        """Brings the FISH catalog up to date with a library directory.
+           Returns (path, size, md5, os, drivers) for every package in it"""
+        logging.debug("index_fish_library: %s" % directory)
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.create')
+        return self._catalog_reply(self.fish_catalog.index(directory))
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 'as', out_signature = 'a(stssas)', sender_keyword = 'sender',
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
+    def query_fish_packages(self, packages, sender=None, conn=None):
+        """Looks a list of FISH packages up in the catalog, indexing any that
+           are new or changed.
+           Returns (path, size, md5, os, drivers) for each, in the same order,
+           the md5 is empty for packages that can't be read"""
+        logging.debug("query_fish_packages: %s" % packages)
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.create')
+        def lookup(package):
+            """Packages that can't be read come back without an md5"""
+            try:
+                return self.fish_catalog.update(package)
+            except (IOError, OSError, tarfile.TarError, sqlite3.Error) as err:
+                logging.debug("Unable to index %s: %s" % (package, err))
+                return CatalogEntry(package, 0, 0, '', '', [], [], False)
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            entries = list(pool.map(lookup, packages))
+        return self._catalog_reply(entries)
+
+    def _run_build(self, job, base, driver_fish, application_fish,
+                   dell_recovery_package, create_fn, version, iso):
+        """Runs a build submitted with submit_build.  It gets a BTOxml and
+           a scratch directory of its own.  The scratch directory and
+           whatever the build mounted go away when the build is done"""
+        scratch = tempfile.mkdtemp(prefix='dell-recovery-job%d-' % job.id)
+        self._new_context(job, scratch)
+        try:
+            Backend.assemble_image(self, base, driver_fish, application_fish,
+                                   dell_recovery_package, create_fn, version,
+                                   iso)
+        finally:
+            self.progress_emitter.finish(job.id)
+            #nested images are mounted from inside their parents
+            for mntdir in reversed(self._context().mounts):
+                self._unmount_drive(mntdir)
+                with self._mount_lock:
+                    self._job_mounts.discard(mntdir)
+            self._new_context()
+            walk_cleanup(scratch)
+
+    def _job_state_changed(self, job):
+        """Announces a job changing state, and lets the backend exit once
+           an exit was requested and this was the last job"""
+        logging.debug("job %d (%s): %s %s" % (job.id, job.description,
+                                              job.state, job.error))
+        self._emit(self.report_job_state, dbus.UInt32(job.id), job.state,
+                   job.error)
+        if job.is_finished():
+            self._emit(self._exit_if_idle)
+
+    def _job_progress(self, job, input_str, percent, rate, eta):
+        """Sends the progress of a job, job ids go out as they came in"""
+        self._emit(self.report_job_progress, dbus.UInt32(job), input_str,
+                   percent, rate, eta)
+
+    def _job_reply(self, job):
+        """Describes a job as (id, state, description, priority, error)"""
+        return dbus.Struct((dbus.UInt32(job.id), job.state, job.description,
+                            job.priority, job.error), signature='ussis')
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 'sasa{ss}ssssi', out_signature = 'u', sender_keyword = 'sender',
+        connection_keyword = 'conn')
+    def submit_build(self,
+                     base,
+                     driver_fish,
+                     application_fish,
+                     dell_recovery_package,
+                     create_fn,
+                     version, iso, priority, sender=None, conn=None):
+        """Queues up a build, taking the same arguments as assemble_image,
+           and returns its job id straight away.
+           Higher priorities are built first, builds of the same priority in
+           the order they were submitted.  Follow it with report_job_state
+           and report_job_progress, or query_job"""
+        logging.debug("submit_build: iso %s, priority %d" % (iso, priority))
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.create')
+        job = self.jobs.submit(functools.partial(self._run_build,
+                                                 base=base,
+                                                 driver_fish=list(driver_fish),
+                                                 application_fish=dict(application_fish),
+                                                 dell_recovery_package=dell_recovery_package,
+                                                 create_fn=create_fn,
+                                                 version=version,
+                                                 iso=iso),
+                               os.path.basename(iso), priority)
+        return dbus.UInt32(job.id)
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 'u', out_signature = '(ussis)', sender_keyword = 'sender',
+        connection_keyword = 'conn')
+    def query_job(self, job_id, sender=None, conn=None):
+        """Returns (id, state, description, priority, error) of a job"""
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.query_jobs')
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise UnknownJob("There is no job %d." % job_id)
+        return self._job_reply(job)
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = '', out_signature = 'a(ussis)', sender_keyword = 'sender',
+        connection_keyword = 'conn')
+    def list_jobs(self, sender=None, conn=None):
+        """Returns (id, state, description, priority, error) of every job
+           that is queued, running or recently finished"""
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.query_jobs')
+        return dbus.Array([self._job_reply(job) for job in self.jobs.jobs()],
+                          signature='(ussis)')
+
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+        in_signature = 'u', out_signature = 'b', sender_keyword = 'sender',
+        connection_keyword = 'conn')
+    def cancel_job(self, job_id, sender=None, conn=None):
+        """Cancels a job that hasn't started yet, returns whether it was"""
+        self._reset_timeout()
+        self._check_polkit_privilege(sender, conn, 'com.dell.recoverymedia.create')
+        return self.jobs.cancel(job_id)
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
         in_signature = '', out_signature = '', sender_keyword = 'sender',
@@ -828,7 +1431,8 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
 
     @dbus.service.method(DBUS_INTERFACE_NAME,
         in_signature = 'sss', out_signature = '', sender_keyword = 'sender',
-        connection_keyword = 'conn')
+        connection_keyword = 'conn', async_callbacks = ASYNC_CALLBACKS)
+    @threaded()
     def create_ubuntu(self, recovery, version, iso, sender=None, conn=None):
         """Creates Ubuntu compatible recovery media"""
 
@@ -839,12 +1443,15 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
             (recovery, version, iso))
 
         #create temporary workspace
-        tmpdir = tempfile.mkdtemp()
-        atexit.register(walk_cleanup, tmpdir)
+        tmpdir = self._mkdtemp()
 
         #mount the recovery partition
         mntdir = self.request_mount(recovery, "r", sender, conn)
 
+        #on its own, the media records what the partition already did
+        if not self._context().assembling:
+            self._load_bto_xml(mntdir)
+
         #validate that ubuntu is on the partition
         if not os.path.exists(os.path.join(mntdir, '.disk', 'info')) and \
            not os.path.exists(os.path.join(mntdir, '.disk', 'info.recovery')):
@@ -862,12 +1469,13 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
         #check for a nested ISO image
         if os.path.exists(os.path.join(mntdir, 'ubuntu.iso')):
             pattern = re.compile('^ubuntu.iso|^.disk')
-            w_size = black_tree("size", pattern, mntdir)
-            self.start_sizable_progress_thread(_('Preparing nested image'),
-                                           tmpdir,
-                                           w_size)
-            black_tree("copy", pattern, mntdir, tmpdir)
-            self.stop_progress_thread()
+            manifest = black_tree("scan", pattern, mntdir)
+            progress = self.start_byte_progress(_('Preparing nested image'),
+                                                manifest.data_size)
+            manifest.copy(tmpdir, streaming=True, algorithms=self.media_digests,
+                          counter=progress.add)
+            progress.finish()
+            self.digests.update(manifest.digests)
             mntdir = self.request_mount(os.path.join(mntdir, 'ubuntu.iso'), "r", sender, conn)
 
         #Generate BTO XML File
@@ -1002,11 +1610,21 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
                     os.makedirs(os.path.join(tmpdir, 'factory'))
                 shutil.copy(os.path.join(mntdir, path + '.old'), os.path.join(tmpdir, path))
 
-        #regenerate md5sum file
+        #regenerate md5sum file, and the other checksum manifests with it
         if os.path.exists(os.path.join(mntdir, 'md5sum.txt')):
-            xorrisoargs.append('-m')
-            xorrisoargs.append(os.path.join(mntdir, 'md5sum.txt'))
-            regenerate_md5sum(tmpdir, mntdir)
+            #old manifests stay off the media, even those not written again
+            dropped = []
+            for name in list(MEDIA_MANIFESTS.values()) + [JSON_MANIFEST]:
+                if os.path.exists(os.path.join(mntdir, name)):
+                    xorrisoargs.append('-m')
+                    xorrisoargs.append(os.path.join(mntdir, name))
+                    dropped.append(name)
+            regenerate_manifests(tmpdir, mntdir, self.digests,
+                                 cache=self.digest_cache,
+                                 algorithms=self.media_digests,
+                                 json_manifest=self.json_manifest,
+                                 exclude=dropped)
+            self._save_digest_cache()
         #Directories to install
         xorrisoargs.append(tmpdir + '/')
         xorrisoargs.append(mntdir + '/')
@@ -1025,18 +1643,23 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
 
         retval = seg1.poll()
         logging.debug(" create_ubuntu: xorriso debug")
+        progress = self.start_byte_progress(_('Building ISO'), 0)
         while (retval is None):
             readx = select.select([pipe.fileno()], [], [])[0]
             if readx:
                 output = pipe.read()
                 if output.strip():
                     logging.debug(output.strip())
-                    split = output.split()
-                    if (len(split) > 4):
-                        progress = split[4]
-                        if (progress[-1:] == '%'):
-                            self.report_progress(_('Building ISO'), progress[:-1])
+                    for line in output.splitlines():
+                        written, percent = parse_xorriso_progress(line)
+                        if written is not None and percent:
+                            progress.set(written, int(written * 100 / percent))
+                        elif percent is not None:
+                            progress.set_fraction(percent / 100)
             retval = seg1.poll()
+        if retval == 0:
+            progress.finish()
+        self.progress_emitter.flush(self._job_key())
         if retval is not 0:
             logging.error(" create_ubuntu: xorriso exited with a nonstandard return value.")
             logging.error("  cmd: %s" % xorrisoargs)
@@ -1052,8 +1675,24 @@ arch %s, distributor_str %s" % (bto_version, distributor, release, arch, distrib
         return True
 
     @dbus.service.signal(DBUS_INTERFACE_NAME)
-    def report_progress(self, this, that=''):
+    def report_progress(self, this, that='', rate=0.0, eta=-1.0):
         '''Report progress of something to UI.
+           rate is the throughput in bytes/s and eta the seconds left, when
+           they are known.
+        '''
+        return True
+
+    @dbus.service.signal(DBUS_INTERFACE_NAME)
+    def report_job_progress(self, job, this, that='', rate=0.0, eta=-1.0):
+        '''Report progress of a job from submit_build, otherwise the same
+           as report_progress.
+        '''
+        return True
+
+    @dbus.service.signal(DBUS_INTERFACE_NAME)
+    def report_job_state(self, job, state, error):
+        '''Report a job from submit_build being queued, running, done,
+           failed or cancelled.  error says why it failed.
         '''
         return True
 
@@ -278,7 +278,7 @@ partition layout.")
         self.widgets.get_object('version').set_text(version)
         return True
 
-    def update_progress_gui(self, progress_text, progress):
+    def update_progress_gui(self, progress_text, progress, rate=0, eta=-1):
         """Updates the progressbar to show what we are working on"""
         
         progressbar = self.widgets.get_object('progressbar')
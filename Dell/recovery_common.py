@@ -36,7 +36,10 @@ import glob
 import sys
 import datetime
 import logging
-import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from Dell.recovery_io import COPY_WORKERS, HASH_WORKERS, TreeManifest, hash_file
 
 ##                ##
 ##Common Variables##
@@ -49,6 +52,11 @@ DBUS_INTERFACE_NAME = 'com.dell.RecoveryMedia'
 CDROM_MOUNT = '/cdrom'
 ISO_MOUNT = '/isodevice'
 
+#checksum manifests written on the media for each digest algorithm
+MEDIA_MANIFESTS = {'md5': 'md5sum.txt', 'sha1': 'SHA1SUMS',
+                   'sha256': 'SHA256SUMS', 'sha512': 'SHA512SUMS'}
+JSON_MANIFEST = 'manifest.json'
+
 #Translation Support
 DOMAIN = 'dell-recovery'
 LOCALEDIR = '/usr/share/locale'
@@ -78,65 +86,38 @@ RP_LABELS = [ 'dualrcvy', 'recovery', 'install', 'os' ]
 ##Common Functions##
 ##                ##
 
-def black_tree(action, blacklist, src, dst='', base=None):
+def black_tree(action, blacklist, src, dst='', base=None, workers=COPY_WORKERS,
+               streaming=False, journal=None):
     """Recursively ACTIONs files from src to dest only
        when they don't match the blacklist outlined in blacklist"""
-    return _tree(action, blacklist, src, dst, base, False)
+    return _tree(action, blacklist, src, dst, base, False, workers, streaming,
+                 journal)
 
-def white_tree(action, whitelist, src, dst='', base=None):
+def white_tree(action, whitelist, src, dst='', base=None, workers=COPY_WORKERS,
+               streaming=False, journal=None):
     """Recursively ACTIONs files from src to dest only
        when they match the whitelist outlined in whitelist"""
-    return _tree(action, whitelist, src, dst, base, True)
-
-def _tree(action, list, src, dst, base, white):
-    """Helper function for tree calls"""
-    from distutils.file_util import copy_file
-
-    if base is None:
-        base = src
-        if not base.endswith('/'):
-            base += '/'
-
-    names = os.listdir(src)
-
-    if action == "copy":
-        outputs = []
+    return _tree(action, whitelist, src, dst, base, True, workers, streaming,
+                 journal)
+
+def _tree(action, list, src, dst, base, white, workers=COPY_WORKERS,
+          streaming=False, journal=None):
+    """Helper function for tree calls.
+       action is one of:
+       * size: returns the number of bytes that would be copied
+       * copy: copies the files, returns the list of outputs
+       * scan: returns the TreeManifest so that both of the above can be
+               done from a single walk of src
+       streaming copies keep the page cache from filling up with the copy,
+       a CopyJournal lets an interrupted copy be resumed"""
+    manifest = TreeManifest(src, list, white, base)
+
+    if action == "scan":
+        return manifest
     elif action == "size":
-        outputs = 0
-
-    for n in names:
-        src_name = os.path.join(src, n)
-        dst_name = os.path.join(dst, n)
-        end = src_name.split(base)[1]
-
-        #don't copy symlinks or hardlinks, vfat seems to hate them
-        if os.path.islink(src_name):
-            continue
-
-        #recurse till we find FILES
-        elif os.path.isdir(src_name):
-            if action == "copy":
-                outputs.extend(
-                    _tree(action, list, src_name, dst_name, base, white))
-            elif action == "size":
-                #add the directory we're in
-                outputs += os.path.getsize(src_name)
-                #add the files in that directory
-                outputs += _tree(action, list, src_name, dst_name, base, white)
-
-        #only copy the file if it matches the list / color
-        elif (white and list.search(end)) or not (white or list.search(end)):
-            if action == "copy":
-                if not os.path.isdir(dst):
-                    os.makedirs(dst)
-                copy_file(src_name, dst_name, preserve_mode=1,
-                          preserve_times=1, update=1, dry_run=0)
-                outputs.append(dst_name)
-
-            elif action == "size":
-                outputs += os.path.getsize(src_name)
-
-    return outputs
+        return manifest.size
+    elif action == "copy":
+        return manifest.copy(dst, workers, streaming, journal)
 
 def check_vendor():
     """Checks to make sure that the app is running on Dell HW"""
@@ -656,49 +637,202 @@ def dbus_sync_call_signal_wrapper(dbus_iface, func, handler_map, *args, **kwargs
     return _h_reply_result
 
 
-def regenerate_md5sum(root_dir,sec_dir=None):
+def regenerate_md5sum(root_dir,sec_dir=None,known=None,workers=HASH_WORKERS,
+                      cache=None):
     '''generate the md5sum.txt when building the ISO image.
 
     No matter whether the md5sum.txt exits or not, we will walk through the files and then build a new file.
+    See regenerate_manifests for the rest of the arguments.
     '''
-    #check and delete the previsous md5sum.txt if the root dir exists md5sum.txt file
-    if os.path.exists(os.path.join(root_dir, 'md5sum.txt')):
-        os.remove(os.path.join(root_dir, 'md5sum.txt'))
+    regenerate_manifests(root_dir, sec_dir, known, workers, cache)
+
+def regenerate_manifests(root_dir,sec_dir=None,known=None,workers=HASH_WORKERS,
+                         cache=None,algorithms=('md5',),json_manifest=False,
+                         exclude=()):
+    '''generate the checksum manifests when building the ISO image.
+
+    md5sum.txt is always written, and a file from MEDIA_MANIFESTS for every
+    other algorithm asked for, along with JSON_MANIFEST if json_manifest is set.
+    Only the manifests written at the top of the media are left out of them,
+    along with the top level files named in exclude, which the caller keeps
+    off the media.
+    All of the digests of a file are worked out in a single read of it.
+    known is an optional DigestMap of files that were hashed while being copied,
+    those are not read again.
+    Files are hashed in chunks by a pool of workers, and listed in path order.
+    cache is an optional DigestCache, files of sec_dir are looked up in it and
+    added to it so that an unchanged secondary dir is only hashed once.
+    '''
+    algorithms = ['md5'] + [name for name in algorithms if name != 'md5']
+    outputs = [MEDIA_MANIFESTS[name] for name in algorithms]
+    if json_manifest:
+        outputs.append(JSON_MANIFEST)
+
+    #check and delete the previsous manifests if the root dir has them
+    for output in outputs:
+        if os.path.exists(os.path.join(root_dir, output)):
+            os.remove(os.path.join(root_dir, output))
 
     #define the head info of md5sum.txt
     head_info = """This file contains the list of md5 checksums of all files on this medium.\n\nYou can verify them automatically with the 'integrity-check' boot parameter,\nor, manually with: 'md5sum -c md5sum.txt'.\n\n"""
-    #get the root dir file list for summing md5
-    root_list = []
     #some files don't need to check md5
     uncheck_list = ["md5sum.txt","grubenv"]
-    for root,dirs,files in os.walk(root_dir):
-        for f in files:
-            if f not in uncheck_list:
-                root_list.append(os.path.join(root,f))
-    #sum md5 then write into file function
-    def md5sum(fd,path,root):
-        file_path = '.' + path.split(root)[1]
-        md5 = hashlib.md5(open(path,'rb').read()).hexdigest()
-        content = md5+"  "+file_path+"\n"
-        fd.write(content)
-
-    with open(os.path.join(root_dir, 'md5sum.txt'),'w') as wfd:
-        wfd.write(head_info)
+    uncheck_top = set('./' + name for name in outputs)
+    uncheck_top.update('./' + name for name in exclude)
+    #relative path -> full path, files in root_dir win over the secondary dir
+    file_list = {}
+    for top in (sec_dir, root_dir):
+        if not top:
+            continue
+        for root,dirs,files in os.walk(top):
+            for f in files:
+                if f not in uncheck_list:
+                    full_path = os.path.join(root,f)
+                    file_path = './' + os.path.relpath(full_path, top)
+                    if file_path not in uncheck_top:
+                        file_list[file_path] = full_path
+
+    #sum every digest of one file in one pass
+    def checksum(path):
+        digests = None
+        if known is not None:
+            digests = known.lookup(path, algorithms)
+        if digests is None:
+            if cache is not None and sec_dir and \
+               not path.startswith(os.path.join(root_dir, '')):
+                digests = cache.hash_file(path, algorithms)
+            else:
+                digests = hash_file(path, algorithms)
+        return digests
+
+    order = sorted(file_list)
+    entries = []
+    wfds = [open(os.path.join(root_dir, MEDIA_MANIFESTS[name]), 'w')
+            for name in algorithms]
+    try:
+        wfds[0].write(head_info)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            sums = pool.map(checksum, [file_list[item] for item in order])
+            for file_path, digests in zip(order, sums):
+                for name, wfd in zip(algorithms, wfds):
+                    wfd.write(digests[name]+"  "+file_path+"\n")
+                if json_manifest:
+                    entry = {'path': file_path,
+                             'size': os.path.getsize(file_list[file_path])}
+                    for name in algorithms:
+                        entry[name] = digests[name]
+                    entries.append(entry)
+        if json_manifest:
+            with open(os.path.join(root_dir, JSON_MANIFEST), 'w') as wfd:
+                json.dump({'algorithms': algorithms, 'files': entries}, wfd,
+                          indent=1, sort_keys=True)
+    except Exception as err:
+        import syslog
+        syslog.syslog("rewrite the checksum manifests failed with : %s" %(err))
+    finally:
+        for wfd in wfds:
+            wfd.close()
+
+def read_manifest(path):
+    '''Reads a checksum manifest in the format of md5sum.txt or SHA256SUMS.
+
+    Lines that don't carry a checksum, like the md5sum.txt header, are skipped.
+    Returns a list of (checksum, relative path) tuples.
+    '''
+    entries = []
+    with open(path, 'r') as rfd:
+        for line in rfd:
+            line = line.rstrip('\n')
+            if '  ' not in line:
+                continue
+            checksum, file_path = line.split('  ', 1)
+            if checksum and all(c in '0123456789abcdef' for c in checksum.lower()):
+                entries.append((checksum.lower(), file_path))
+    return entries
+
+def verify_manifest(root_dir, manifest='md5sum.txt', workers=HASH_WORKERS,
+                    progress=None):
+    '''Checks the files of root_dir against one of its checksum manifests.
+
+    Files are hashed in chunks by a pool of workers.  progress is an optional
+    ByteProgress, it is reset to the number of bytes listed and fed every chunk.
+    Returns a list of (relative path, expected, actual) tuples for every file
+    that doesn't match, where actual is empty if the file couldn't be read.
+    Entries that lead out of root_dir, through '..' or symlinks, are never
+    opened and are reported as not matching.
+    '''
+    algorithm = 'md5'
+    for name, output in MEDIA_MANIFESTS.items():
+        if output == manifest:
+            algorithm = name
+    entries = read_manifest(os.path.join(root_dir, manifest))
+    top = os.path.realpath(root_dir)
+
+    def resolve(file_path):
+        '''Where a listed file really is, None if that's outside root_dir'''
+        path = os.path.realpath(os.path.join(top, file_path))
+        if os.path.commonpath([top, path]) != top:
+            return None
+        return path
+
+    def size(entry):
+        '''The size of a listed file, if it is there'''
+        path = resolve(entry[1])
+        if path is None:
+            return 0
         try:
-            #write the md5 of root file list
-            for full_path in root_list:
-                md5sum(wfd,full_path,root_dir)
-            #check the secondary dir or not for building ISO image by dell recovery
-            if sec_dir:
-                for root,dirs,files in os.walk(sec_dir):
-                    for f in files:
-                        if f not in uncheck_list:
-                            full_path = os.path.join(root,f)
-                            if root_dir + full_path.split(sec_dir)[1] not in root_list:
-                                md5sum(wfd,full_path,sec_dir)
-        except Exception as err:
-            import syslog
-            syslog.syslog("rewrite the md5sum.txt file failed with : %s" %(err))
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    counter = None
+    if progress is not None:
+        progress.reset_write(sum(size(entry) for entry in entries))
+        counter = progress.add
+
+    def check(entry):
+        '''Hashes a listed file, returns the mismatch if there is one'''
+        expected, file_path = entry
+        path = resolve(file_path)
+        try:
+            if path is None:
+                actual = ''
+            else:
+                actual = hash_file(path, (algorithm,), counter)[algorithm]
+        except (IOError, OSError):
+            actual = ''
+        if actual != expected:
+            return (os.path.normpath(file_path), expected, actual)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        results = pool.map(check, entries)
+        return [result for result in results if result is not None]
+
+def parse_xorriso_progress(line):
+    '''Picks the progress out of a line of xorriso output.
+
+    xorriso reports either "Writing: <sectors>s <percent>%" or, when emulating
+    mkisofs, just "<percent>% done".  Returns the number of bytes written and
+    the percentage, either of which is None when the line doesn't carry it.
+    '''
+    written = None
+    percent = None
+    split = line.split()
+    for index, word in enumerate(split):
+        if word == 'Writing:' and index + 1 < len(split) and \
+           split[index + 1].endswith('s'):
+            try:
+                written = int(split[index + 1][:-1]) * 2048
+            except ValueError:
+                pass
+        elif word.endswith('%') and percent is None and \
+             (index == 0 or split[index - 1] not in ('fifo', 'buf')):
+            try:
+                percent = float(word[:-1])
+            except ValueError:
+                pass
+    return (written, percent)
 
 ##                ##
 ## Common Classes ##
@@ -712,6 +846,14 @@ class CreateFailed(dbus.DBusException):
     """Exception Raised if the media creation process failed for any reason"""
     _dbus_error_name = 'com.dell.RecoveryMedia.CreateFailedException'
 
+class VerifyFailed(dbus.DBusException):
+    """Exception Raised if media can't be verified at all"""
+    _dbus_error_name = 'com.dell.RecoveryMedia.VerifyFailedException'
+
+class UnknownJob(dbus.DBusException):
+    """Exception Raised if a job id isn't known"""
+    _dbus_error_name = 'com.dell.RecoveryMedia.UnknownJobException'
+
 class PermissionDeniedByPolicy(dbus.DBusException):
     """Exception Raised if policy kit denied the user access"""
     _dbus_error_name = 'com.dell.RecoveryMedia.PermissionDeniedByPolicy'
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# «recovery_fish» - Helpers for handling FISH packages while assembling images
+#
+# Copyright (C) 2017, Dell Inc.
+#
+# Author:
+#  - Mario Limonciello <Mario_Limonciello@Dell.com>
+#
+# This is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this application; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##################################################################################
+
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from Dell.recovery_io import (CACHE_DIR, HASH_WORKERS, hash_file, link_tree,
+                              scan_tar)
+from Dell.recovery_xml import BTOxml
+
+##                ##
+##Common Variables##
+##                ##
+
+#Extracted FISH tarballs, by the md5 of the package, and how much of them
+#to keep around
+FISH_CACHE = os.path.join(CACHE_DIR, 'fish')
+FISH_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+#Written last into every cache entry, an entry without it is incomplete
+FISH_CACHE_INFO = 'info.json'
+
+#Index of FISH packages that have been looked at
+FISH_CATALOG = os.path.join(CACHE_DIR, 'fish-catalog.db')
+
+#What the catalog knows about a package.  os and description come from its
+#prepackage.dell, and are empty if it doesn't have one
+CatalogEntry = namedtuple('CatalogEntry', 'path size mtime_ns md5 os '
+                                          'description members prepackage')
+
+##                ##
+## Common Classes ##
+##                ##
+
+class FishCache:
+    """Content addressed cache of extracted FISH tarballs.
+       Every package lives in a directory named after its md5 holding the
+       extracted tree and the list of member names.  Trees are handed out
+       with link_tree so a hit costs no decompression, and the least recently
+       used entries are dropped once they add up to more than limit bytes"""
+    def __init__(self, path=FISH_CACHE, limit=FISH_CACHE_SIZE):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+
+    def _entry(self, md5):
+        """Directory of the cache entry for a package"""
+        return os.path.join(self.path, md5)
+
+    def _info(self, md5):
+        """Reads the info of a complete cache entry, or returns None"""
+        try:
+            with open(os.path.join(self._entry(md5), FISH_CACHE_INFO)) as rfd:
+                return json.load(rfd)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def fetch(self, md5, destination):
+        """Recreates the extracted tree of the package with this md5 in
+           destination.
+           Returns the info of the package ({'names': [...], 'size': n}), or
+           None if it isn't cached"""
+        with self._lock:
+            info = self._info(md5)
+            if info is None:
+                return None
+            link_tree(os.path.join(self._entry(md5), 'tree'), destination)
+            #the info file's mtime is when the entry was last used
+            os.utime(os.path.join(self._entry(md5), FISH_CACHE_INFO), None)
+        return info
+
+    def store(self, md5, source, names):
+        """Adds the extracted tree source of the package with this md5.
+           Only safely extracted packages belong here, names is their list
+           of members"""
+        size = 0
+        for root, dirs, files in os.walk(source):
+            for name in files:
+                if not os.path.islink(os.path.join(root, name)):
+                    size += os.path.getsize(os.path.join(root, name))
+        if size > self.limit:
+            return
+        with self._lock:
+            if self._info(md5) is not None:
+                return
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            staging = tempfile.mkdtemp(dir=self.path, prefix='.new-')
+            try:
+                link_tree(source, os.path.join(staging, 'tree'))
+                with open(os.path.join(staging, FISH_CACHE_INFO), 'w') as wfd:
+                    json.dump({'names': names, 'size': size}, wfd)
+                if os.path.isdir(self._entry(md5)):
+                    shutil.rmtree(self._entry(md5))
+                os.rename(staging, self._entry(md5))
+            except (IOError, OSError):
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+            self._evict()
+
+    def _evict(self):
+        """Drops the least recently used entries until the cache fits in its
+           limit, must hold the lock"""
+        entries = []
+        total = 0
+        for md5 in os.listdir(self.path):
+            info_path = os.path.join(self._entry(md5), FISH_CACHE_INFO)
+            info = self._info(md5)
+            if info is None:
+                #left behind by an interrupted store
+                shutil.rmtree(self._entry(md5), ignore_errors=True)
+                continue
+            entries.append((os.stat(info_path).st_mtime, md5, info['size']))
+            total += info['size']
+        for used, md5, size in sorted(entries):
+            if total <= self.limit:
+                break
+            shutil.rmtree(self._entry(md5), ignore_errors=True)
+            total -= size
+
+class FishCatalog:
+    """sqlite index of FISH packages: size, mtime, md5, what prepackage.dell
+       says about them and the list of members.
+       Packages are only read when they are new or have changed since they
+       were last indexed, after that everything is a lookup"""
+    def __init__(self, path=FISH_CATALOG):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        """Opens the database on first use, must hold the lock"""
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS packages ('
+                             'path TEXT PRIMARY KEY, size INTEGER, '
+                             'mtime_ns INTEGER, md5 TEXT, os TEXT, '
+                             'description TEXT, members TEXT, '
+                             'prepackage INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS packages_md5 '
+                             'ON packages (md5)')
+            self._db.commit()
+        return self._db
+
+    def close(self):
+        """Closes the database"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def _entry(row):
+        """Turns a database row into a CatalogEntry"""
+        return CatalogEntry(row[0], row[1], row[2], row[3], row[4],
+                            json.loads(row[5]), json.loads(row[6]),
+                            bool(row[7]))
+
+    @staticmethod
+    def _scan(path, path_stat):
+        """Reads a package in a single pass, returns its CatalogEntry"""
+        os_version = ''
+        description = []
+        members = []
+        prepackage = None
+        try:
+            is_tar = tarfile.is_tarfile(path)
+        except (IOError, OSError):
+            is_tar = False
+        if is_tar:
+            digests, members, contents = scan_tar(path, ('md5',),
+                                lambda name: name.endswith('prepackage.dell'))
+            for name in members:
+                if name in contents:
+                    prepackage = contents[name]
+                    break
+        else:
+            digests = hash_file(path, ('md5',))
+        if prepackage:
+            xml_obj = BTOxml()
+            xml_obj.load_bto_xml(prepackage)
+            os_version = xml_obj.fetch_node_contents('os')
+            description = xml_obj.fetch_node_contents('driver')
+            if not isinstance(description, list):
+                description = [description]
+        return CatalogEntry(path, path_stat.st_size, path_stat.st_mtime_ns,
+                            digests['md5'], os_version, description, members,
+                            bool(prepackage))
+
+    def lookup(self, path):
+        """Returns the CatalogEntry of path if it is indexed and hasn't
+           changed since, otherwise None"""
+        path = os.path.abspath(path)
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._connect().execute('SELECT * FROM packages WHERE path = ?',
+                                          (path,)).fetchone()
+        if row is None or row[1] != path_stat.st_size or \
+           row[2] != path_stat.st_mtime_ns:
+            return None
+        return self._entry(row)
+
+    def update(self, path):
+        """Returns the CatalogEntry of path, (re)indexing it if needed"""
+        entry = self.lookup(path)
+        if entry is not None:
+            return entry
+        path = os.path.abspath(path)
+        entry = self._scan(path, os.stat(path))
+        with self._lock:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (entry.path, entry.size, entry.mtime_ns, entry.md5,
+                        entry.os, json.dumps(entry.description),
+                        json.dumps(entry.members), int(entry.prepackage)))
+            db.commit()
+        return entry
+
+    def index(self, directory, workers=HASH_WORKERS):
+        """Brings the catalog up to date with a library directory: new and
+           changed files are read, files that are gone are dropped.
+           Returns the CatalogEntry of every file, sorted by path.  Files
+           that can't be read get an empty entry and are left out of the
+           catalog, the rest of the library is still indexed"""
+        directory = os.path.abspath(directory)
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                paths.append(os.path.join(root, name))
+        unreadable = set()
+        def read(path):
+            try:
+                return self.update(path)
+            except (IOError, OSError, tarfile.TarError, EOFError):
+                unreadable.add(path)
+                return CatalogEntry(path, 0, 0, '', '', [], [], False)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            entries = list(pool.map(read, sorted(paths)))
+        with self._lock:
+            db = self._connect()
+            known = [row[0] for row in
+                     db.execute('SELECT path FROM packages WHERE path LIKE ?',
+                                (os.path.join(directory, '%'),))]
+            found = set(paths) - unreadable
+            for path in known:
+                if path.startswith(os.path.join(directory, '')) and \
+                   path not in found:
+                    db.execute('DELETE FROM packages WHERE path = ?', (path,))
+            db.commit()
+        return entries
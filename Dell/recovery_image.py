@@ -0,0 +1,675 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# «recovery_image» - Reads the contents of ISO images without mounting them
+#
+# Copyright (C) 2017, Dell Inc.
+#
+# Author:
+#  - Mario Limonciello <Mario_Limonciello@Dell.com>
+#
+# This is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this application; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##################################################################################
+
+import json
+import lzma
+import mmap
+import os
+import stat
+import struct
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+
+from Dell.recovery_io import CACHE_DIR
+
+##                ##
+##Common Variables##
+##                ##
+
+#Volume descriptors start at sector 16 and are always 2048 bytes
+ISO_SECTOR = 2048
+ISO_DESCRIPTORS = 16
+ISO_MAGIC = b'CD001'
+
+#Escape sequences of a supplementary volume descriptor that make it Joliet
+JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+
+#Directory record flags
+ISO_FLAG_DIRECTORY = 0x02
+ISO_FLAG_MULTI_EXTENT = 0x80
+
+#How much of a file is handed out at a time when streaming it
+ISO_STREAM_CHUNK = 1024 * 1024
+
+#newc cpio headers, and what starts each kind of compressed initrd segment
+CPIO_MAGICS = (b'070701', b'070702')
+CPIO_HEADER = 110
+CPIO_TRAILER = 'TRAILER!!!'
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+LZMA_MAGIC = b'\x5d\x00\x00'
+
+#What was learned about images on earlier probes, and how many to remember
+IMAGE_CACHE = os.path.join(CACHE_DIR, 'images.json')
+IMAGE_CACHE_ENTRIES = 256
+
+#A file or directory on the image.  extents is a tuple of (offset, length)
+#pairs in bytes, more than one only for files split across extents
+IsoEntry = namedtuple('IsoEntry', 'name size is_dir extents')
+
+##                ##
+## Common Classes ##
+##                ##
+
+class ImageError(Exception):
+    """Raised when an image isn't a readable ISO9660 filesystem"""
+    pass
+
+class IsoImage:
+    """Read only view of an ISO9660 image.
+       The image is mapped once and directories are only parsed the first
+       time something below them is looked up, so finding a single file
+       touches just the sectors on its path.  Names come from the Joliet tree
+       when there is one, like isoinfo -J, otherwise from Rock Ridge or the
+       plain ISO9660 names"""
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error) as err:
+            os.close(self._fd)
+            raise ImageError("Unable to map %s: %s" % (path, err))
+        self._directories = {}
+        self.volume_id = ''
+        try:
+            self._root = self._read_descriptors()
+        except (struct.error, IndexError, ValueError):
+            self.close()
+            raise ImageError("%s has a damaged volume descriptor" % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the mapping of the image"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
+
+    def _read_descriptors(self):
+        """Picks the directory tree to read names from"""
+        primary = None
+        joliet = None
+        sector = ISO_DESCRIPTORS
+        while (sector + 1) * ISO_SECTOR <= len(self._map):
+            offset = sector * ISO_SECTOR
+            if self._map[offset + 1:offset + 6] != ISO_MAGIC:
+                break
+            kind = self._map[offset]
+            if kind == 255:
+                break
+            if kind == 1 and primary is None:
+                primary = offset
+            elif kind == 2 and joliet is None and \
+                    self._map[offset + 88:offset + 91] in JOLIET_ESCAPES:
+                joliet = offset
+            sector += 1
+        if primary is None:
+            raise ImageError("%s is not an ISO9660 image" % self.path)
+
+        self.block_size = struct.unpack_from('<H', self._map, primary + 128)[0]
+        self.volume_id = self._map[primary + 40:primary + 72].decode(
+                                                'ascii', 'replace').strip()
+        self.joliet = joliet is not None
+        self.rock_ridge = False
+        if self.joliet:
+            root = self._record(joliet + 156)
+        else:
+            root = self._record(primary + 156)
+            #Rock Ridge announces itself with SUSP entries on the root's '.'
+            first = self._records(root.extents[0][0], root.size)
+            for record_offset in first:
+                self.rock_ridge = self._system_use(record_offset)[1]
+                break
+        return root
+
+    def _record(self, offset):
+        """Returns the entry for the directory record at offset"""
+        extent, size = struct.unpack_from('<I4xI', self._map, offset + 2)
+        flags = self._map[offset + 25]
+        return IsoEntry('', size, bool(flags & ISO_FLAG_DIRECTORY),
+                        ((extent * self.block_size, size),))
+
+    def _records(self, start, size):
+        """Yields the offsets of the records of a directory, skipping the
+           padding at the end of every sector"""
+        offset = start
+        end = start + size
+        while offset < end:
+            length = self._map[offset]
+            if not length:
+                offset = (offset // self.block_size + 1) * self.block_size
+                continue
+            yield offset
+            offset += length
+
+    def _system_use(self, offset):
+        """Returns the Rock Ridge name of a record, or None, and whether
+           the record has Rock Ridge entries at all"""
+        length = self._map[offset]
+        name_len = self._map[offset + 32]
+        area = offset + 33 + name_len + (1 - name_len % 2)
+        end = offset + length
+        name = None
+        found = False
+        #continuation areas that were followed, a chain that comes back
+        #around to one of them is corrupt
+        visited = set()
+        while area + 4 <= end:
+            signature = self._map[area:area + 2]
+            entry_len = self._map[area + 2]
+            if entry_len < 4:
+                break
+            if signature in (b'SP', b'RR', b'PX', b'NM'):
+                found = True
+            if signature == b'NM':
+                flags = self._map[area + 4]
+                if not flags & 0x06:
+                    piece = self._map[area + 5:area + entry_len]
+                    name = (name or b'') + piece
+            elif signature == b'CE':
+                block, ce_offset, ce_len = struct.unpack_from('<I4xI4xI',
+                                                              self._map,
+                                                              area + 4)
+                if (block, ce_offset) in visited:
+                    break
+                visited.add((block, ce_offset))
+                area = block * self.block_size + ce_offset
+                end = min(area + ce_len, len(self._map))
+                continue
+            elif signature == b'ST':
+                break
+            area += entry_len
+        if name is not None:
+            name = name.decode('utf-8', 'replace')
+        return name, found
+
+    def _name(self, offset):
+        """Decodes the name of the record at offset"""
+        name_len = self._map[offset + 32]
+        raw = self._map[offset + 33:offset + 33 + name_len]
+        if self.joliet:
+            name = raw.decode('utf-16-be', 'replace')
+        else:
+            name = None
+            if self.rock_ridge:
+                name = self._system_use(offset)[0]
+            if name is None:
+                name = raw.decode('ascii', 'replace')
+                name = name.split(';')[0]
+                if name.endswith('.'):
+                    name = name[:-1]
+        if self.joliet:
+            name = name.split(';')[0]
+        return name
+
+    def _directory(self, entry):
+        """Returns the name to entry mapping of a directory.  Directories
+           are only read when they are first looked at, so damage to one is
+           reported as an ImageError then"""
+        start = entry.extents[0][0]
+        if start in self._directories:
+            return self._directories[start]
+        if start + entry.size > len(self._map):
+            raise ImageError("%s is truncated" % self.path)
+        try:
+            contents = self._read_directory(start, entry.size)
+        except (struct.error, IndexError, ValueError):
+            raise ImageError("%s has a damaged directory" % self.path)
+        self._directories[start] = contents
+        return contents
+
+    def _read_directory(self, start, size):
+        """Reads the records of a directory into a name to entry mapping"""
+        contents = {}
+        pending = None
+        for offset in self._records(start, size):
+            name_len = self._map[offset + 32]
+            if name_len == 1 and self._map[offset + 33] in (0, 1):
+                continue
+            record = self._record(offset)
+            flags = self._map[offset + 25]
+            if pending is not None:
+                extents = pending.extents + record.extents
+                record = IsoEntry(pending.name, pending.size + record.size,
+                                  False, extents)
+            else:
+                record = record._replace(name=self._name(offset))
+            if flags & ISO_FLAG_MULTI_EXTENT:
+                pending = record
+                continue
+            pending = None
+            contents[record.name] = record
+        return contents
+
+    def _lookup(self, path):
+        """Finds the entry at path, or returns None"""
+        entry = self._root
+        for piece in path.strip('/').split('/'):
+            if not piece:
+                continue
+            if not entry.is_dir:
+                return None
+            contents = self._directory(entry)
+            found = contents.get(piece)
+            if found is None and not (self.joliet or self.rock_ridge):
+                #plain ISO9660 names are upper case only
+                found = contents.get(piece.upper())
+            if found is None:
+                return None
+            entry = found
+        return entry
+
+    def stat(self, path):
+        """Returns the IsoEntry at path, or None if it doesn't exist"""
+        return self._lookup(path)
+
+    def exists(self, path):
+        """Checks whether path is on the image"""
+        return self._lookup(path) is not None
+
+    def isdir(self, path):
+        """Checks whether path is a directory on the image"""
+        entry = self._lookup(path)
+        return entry is not None and entry.is_dir
+
+    def listdir(self, path='/'):
+        """Lists the names in a directory of the image"""
+        entry = self._lookup(path)
+        if entry is None or not entry.is_dir:
+            raise ImageError("%s is not a directory in %s" % (path, self.path))
+        return sorted(self._directory(entry))
+
+    def walk(self, path='/'):
+        """Yields the full path of everything below path, directories
+           before their contents, like isoinfo -f"""
+        entry = self._lookup(path)
+        if entry is None or not entry.is_dir:
+            return
+        stack = [(path.rstrip('/'), entry, None)]
+        while stack:
+            parent, entry, names = stack[-1]
+            if names is None:
+                names = iter(sorted(self._directory(entry)))
+                stack[-1] = (parent, entry, names)
+            name = next(names, None)
+            if name is None:
+                stack.pop()
+                continue
+            child = self._directory(entry)[name]
+            full = parent + '/' + name
+            yield full
+            if child.is_dir:
+                stack.append((full, child, None))
+
+    def stream(self, path, chunk=ISO_STREAM_CHUNK):
+        """Yields the contents of a file in memoryviews of up to chunk
+           bytes, straight from the mapping"""
+        entry = self._lookup(path)
+        if entry is None or entry.is_dir:
+            raise ImageError("%s is not a file in %s" % (path, self.path))
+        view = memoryview(self._map)
+        try:
+            for start, length in entry.extents:
+                if start + length > len(self._map):
+                    raise ImageError("%s is truncated" % self.path)
+                for offset in range(start, start + length, chunk):
+                    yield view[offset:min(offset + chunk, start + length)]
+        finally:
+            view.release()
+
+    def read(self, path):
+        """Returns the contents of a file, or None if it doesn't exist"""
+        entry = self._lookup(path)
+        if entry is None or entry.is_dir:
+            return None
+        return b''.join(bytes(piece) for piece in self.stream(path))
+
+class DirectoryImage:
+    """The same read only view as IsoImage over an image that is already
+       unpacked or mounted somewhere, so probes work the same on both"""
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Nothing to release, the mount belongs to whoever made it"""
+        pass
+
+    def _local(self, path):
+        """Where path of the image is on the filesystem"""
+        return os.path.join(self.path, path.lstrip('/'))
+
+    def exists(self, path):
+        """Checks whether path is in the image"""
+        return os.path.exists(self._local(path))
+
+    def isdir(self, path):
+        """Checks whether path is a directory in the image"""
+        return os.path.isdir(self._local(path))
+
+    def listdir(self, path='/'):
+        """Lists the names in a directory of the image"""
+        try:
+            return sorted(os.listdir(self._local(path)))
+        except OSError:
+            raise ImageError("%s is not a directory in %s" % (path, self.path))
+
+    def walk(self, path='/'):
+        """Yields the full path of everything below path, directories
+           before their contents"""
+        top = self._local(path)
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            parent = os.path.relpath(root, self.path)
+            parent = '' if parent == '.' else '/' + parent
+            for name in sorted(dirs + files):
+                yield parent + '/' + name
+
+    def stream(self, path, chunk=ISO_STREAM_CHUNK):
+        """Yields the contents of a file in pieces of up to chunk bytes"""
+        local = self._local(path)
+        if not os.path.isfile(local):
+            raise ImageError("%s is not a file in %s" % (path, self.path))
+        with open(local, 'rb') as rfd:
+            for piece in iter(lambda: rfd.read(chunk), b''):
+                yield piece
+
+    def read(self, path):
+        """Returns the contents of a file, or None if it doesn't exist"""
+        local = self._local(path)
+        if not os.path.isfile(local):
+            return None
+        with open(local, 'rb') as rfd:
+            return rfd.read()
+
+class _ChunkReader:
+    """Reads bytes from an iterator of chunks, with room to push data back
+       once it turns out to belong to something else"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def _more(self):
+        """Returns the next piece of data, or b'' at the end"""
+        for chunk in self._chunks:
+            if chunk:
+                return bytes(chunk)
+        return b''
+
+    def chunk(self):
+        """Returns whatever is available next, or b'' at the end"""
+        if self._pending:
+            data, self._pending = self._pending, b''
+            return data
+        return self._more()
+
+    def unread(self, data):
+        """Puts data back in front of what hasn't been read yet"""
+        if data:
+            self._pending = data + self._pending
+
+    def read(self, size):
+        """Returns the next size bytes, fewer only at the end"""
+        pieces = [self._pending]
+        have = len(self._pending)
+        while have < size:
+            data = self._more()
+            if not data:
+                break
+            pieces.append(data)
+            have += len(data)
+        data = b''.join(pieces)
+        self._pending = data[size:]
+        return data[:size]
+
+    def skip(self, size):
+        """Throws away the next size bytes, returns whether they were there"""
+        while size:
+            data = self.chunk()
+            if not data:
+                return False
+            if len(data) > size:
+                self.unread(data[size:])
+                return True
+            size -= len(data)
+        return True
+
+    def skip_padding(self):
+        """Throws away NUL padding, returns whether anything follows it"""
+        while True:
+            data = self.chunk()
+            if not data:
+                return False
+            data = data.lstrip(b'\0')
+            if data:
+                self.unread(data)
+                return True
+
+class _DecompressingReader(_ChunkReader):
+    """Reads a single compressed segment out of another reader, handing
+       back whatever follows the segment when it ends"""
+    def __init__(self, raw, decompressor):
+        _ChunkReader.__init__(self, ())
+        self._raw = raw
+        self._decompressor = decompressor
+
+    def _more(self):
+        while not self._decompressor.eof:
+            data = self._raw.chunk()
+            if not data:
+                return b''
+            data = self._decompressor.decompress(data)
+            if self._decompressor.eof:
+                self._raw.unread(self._decompressor.unused_data)
+            if data:
+                return data
+        return b''
+
+def _decompressor(magic):
+    """Returns a decompressor for a segment starting with magic, or None
+       if it isn't compressed in a way that can be read"""
+    if magic.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if magic.startswith(XZ_MAGIC):
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    if magic.startswith(LZMA_MAGIC):
+        return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+    return None
+
+def _scan_cpio(reader, path):
+    """Reads newc headers up to the trailer of one archive, skipping over
+       file contents.  Returns True if path is in it, False at the trailer
+       and None if the archive is damaged or cut short"""
+    while True:
+        header = reader.read(CPIO_HEADER)
+        if len(header) < CPIO_HEADER or header[:6] not in CPIO_MAGICS:
+            return None
+        try:
+            file_size = int(header[54:62], 16)
+            name_size = int(header[94:102], 16)
+        except ValueError:
+            return None
+        name = reader.read(name_size + (-(CPIO_HEADER + name_size) % 4))
+        if len(name) < name_size:
+            return None
+        name = name[:name_size].rstrip(b'\0').decode('utf-8', 'replace')
+        if name == CPIO_TRAILER:
+            return False
+        while name.startswith('./'):
+            name = name[2:]
+        name = name.lstrip('/')
+        if name == path or name.endswith('/' + path):
+            return True
+        if not reader.skip(file_size + (-file_size % 4)):
+            return None
+
+def initrd_contains(chunks, path):
+    """Checks whether an initrd, fed in as an iterator of chunks, has a file
+       at path.  Handles uncompressed, gzip, xz and lzma segments one after
+       the other, like the early microcode archives prepended to initrds, and
+       stops reading the moment path turns up"""
+    raw = _ChunkReader(chunks)
+    reader = raw
+    path = path.lstrip('/')
+    try:
+        while True:
+            if not reader.skip_padding():
+                if reader is raw:
+                    return False
+                reader = raw
+                continue
+            magic = reader.read(len(XZ_MAGIC))
+            reader.unread(magic)
+            if magic[:6] in CPIO_MAGICS:
+                found = _scan_cpio(reader, path)
+                if found is not False:
+                    return bool(found)
+                continue
+            decompressor = _decompressor(magic)
+            if reader is not raw or decompressor is None:
+                return False
+            reader = _DecompressingReader(raw, decompressor)
+    except (lzma.LZMAError, zlib.error, EOFError):
+        return False
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def read_lines(chunks, gzipped=False):
+    """Yields the lines of a text file fed in as an iterator of chunks,
+       decompressing it on the way if it is gzipped.  Stopping early closes
+       chunks, so nothing more of the file is read"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    tail = b''
+    try:
+        for chunk in chunks:
+            data = bytes(chunk)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            lines = (tail + data).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', 'replace')
+        if tail:
+            yield tail.decode('utf-8', 'replace')
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+class ImageCache:
+    """Metadata of base images and recovery partitions probed on earlier
+       runs, kept on disk.  Entries belong to a path and are only handed
+       back while the file there still has the same (dev, inode, size,
+       mtime_ns), anything that isn't a regular file is never cached"""
+    def __init__(self, path=IMAGE_CACHE, limit=IMAGE_CACHE_ENTRIES):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = False
+        try:
+            with open(self.path) as rfd:
+                for image, identity, info in json.load(rfd):
+                    self._entries[image] = (tuple(identity), info)
+        except (IOError, OSError, ValueError, TypeError):
+            self._entries.clear()
+
+    @staticmethod
+    def _identity(path):
+        """The key of an image as it is now, or None if it can't be cached"""
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(path_stat.st_mode):
+            return None
+        return (path_stat.st_dev, path_stat.st_ino, path_stat.st_size,
+                path_stat.st_mtime_ns)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, path, fields):
+        """Returns what is known about path, or None unless all of fields
+           are known for the image as it is now"""
+        identity = self._identity(path)
+        if identity is None:
+            return None
+        image = os.path.realpath(path)
+        with self._lock:
+            entry = self._entries.get(image)
+            if entry is None or entry[0] != identity:
+                return None
+            for name in fields:
+                if name not in entry[1]:
+                    return None
+            self._entries.move_to_end(image)
+            return dict(entry[1])
+
+    def add(self, path, info):
+        """Remembers info about path, merged with what is already known
+           about the same image"""
+        identity = self._identity(path)
+        if identity is None:
+            return
+        image = os.path.realpath(path)
+        with self._lock:
+            known_identity, known = self._entries.pop(image, (None, {}))
+            if known_identity != identity:
+                known = {}
+            known.update(info)
+            self._entries[image] = (identity, known)
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        """Writes the cache back out if it changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[image, list(identity), info]
+                       for image, (identity, info) in self._entries.items()]
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        #one per thread, jobs can be saving at the same time
+        tmp = '%s.%d.new' % (self.path, threading.get_ident())
+        with open(tmp, 'w') as wfd:
+            json.dump(entries, wfd)
+        os.rename(tmp, self.path)
@@ -0,0 +1,895 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# «recovery_io» - File copying helpers used while assembling recovery media
+#
+# Copyright (C) 2017, Dell Inc.
+#
+# Author:
+#  - Mario Limonciello <Mario_Limonciello@Dell.com>
+#
+# This is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this application; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##################################################################################
+
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import tarfile
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+##                ##
+##Common Variables##
+##                ##
+
+#Number of files copied at the same time by the tree copy engine
+COPY_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+#Number of files hashed at the same time, hashlib drops the GIL so this is
+#bounded by cores rather than by the disk
+HASH_WORKERS = os.cpu_count() or 1
+
+#Largest piece of a file moved by a single copy call
+COPY_CHUNK = 8 * 1024 * 1024
+
+#How far ahead of the copy cursor sources are read in streaming mode, and how
+#much written data is allowed to pile up before it is flushed and dropped
+STREAM_WINDOW = 32 * 1024 * 1024
+
+#Name of the journal kept in the root of a destination while it is filled
+COPY_JOURNAL = '.dell-recovery-copy.journal'
+
+#A journal only records files once they are known to be on disk, which takes
+#a sync; do that at most every this many bytes or files
+JOURNAL_SYNC_BYTES = 256 * 1024 * 1024
+JOURNAL_SYNC_FILES = 2000
+
+#Where things worth keeping between runs of the backend live
+CACHE_DIR = '/var/cache/dell-recovery'
+
+#Digests of files that were hashed before, and how many of them to keep
+DIGEST_CACHE = os.path.join(CACHE_DIR, 'digests.json')
+DIGEST_CACHE_ENTRIES = 200000
+
+#sync_file_range(2) flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+#Errors that mean the kernel can't do an in kernel copy between these files
+_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                    errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+#python doesn't wrap sync_file_range, go straight to libc for it
+try:
+    import ctypes
+    import ctypes.util
+    _sync_file_range = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True).sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64, ctypes.c_uint]
+except (ImportError, OSError, AttributeError):
+    _sync_file_range = None
+
+#ioctl asking btrfs/xfs to share the extents of one file with another
+_FICLONE = 0x40049409
+
+#Scratch buffers for copies that have to go through userspace
+_buffers = threading.local()
+
+##                ##
+##Common Functions##
+##                ##
+
+def _pattern_ops(parsed):
+    """Yields every opcode of a parsed regex, descending into groups,
+       branches and repeats"""
+    for op, av in parsed:
+        yield op, av
+        pending = [av]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                for child in _pattern_ops(item):
+                    yield child
+            elif isinstance(item, (tuple, list)):
+                pending.extend(item)
+
+def _prefix_stable(pattern):
+    """Checks if a regex can only ever look at the characters it consumes.
+       For such a regex a match found on a directory's path is also found on
+       the path of every file below that directory"""
+    if not isinstance(pattern.pattern, str):
+        return False
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return False
+    for op, av in _pattern_ops(parsed):
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return False
+        if op == sre_constants.AT and av not in (sre_constants.AT_BEGINNING,
+                                                 sre_constants.AT_BEGINNING_STRING):
+            return False
+    return True
+
+def _fadvise(fd, offset, length, advice):
+    """posix_fadvise that never fails, the advice is only a hint"""
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (OSError, AttributeError):
+        pass
+
+def _sync_range(fd, offset, length, flags):
+    """Starts and/or waits on writeback of part of a file"""
+    if _sync_file_range is not None:
+        if _sync_file_range(fd, offset, length, flags) == 0:
+            return
+    if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+
+def _copy_range(infd, outfd, offset):
+    """Copies a chunk without leaving the kernel"""
+    return os.copy_file_range(infd, outfd, COPY_CHUNK, offset, offset)
+
+def _copy_sendfile(infd, outfd, offset):
+    """Copies a chunk through the kernel page cache"""
+    os.lseek(outfd, offset, os.SEEK_SET)
+    return os.sendfile(outfd, infd, offset, COPY_CHUNK)
+
+def _buffer():
+    """Returns the scratch buffer of the calling thread"""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = bytearray(COPY_CHUNK)
+    return buf
+
+def _copy_buffer(infd, outfd, offset, hashers=None):
+    """Copies a chunk through a per thread userspace buffer, feeding it
+       to any hashers on the way"""
+    buf = _buffer()
+    os.lseek(infd, offset, os.SEEK_SET)
+    count = os.readv(infd, [buf])
+    os.lseek(outfd, offset, os.SEEK_SET)
+    view = memoryview(buf)[:count]
+    if hashers:
+        for hasher in hashers.values():
+            hasher.update(view)
+    while view:
+        view = view[os.write(outfd, view):]
+    return count
+
+def _copy_data(infd, outfd, streaming=False, hashers=None, counter=None):
+    """Moves the contents of infd into outfd, preferring copy_file_range,
+       then sendfile and finally a plain read/write loop.
+       Data that needs hashing always goes through the read/write loop so it
+       is only read once.
+       counter is called with the size of every chunk as it lands.
+       Returns the number of bytes copied"""
+    if hashers:
+        methods = [functools.partial(_copy_buffer, hashers=hashers)]
+    else:
+        methods = [_copy_sendfile, _copy_buffer]
+        if hasattr(os, 'copy_file_range'):
+            methods.insert(0, _copy_range)
+    stream = None
+    if streaming:
+        stream = StreamWindow(infd, outfd)
+    offset = 0
+    while True:
+        try:
+            count = methods[0](infd, outfd, offset)
+        except OSError as err:
+            if err.errno not in _FALLBACK_ERRNOS or len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if not count:
+            break
+        offset += count
+        if counter is not None:
+            counter(count)
+        if stream:
+            stream.advance(offset)
+    if stream:
+        stream.finish(offset)
+    return offset
+
+def _new_hashers(algorithms):
+    """Creates a hashlib object for each algorithm name"""
+    return dict((name, hashlib.new(name)) for name in algorithms)
+
+def _copy_file(src, dst, update, streaming, hashers, counter=None):
+    """Helper function for the copy_file calls.
+       Returns the destination, or None if update left it alone"""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    src_stat = os.stat(src)
+    if update and os.path.exists(dst) and \
+       os.stat(dst).st_mtime >= src_stat.st_mtime:
+        return None
+
+    #never write through a hardlink, the other names (e.g. a FishCache
+    #entry) have to keep their contents
+    if os.path.exists(dst) and os.stat(dst).st_nlink > 1:
+        os.unlink(dst)
+
+    with open(src, 'rb') as rfd:
+        with open(dst, 'wb') as wfd:
+            _copy_data(rfd.fileno(), wfd.fileno(), streaming, hashers, counter)
+
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+    return dst
+
+def copy_file(src, dst, update=False, streaming=False, counter=None):
+    """Copies the file src to dst, keeping its mode and times.
+       If dst is a directory the file is copied into it.
+       If update is set, dst is left alone when it is already newer than src.
+       If streaming is set, the copy keeps out of the page cache (see
+       StreamWindow).
+       counter is called with the number of bytes of every chunk copied.
+       Returns the full destination path"""
+    target = _copy_file(src, dst, update, streaming, None, counter)
+    if target is None:
+        if os.path.isdir(dst):
+            return os.path.join(dst, os.path.basename(src))
+        return dst
+    return target
+
+def copy_file_hashed(src, dst, algorithms=('md5',), streaming=False,
+                     counter=None):
+    """Copies src to dst like copy_file, computing digests of the data as it
+       goes past.
+       Returns the full destination path and a dict of hex digests"""
+    hashers = _new_hashers(algorithms)
+    dst = _copy_file(src, dst, False, streaming, hashers, counter)
+    return (dst, dict((name, hasher.hexdigest())
+                      for name, hasher in hashers.items()))
+
+def hash_file(path, algorithms=('md5',), counter=None):
+    """Computes digests of a file, reading it in chunks.
+       counter is called with the size of every chunk read.
+       Returns a dict of hex digests"""
+    hashers = _new_hashers(algorithms)
+    buf = _buffer()
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as rfd:
+        _fadvise(rfd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            count = rfd.readinto(buf)
+            if not count:
+                break
+            for hasher in hashers.values():
+                hasher.update(view[:count])
+            if counter is not None:
+                counter(count)
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers.items())
+
+def copy_files(jobs, workers=COPY_WORKERS, streaming=False, update=True,
+               finished=None, algorithms=None, counter=None):
+    """Copies a list of (source, destination) file pairs.
+       Destination directories are created up front so that the worker
+       threads never race each other on makedirs.
+       finished is called with the index of every job as it completes, along
+       with the digests of the data when algorithms are given.
+       counter is called from the workers with the size of every chunk
+       copied, and with the whole size of files update leaves alone.
+       Returns the list of destinations in the same order as jobs"""
+    for directory in sorted(set(os.path.dirname(dst) for src, dst in jobs)):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _copy(index):
+        """Copies a single file, keeping mode and times"""
+        src, dst = jobs[index]
+        hashers = None
+        if algorithms:
+            hashers = _new_hashers(algorithms)
+        target = _copy_file(src, dst, update, streaming, hashers, counter)
+        if target is None and counter is not None:
+            counter(os.stat(src).st_size)
+        if finished is not None and target is not None:
+            digests = None
+            if hashers:
+                digests = dict((name, hasher.hexdigest())
+                               for name, hasher in hashers.items())
+            finished(index, digests)
+        return dst
+
+    if workers is None or workers < 2 or len(jobs) < 2:
+        return [_copy(index) for index in range(len(jobs))]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_copy, index) for index in range(len(jobs))]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+class _HashingReader:
+    """File object wrapper that hashes everything read through it"""
+    def __init__(self, fileobj, hashers):
+        self.fileobj = fileobj
+        self.hashers = hashers
+
+    def read(self, size=-1):
+        """Reads from the wrapped file, hashing the data on the way"""
+        data = self.fileobj.read(size)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        return data
+
+    def drain(self):
+        """Reads whatever the consumer left behind, so the hashes cover the
+           whole file"""
+        while self.read(COPY_CHUNK):
+            pass
+
+def _safe_tar_name(name):
+    """Whether a name in a tarball stays inside the extraction directory"""
+    if not name or name.startswith('/'):
+        return False
+    return os.path.normpath(name).split(os.sep)[0] != '..'
+
+def scan_tar(path, algorithms=(), wanted=None):
+    """Lists a (possibly compressed) tarball in a single pass over the
+       stream, hashing the raw file with algorithms at the same time.
+       The contents of regular files whose names wanted returns True for are
+       read along the way.
+       Returns the digests, the list of member names and a dict of the
+       contents that were read"""
+    hashers = _new_hashers(algorithms)
+    names = []
+    contents = {}
+    with open(path, 'rb') as rfd:
+        reader = _HashingReader(rfd, hashers)
+        with tarfile.open(fileobj=reader, mode='r|*') as archive:
+            for member in archive:
+                names.append(member.name)
+                if wanted is not None and member.isfile() and wanted(member.name):
+                    contents[member.name] = archive.extractfile(member).read()
+        reader.drain()
+    return (dict((name, hasher.hexdigest()) for name, hasher in hashers.items()),
+            names, contents)
+
+def extract_tar(path, destination, algorithms=()):
+    """Extracts a (possibly compressed) tarball into destination in a single
+       pass over the stream, checking every member as it goes and hashing
+       the raw file with algorithms at the same time.
+       destination should be a private directory; if a member would land
+       outside of it, by name, by going through a symlink the tarball made,
+       by being written over a link it made or by hardlinking through or to
+       one of its symlinks, everything extracted so far is removed again.
+       Members are otherwise
+       extracted as they are, with their modes and wherever their symlinks
+       point, like extractall does.
+       Returns the digests and the list of member names, or None instead of
+       the names if the tarball was unsafe"""
+    hashers = _new_hashers(algorithms)
+    names = []
+    directories = []
+    #symlinks the tarball made, and every link it made
+    symlinks = set()
+    links = set()
+
+    def through_symlink(name, parents_only):
+        """Whether name leads through (or is) one of the tarball's symlinks"""
+        parts = os.path.normpath(name).split(os.sep)
+        end = len(parts) if parents_only else len(parts) + 1
+        return any(os.sep.join(parts[:index]) in symlinks
+                   for index in range(1, end))
+
+    options = {}
+    if hasattr(tarfile, 'data_filter'):
+        #newer pythons filter members by default, FISH packages are trusted
+        #as far as the checks here go
+        options['filter'] = 'fully_trusted'
+    with open(path, 'rb') as rfd:
+        reader = _HashingReader(rfd, hashers)
+        with tarfile.open(fileobj=reader, mode='r|*') as archive:
+            for member in archive:
+                if names is None:
+                    continue
+                if not _safe_tar_name(member.name) or \
+                   (member.islnk() and not _safe_tar_name(member.linkname)):
+                    names = None
+                    continue
+                if through_symlink(member.name, True) or \
+                   os.path.normpath(member.name) in links or \
+                   (member.islnk() and through_symlink(member.linkname, False)):
+                    names = None
+                    continue
+                if member.issym():
+                    symlinks.add(os.path.normpath(member.name))
+                if member.issym() or member.islnk():
+                    links.add(os.path.normpath(member.name))
+                names.append(member.name)
+                if member.isdir():
+                    #attributes go on once the contents are in place
+                    directories.append(member)
+                    archive.extract(member, destination, set_attrs=False,
+                                    **options)
+                else:
+                    archive.extract(member, destination, **options)
+        reader.drain()
+
+    if names is None:
+        for name in os.listdir(destination):
+            target = os.path.join(destination, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            else:
+                os.unlink(target)
+    else:
+        for member in reversed(directories):
+            target = os.path.join(destination, member.name)
+            os.chmod(target, member.mode & 0o7777)
+            os.utime(target, (member.mtime, member.mtime))
+    return (dict((name, hasher.hexdigest()) for name, hasher in hashers.items()),
+            names)
+
+def clone_file(src, dst):
+    """Makes dst share the contents of src: a reflink where the filesystem
+       can do copy-on-write, a hardlink when it can't, and a copy when the
+       two aren't on the same filesystem.
+       Hardlinked files must be treated as read-only"""
+    try:
+        with open(src, 'rb') as rfd:
+            with open(dst, 'wb') as wfd:
+                fcntl.ioctl(wfd.fileno(), _FICLONE, rfd.fileno())
+        shutil.copystat(src, dst)
+        return
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+def link_tree(src, dst):
+    """Recreates the tree src at dst with clone_file, symlinks are recreated
+       and directories keep their modes"""
+    directories = []
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        directories.append((root, target))
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        for name in links:
+            dirs.remove(name)
+        for name in files + links:
+            source = os.path.join(root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, name))
+            else:
+                clone_file(source, os.path.join(target, name))
+    for source, target in reversed(directories):
+        shutil.copystat(source, target)
+
+def move_tree(src, dst):
+    """Moves the contents of the tree src into dst, replacing any files that
+       are already there like an extraction straight into dst would.
+       Files are renamed rather than copied when both are on one filesystem.
+       src is left empty"""
+    for root, dirs, files in os.walk(src):
+        relative = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(dst, relative))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        #links to directories are moved like files, never walked into
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        for name in links:
+            dirs.remove(name)
+        for name in sorted(files + links):
+            source = os.path.join(root, name)
+            destination = os.path.join(target, name)
+            try:
+                os.rename(source, destination)
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    raise
+                if os.path.lexists(destination):
+                    os.unlink(destination)
+                shutil.move(source, destination)
+        dirs.sort()
+
+##                ##
+## Common Classes ##
+##                ##
+
+#A single file found while scanning a tree, path is relative to the tree root
+ManifestEntry = namedtuple('ManifestEntry', 'path size mtime_ns mode inode')
+
+class StreamWindow:
+    """Keeps a single large copy from flooding the page cache.
+       Sources are read ahead of the copy cursor, written data is flushed
+       every STREAM_WINDOW bytes and dropped from the cache once it has
+       reached the disk"""
+    def __init__(self, infd, outfd):
+        self.infd = infd
+        self.outfd = outfd
+        #everything before dropped is on disk and out of the cache
+        self.dropped = 0
+        #everything before started has had its writeback started
+        self.started = 0
+        _fadvise(infd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _fadvise(infd, 0, STREAM_WINDOW, os.POSIX_FADV_WILLNEED)
+
+    def advance(self, offset):
+        """Called whenever the copy reached offset"""
+        _fadvise(self.infd, offset, STREAM_WINDOW, os.POSIX_FADV_WILLNEED)
+        if offset - self.started < STREAM_WINDOW:
+            return
+        #wait for the previous window to hit the disk and forget it
+        if self.started > self.dropped:
+            self._drop(self.started)
+        #kick off writeback of this window without waiting for it
+        _sync_range(self.outfd, self.started, offset - self.started,
+                    SYNC_FILE_RANGE_WRITE)
+        self.started = offset
+
+    def finish(self, offset):
+        """Flushes and drops whatever is left of the file"""
+        if offset > self.dropped:
+            self._drop(offset)
+
+    def _drop(self, offset):
+        """Waits for the data before offset to be written and drops it"""
+        _sync_range(self.outfd, self.dropped, offset - self.dropped,
+                    SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                    SYNC_FILE_RANGE_WAIT_AFTER)
+        _fadvise(self.outfd, self.dropped, offset - self.dropped,
+                 os.POSIX_FADV_DONTNEED)
+        self.dropped = offset
+
+class DigestMap:
+    """Digests of files worked out while they were being copied, along with
+       enough of their stat to tell if a file changed after it was hashed"""
+    def __init__(self):
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _identity(path_stat):
+        """The parts of a stat that change whenever the contents do"""
+        return (path_stat.st_dev, path_stat.st_ino, path_stat.st_size,
+                path_stat.st_mtime_ns, path_stat.st_ctime_ns)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, path, digests):
+        """Remembers the digests of a file that was just written"""
+        identity = self._identity(os.stat(path))
+        with self._lock:
+            self._digests[path] = (identity, dict(digests))
+
+    def update(self, other):
+        """Merges the digests of another DigestMap into this one"""
+        with self._lock:
+            self._digests.update(other._digests)
+
+    def lookup(self, path, algorithms=('md5',)):
+        """Returns the digests of path if they are all known and the file
+           hasn't changed since, otherwise None"""
+        item = self._digests.get(path)
+        if item is None:
+            return None
+        try:
+            identity = self._identity(os.stat(path))
+        except OSError:
+            return None
+        if identity != item[0]:
+            return None
+        for name in algorithms:
+            if name not in item[1]:
+                return None
+        return item[1]
+
+class DigestCache:
+    """Digests of files that were hashed on earlier runs, kept on disk.
+       Files are known by (path, dev, inode, size, mtime_ns, ctime_ns) so an
+       unchanged file is never hashed twice, and the least recently used
+       entries are dropped once there are more than limit of them.
+       The path and ctime are part of it because loop devices are reused
+       between mounts and iso9660 inodes are only record offsets, so two
+       images can have files that agree on everything else"""
+    def __init__(self, path=DIGEST_CACHE, limit=DIGEST_CACHE_ENTRIES):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = False
+        try:
+            with open(self.path) as rfd:
+                for key, digests in json.load(rfd):
+                    self._entries[tuple(key)] = digests
+        except (IOError, OSError, ValueError, TypeError):
+            self._entries.clear()
+
+    @staticmethod
+    def _key(path, path_stat):
+        """The identity of a file as far as the cache is concerned"""
+        return (os.path.abspath(path), path_stat.st_dev, path_stat.st_ino,
+                path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_ctime_ns)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, path, algorithms=('md5',)):
+        """Returns the cached digests of path, or None if any of algorithms
+           isn't known for the file as it is now"""
+        try:
+            key = self._key(path, os.stat(path))
+        except OSError:
+            return None
+        with self._lock:
+            digests = self._entries.get(key)
+            if digests is None:
+                return None
+            for name in algorithms:
+                if name not in digests:
+                    return None
+            self._entries.move_to_end(key)
+        return dict(digests)
+
+    def add(self, path, digests, path_stat=None):
+        """Remembers digests for path.  Pass the stat taken before the file
+           was read so that changes made while it was hashed don't stick"""
+        if path_stat is None:
+            path_stat = os.stat(path)
+        key = self._key(path, path_stat)
+        with self._lock:
+            known = self._entries.pop(key, {})
+            known.update(digests)
+            self._entries[key] = known
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def hash_file(self, path, algorithms=('md5',)):
+        """Like hash_file, but only reads path if it isn't cached"""
+        digests = self.lookup(path, algorithms)
+        if digests is None:
+            path_stat = os.stat(path)
+            digests = hash_file(path, algorithms)
+            self.add(path, digests, path_stat)
+        return digests
+
+    def save(self):
+        """Writes the cache back out if it changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[list(key), digests]
+                       for key, digests in self._entries.items()]
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        #one per thread, jobs can be saving at the same time
+        tmp = '%s.%d.new' % (self.path, threading.get_ident())
+        with open(tmp, 'w') as wfd:
+            json.dump(entries, wfd)
+        os.rename(tmp, self.path)
+
+class CopyJournal:
+    """Remembers which files of a copy have safely reached the destination,
+       so an interrupted copy can be resumed rather than started over.
+       Files are keyed by source path along with the size and mtime they
+       had when they were copied"""
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.pending = []
+        self.pending_bytes = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as rfd:
+                for line in rfd:
+                    try:
+                        src, size, mtime_ns = json.loads(line)
+                    except ValueError:
+                        #torn write from when the copy was interrupted
+                        continue
+                    self.done[src] = (size, mtime_ns)
+        self._wfd = open(path, 'a')
+
+    def is_done(self, src, entry, dst):
+        """Checks if src was copied to dst and neither changed since"""
+        if self.done.get(src) != (entry.size, entry.mtime_ns):
+            return False
+        try:
+            dst_stat = os.stat(dst)
+        except OSError:
+            return False
+        #vfat only keeps mtimes to 2 seconds
+        return dst_stat.st_size == entry.size and \
+               abs(dst_stat.st_mtime_ns - entry.mtime_ns) <= 2000000000
+
+    def record(self, src, entry):
+        """Notes that src has been copied"""
+        with self._lock:
+            self.pending.append((src, entry.size, entry.mtime_ns))
+            self.pending_bytes += entry.size
+            if self.pending_bytes >= JOURNAL_SYNC_BYTES or \
+               len(self.pending) >= JOURNAL_SYNC_FILES:
+                self._flush()
+
+    def _flush(self):
+        """Writes out pending records once their data is on disk"""
+        if not self.pending:
+            return
+        os.sync()
+        for record in self.pending:
+            self._wfd.write(json.dumps(record) + '\n')
+            self.done[record[0]] = record[1:]
+        self._wfd.flush()
+        os.fsync(self._wfd.fileno())
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        """Flushes everything recorded and closes the journal"""
+        with self._lock:
+            if not self._wfd.closed:
+                self._flush()
+                self._wfd.close()
+
+    def remove(self):
+        """Throws the journal away once the copy is complete"""
+        self.close()
+        os.remove(self.path)
+
+class TreeMatcher:
+    """Wraps the regex of a white or blacklist so that whole directories can
+       be decided at once, without listing them, when the regex allows it"""
+    def __init__(self, pattern, white):
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        self.pattern = pattern
+        self.white = white
+        self.prefix_stable = _prefix_stable(pattern)
+
+    def search(self, path):
+        """Compatibility with callers that expect a regex"""
+        return self.pattern.search(path)
+
+    def wants(self, path):
+        """Checks a relative file path against the list / color"""
+        if self.white:
+            return bool(self.pattern.search(path))
+        return not self.pattern.search(path)
+
+    def wants_directory(self, path):
+        """Decides a whole relative directory path.
+           Returns True if every file below it is wanted, False if none are
+           and None if the files need to be checked one at a time"""
+        if self.prefix_stable and self.pattern.search(path + '/'):
+            return self.white
+        return None
+
+class TreeManifest:
+    """Scans a tree once and remembers every file that passes the white or
+       blacklist, so sizing and copying the tree don't hit the source twice"""
+    def __init__(self, src, pattern, white, base=None):
+        self.src = src
+        if isinstance(pattern, TreeMatcher):
+            self.matcher = pattern
+        else:
+            self.matcher = TreeMatcher(pattern, white)
+        self.files = []
+        self.directories = []
+        self.dir_size = 0
+        self.digests = DigestMap()
+        #paths are matched relative to base, but recorded relative to src
+        self.prefix = ''
+        if base is not None:
+            self.prefix = os.path.relpath(src, base)
+            if self.prefix == '.':
+                self.prefix = ''
+        self._scan()
+
+    def _scan(self):
+        """Walks the tree iteratively using a single scandir per directory.
+           Directories the matcher rules out are never listed"""
+        stack = [(self.src, '', None)]
+        while stack:
+            directory, relative, decided = stack.pop()
+            subdirs = []
+            for entry in os.scandir(directory):
+                path = os.path.join(relative, entry.name)
+                match = os.path.join(self.prefix, path)
+                #don't copy symlinks or hardlinks, vfat seems to hate them
+                if entry.is_symlink():
+                    continue
+                elif entry.is_dir():
+                    wanted = decided
+                    if wanted is None:
+                        wanted = self.matcher.wants_directory(match)
+                    if wanted is False:
+                        continue
+                    self.directories.append(path)
+                    self.dir_size += entry.stat().st_size
+                    subdirs.append((entry.path, path, wanted))
+                elif decided or (decided is None and self.matcher.wants(match)):
+                    info = entry.stat()
+                    self.files.append(ManifestEntry(path, info.st_size,
+                                                    info.st_mtime_ns,
+                                                    info.st_mode,
+                                                    info.st_ino))
+            stack.extend(reversed(subdirs))
+
+    @property
+    def size(self):
+        """The number of bytes a copy of this tree will take up"""
+        return self.dir_size + sum(entry.size for entry in self.files)
+
+    @property
+    def data_size(self):
+        """The number of bytes of file contents in the tree"""
+        return sum(entry.size for entry in self.files)
+
+    def copy(self, dst, workers=COPY_WORKERS, streaming=False, journal=None,
+             algorithms=None, counter=None):
+        """Copies every file in the manifest into dst.
+           With a CopyJournal, files it already holds are skipped and every
+           file copied is recorded in it.
+           With algorithms, the digests of every file copied are collected in
+           self.digests as the data streams through.
+           counter is called with byte counts adding up to data_size, see
+           copy_files"""
+        jobs = []
+        entries = []
+        outputs = []
+        for entry in self.files:
+            src = os.path.join(self.src, entry.path)
+            target = os.path.join(dst, entry.path)
+            outputs.append(target)
+            if journal is not None and journal.is_done(src, entry, target):
+                if counter is not None:
+                    counter(entry.size)
+                continue
+            jobs.append((src, target))
+            entries.append(entry)
+
+        def finished(index, digests):
+            """Journals a file once it has been copied"""
+            if journal is not None:
+                journal.record(jobs[index][0], entries[index])
+            if digests:
+                self.digests.add(jobs[index][1], digests)
+
+        copy_files(jobs, workers, streaming, journal is None, finished,
+                   algorithms, counter)
+        return outputs
@@ -23,34 +23,49 @@
 # with this application; if not, write to the Free Software Foundation, Inc., 51
 # Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 ##################################################################################
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Timer, Condition
+from collections import OrderedDict
+import heapq
+import itertools
 import logging
-import os
 import sys
+import time
 
 if sys.version >= '3':
     def callable(obj):
-        import collections
-        return isinstance(obj, collections.Callable)
+        try:
+            from collections.abc import Callable
+        except ImportError:
+            from collections import Callable
+        return isinstance(obj, Callable)
 
 #--------------------------------------------------------------------#
-#Borrowed from USB-Creator initially
-class ProgressBySize(Thread):
-    """Used for emitting progress for subcalls that don't nicely use stdout'"""
-    def __init__(self, input_str, device, to_write):
-        Thread.__init__(self)
-        self._stopevent = Event()
+class ByteProgress:
+    """Used for emitting progress for work that counts its own bytes.
+       Producers push exact counters with add() or set() from any thread,
+       and the percentage, throughput (bytes/s, smoothed) and ETA (s) are
+       pushed out through progress() at most every interval seconds.
+       progress() is only ever called by one producer at a time"""
+    def __init__(self, input_str, total, interval=0.5, smoothing=0.3):
+        self._lock = Lock()
         self.str = input_str
-        self.device = device
+        self.interval = interval
+        self.smoothing = smoothing
         self.scale = 100
         self.start_value = 0
-        self.reset_write(to_write)
+        self.reset_write(total)
 
-    def reset_write(self, to_write):
-        """Resets the amount to be written counter"""
-        self.to_write = to_write
-        statvfs = os.statvfs(self.device)
-        self.start_free = statvfs.f_bsize * statvfs.f_bavail
+    def reset_write(self, total):
+        """Resets the byte counters for a new amount to be written"""
+        with self._lock:
+            self.total = total
+            self.done = 0
+            self.fraction = 0.0
+            self.rate = 0.0
+            self._sample_time = time.time()
+            self._sample_fraction = 0.0
+            self._fraction_rate = 0.0
+            self._emitted = 0
 
     def set_scale_factor(self, factor):
         """"Sets a floating point scaling factor (0-100)"""
@@ -66,29 +81,307 @@ class ProgressBySize(Thread):
         else:
             self.start_value = value
 
-    def progress(self, input_str, percent):
+    def progress(self, input_str, percent, rate, eta):
         """Function intended to be overridden to the correct external function
         """
         pass
 
-    def run(self):
-        """Runs the thread"""
+    def add(self, count):
+        """Records count more bytes as written"""
+        with self._lock:
+            self.done += count
+            self._update_fraction()
+            update = self._sample()
+            if update:
+                self._emit(*update)
+
+    def set(self, done, total=None):
+        """Records the absolute number of bytes written so far"""
+        with self._lock:
+            if total:
+                self.total = total
+            self.done = done
+            self._update_fraction()
+            update = self._sample()
+            if update:
+                self._emit(*update)
+
+    def set_fraction(self, fraction):
+        """Records progress for producers that only know how far along they
+           are, rather than how many bytes they have written"""
+        with self._lock:
+            self.fraction = min(max(fraction, 0.0), 1.0)
+            if self.total:
+                self.done = int(self.fraction * self.total)
+            update = self._sample()
+            if update:
+                self._emit(*update)
+
+    def finish(self):
+        """Pushes out the final state, whether or not it is due"""
+        with self._lock:
+            self.fraction = 1.0
+            if self.total:
+                self.done = self.total
+            self._emit(*self._sample(force=True))
+
+    def _update_fraction(self):
+        """Works out the fraction done from the byte counters"""
+        if self.total:
+            self.fraction = min(float(self.done) / self.total, 1.0)
+
+    def _sample(self, force=False):
+        """Folds the progress since the last sample into the smoothed rate.
+           Returns the values to emit, or None if it isn't time yet"""
+        now = time.time()
+        elapsed = now - self._sample_time
+        if not force and elapsed < self.interval:
+            return None
+        if elapsed > 0:
+            instant = (self.fraction - self._sample_fraction) / elapsed
+            if self._emitted:
+                self._fraction_rate += self.smoothing * \
+                                       (instant - self._fraction_rate)
+            else:
+                self._fraction_rate = instant
+        self._sample_time = now
+        self._sample_fraction = self.fraction
+        self._emitted += 1
+        self.rate = self._fraction_rate * (self.total or 0)
+        eta = -1.0
+        if self.fraction >= 1.0:
+            eta = 0.0
+        elif self._fraction_rate > 0:
+            eta = (1.0 - self.fraction) / self._fraction_rate
+        percent = self.start_value + self.fraction * self.scale
+        return (percent, self.rate, eta)
+
+    def _emit(self, percent, rate, eta):
+        """Calls the progress function, never letting it break the producer"""
         try:
-            while not self._stopevent.isSet():
-                statvfs = os.statvfs(self.device)
-                free = statvfs.f_bsize * statvfs.f_bavail
-                written = self.start_free - free
-                veecent = self.start_value + int((written / float(self.to_write)) * self.scale)
-                if callable(self.progress):
-                    self.progress(self.str, veecent)
-                self._stopevent.wait(2)
+            if callable(self.progress):
+                self.progress(self.str, percent, rate, eta)
         except Exception:
             logging.exception('Could not update progress:')
 
-    def join(self, timeout=None):
-        """Stops the thread"""
-        self._stopevent.set()
-        Thread.join(self, timeout)
+class ProgressEmitter:
+    """Coalesces progress updates before they go out on the bus.
+       Every job gets at most rate updates a second; anything that arrives
+       sooner replaces the update waiting to go out, repeats of what was last
+       sent are dropped, and a final (100%) update always goes out at once"""
+    def __init__(self, rate=2):
+        self.interval = 1.0 / rate
+        self._lock = Lock()
+        self._jobs = {}
+
+    def progress(self, input_str, percent, rate, eta):
+        """Function intended to be overridden to the correct external function
+        """
+        pass
+
+    def job_progress(self, job, input_str, percent, rate, eta):
+        """Sends the progress of a named job, override it to tell jobs
+           apart.  Everything goes through progress unless it is"""
+        self.progress(input_str, percent, rate, eta)
+
+    def update(self, input_str, percent, rate=0.0, eta=-1.0, job=''):
+        """Queues up an update for job, sending it if it is due"""
+        try:
+            value = float(percent)
+        except ValueError:
+            value = 0.0
+        with self._lock:
+            state = self._jobs.setdefault(job, {'job': job, 'sent': None,
+                                                'time': 0, 'pending': None,
+                                                'timer': None})
+            #pulses are a heartbeat, so they are limited but never dropped
+            key = (input_str, round(value, 1))
+            if value >= 0 and key == state['sent']:
+                state['pending'] = None
+                return
+            state['pending'] = (input_str, percent, rate, eta, key)
+            wait = state['time'] + self.interval - time.time()
+            if value >= 100 or wait <= 0:
+                self._send(state)
+            elif state['timer'] is None:
+                state['timer'] = Timer(wait, self.flush, [job])
+                state['timer'].daemon = True
+                state['timer'].start()
+
+    def flush(self, job=''):
+        """Sends whatever update is still waiting to go out for job"""
+        with self._lock:
+            state = self._jobs.get(job)
+            if state:
+                self._send(state)
+
+    def finish(self, job=''):
+        """Sends anything still waiting for job and forgets about it"""
+        with self._lock:
+            state = self._jobs.pop(job, None)
+            if state:
+                self._send(state)
+
+    def _send(self, state):
+        """Sends the pending update of a job, must hold the lock"""
+        if state['timer'] is not None:
+            state['timer'].cancel()
+            state['timer'] = None
+        if state['pending'] is None:
+            return
+        input_str, percent, rate, eta, key = state['pending']
+        state['pending'] = None
+        state['sent'] = key
+        state['time'] = time.time()
+        try:
+            if state['job'] != '':
+                self.job_progress(state['job'], input_str, percent, rate, eta)
+            elif callable(self.progress):
+                self.progress(input_str, percent, rate, eta)
+        except Exception:
+            logging.exception('Could not update progress:')
+
+#States a job goes through
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+#How many finished jobs are remembered for status queries
+JOB_HISTORY = 100
+
+class Job:
+    """A piece of work submitted to a JobQueue"""
+    def __init__(self, job_id, function, description, priority):
+        self.id = job_id
+        self.function = function
+        self.description = description
+        self.priority = priority
+        self.state = JOB_QUEUED
+        self.error = ''
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def is_finished(self):
+        """Checks whether the job is done with, one way or another"""
+        return self.state in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+class JobQueue:
+    """Runs jobs on up to workers threads at once.
+       Higher priorities go first, jobs of the same priority in the order
+       they were submitted.  Every job is called with itself as the only
+       argument, and state_changed hears about it whenever its state does"""
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._condition = Condition()
+        self._queue = []
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._threads = []
+        self._running = 0
+
+    def state_changed(self, job):
+        """Function intended to be overridden to the correct external function
+        """
+        pass
+
+    def _changed(self, job):
+        """Passes a state change on, a broken listener can't break the queue"""
+        try:
+            self.state_changed(job)
+        except Exception:
+            logging.exception('Could not report job state:')
+
+    def submit(self, function, description='', priority=0):
+        """Queues function up to run as a job, and returns the Job"""
+        with self._condition:
+            job = Job(next(self._ids), function, description, priority)
+            self._jobs[job.id] = job
+            self._forget_finished()
+        #heard about before a worker can get to it
+        self._changed(job)
+        with self._condition:
+            heapq.heappush(self._queue, (-priority, next(self._order), job))
+            queued = len([item for item in self._queue
+                          if item[2].state == JOB_QUEUED])
+            while len(self._threads) < min(self.workers, self._running + queued):
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify_all()
+        return job
+
+    def _forget_finished(self):
+        """Drops the oldest finished jobs beyond the history kept, must
+           hold the lock"""
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Returns the job with job_id, or None if it isn't known"""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        """Returns every known job, oldest first"""
+        with self._condition:
+            return list(self._jobs.values())
+
+    def busy(self):
+        """Checks whether any job is queued or running"""
+        with self._condition:
+            return any(not job.is_finished() for job in self._jobs.values())
+
+    def cancel(self, job_id):
+        """Cancels a job that hasn't started yet, returns whether it was"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != JOB_QUEUED:
+                return False
+            job.state = JOB_CANCELLED
+            job.finished = time.time()
+        self._changed(job)
+        return True
+
+    def _next(self):
+        """Waits for the next job to run, and for fewer than workers jobs to
+           be running, must hold the lock"""
+        while True:
+            while self._queue and self._running < self.workers:
+                job = heapq.heappop(self._queue)[2]
+                if job.state == JOB_QUEUED:
+                    return job
+            self._condition.wait()
+
+    def _work(self):
+        """Runs jobs for as long as the program does"""
+        while True:
+            with self._condition:
+                job = self._next()
+                job.state = JOB_RUNNING
+                job.started = time.time()
+                self._running += 1
+            self._changed(job)
+            try:
+                job.result = job.function(job)
+                state = JOB_DONE
+            except Exception as err:
+                logging.exception('Job %d failed:' % job.id)
+                job.error = str(err)
+                state = JOB_FAILED
+            with self._condition:
+                job.state = state
+                job.finished = time.time()
+                self._running -= 1
+                self._condition.notify_all()
+            self._changed(job)
 
 class ProgressByPulse(Thread):
     """Used for emitting the thought of progress for subcalls that don't show
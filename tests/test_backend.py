@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import tarfile
+import threading
+import time
+import unittest
+import tempfile
+
+try:
+    from Dell import recovery_backend
+except ImportError:
+    #needs dbus, gi and the rest of what the backend runs with
+    recovery_backend = None
+
+from Dell import recovery_fish, recovery_io, recovery_xml
+
+@unittest.skipIf(recovery_backend is None, 'the backend dependencies are not available')
+class BackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.backend = recovery_backend.Backend()
+        self.backend.digest_cache = recovery_io.DigestCache(
+                                        os.path.join(self.tmp, 'digests.json'))
+        self.backend.fish_cache = recovery_fish.FishCache(
+                                        os.path.join(self.tmp, 'fish'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _tar(self, name, members):
+        path = os.path.join(self.tmp, name)
+        with tarfile.open(path, 'w:gz') as archive:
+            for member, data in members:
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return path
+
+class DriverFishTestCase(BackendTestCase):
+
+    def _prepare(self, fishie):
+        assembly_tmp = tempfile.mkdtemp(dir=self.tmp)
+        return self.backend._prepare_driver_fish(fishie, assembly_tmp)
+
+    def test_unsafe_not_cached(self):
+        fishie = self._tar('unsafe.tar.gz', [('debs/a.deb', b'a'),
+                                             ('../escape', b'b')])
+        for attempt in range(2):
+            steps = self._prepare(fishie)
+            md5 = steps[0][2]
+            self.assertEqual(('fish', 'unsafe.tar.gz'), steps[0][:2])
+            self.assertEqual([], os.listdir(steps[1][1]))
+            self.assertIsNone(self.backend.fish_cache.fetch(md5,
+                                                tempfile.mkdtemp(dir=self.tmp)))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'escape')))
+
+    def test_safe_cached(self):
+        fishie = self._tar('safe.tar.gz', [('debs/a.deb', b'a')])
+        md5 = self._prepare(fishie)[0][2]
+        info = self.backend.fish_cache.fetch(md5, tempfile.mkdtemp(dir=self.tmp))
+        self.assertEqual(['debs/a.deb'], info['names'])
+
+class FishCatalogTestCase(BackendTestCase):
+
+    def test_locked_catalog(self):
+        def locked(package):
+            raise sqlite3.OperationalError('database is locked')
+        self.backend.fish_catalog.update = locked
+        fishie = self._tar('driver.tar.gz', [('debs/a.deb', b'a')])
+        self.assertEqual([(fishie, 0, '', '', [])],
+                         [tuple(entry) for entry in
+                          self.backend.query_fish_packages([fishie])])
+
+class InspectImageTestCase(BackendTestCase):
+
+    def test_unreadable(self):
+        def unreadable(path):
+            raise OSError(5, 'Input/output error')
+        self.addCleanup(setattr, recovery_backend, 'IsoImage',
+                        recovery_backend.IsoImage)
+        recovery_backend.IsoImage = unreadable
+        self.backend.image_cache = recovery_backend.ImageCache(
+                                        os.path.join(self.tmp, 'images.json'))
+        path = os.path.join(self.tmp, 'base.iso')
+        with open(path, 'wb') as wfd:
+            wfd.write(b'\0' * 2048)
+        info = self.backend._inspect_image(path, None, None)
+        self.assertEqual('', info['bto_version'])
+        self.assertEqual('Unknown Base Image', info['description'])
+
+class AssembleImageTestCase(BackendTestCase):
+
+    def test_base_bto_xml_carried_over(self):
+        base = os.path.join(self.tmp, 'base')
+        os.makedirs(os.path.join(base, '.disk'))
+        xml_obj = recovery_xml.BTOxml()
+        xml_obj.load_bto_xml()
+        xml_obj.replace_node_contents('os', 'ubuntu-16.04')
+        xml_obj.append_fish('driver', 'base-driver.deb', 'c0ffee')
+        xml_obj.write_xml(os.path.join(base, 'bto.xml'))
+        fishie = os.path.join(self.tmp, 'new-driver.deb')
+        with open(fishie, 'wb') as wfd:
+            wfd.write(b'deb')
+
+        written = []
+        def capture(backend, recovery, version, iso):
+            backend.xml_obj.write_xml(iso)
+            written.append(recovery_xml.BTOxml())
+            written[0].load_bto_xml(iso)
+        self.addCleanup(delattr, recovery_backend.Backend, 'capture')
+        recovery_backend.Backend.capture = capture
+        self.backend.assemble_image(base, [fishie], {}, '', 'capture', 'A00',
+                                    os.path.join(self.tmp, 'bto.xml'))
+        self.assertEqual('ubuntu-16.04', written[0].fetch_node_contents('os'))
+        self.assertEqual('base', written[0].fetch_node_contents('base'))
+        with open(os.path.join(self.tmp, 'bto.xml')) as rfd:
+            contents = rfd.read()
+        self.assertIn('base-driver.deb', contents)
+        self.assertIn('new-driver.deb', contents)
+
+class FakeMounts(object):
+    '''Stands in for subprocess in the backend, keeping track of what
+       mount and umount were asked to do'''
+    PIPE = subprocess.PIPE
+
+    def __init__(self):
+        self.mounted = {}
+
+    def Popen(self, args, **kwargs):
+        output = ''
+        if args == ['mount']:
+            #loop mounts are listed by their loop device, not the image
+            output = ''.join('%s on %s type iso9660 (ro)\n' %
+                             (source if '.iso' not in source else '/dev/loop%d' % index,
+                              target)
+                             for index, (target, source) in enumerate(self.mounted.items()))
+        else:
+            self.mounted[args[-1]] = args[-2]
+        return FakeProcess(output)
+
+    def call(self, args):
+        if args[0] == 'umount':
+            del self.mounted[args[1]]
+        return 0
+
+class FakeProcess(object):
+
+    def __init__(self, output):
+        self.output = output
+
+    def communicate(self):
+        return (self.output, '')
+
+    def wait(self):
+        return 0
+
+class FakeAtexit(object):
+    '''Stands in for atexit in the backend, collecting what would have
+       been left to run on exit'''
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, function, *args):
+        self.registered.append((function, args))
+
+class JobTestCase(BackendTestCase):
+
+    def setUp(self):
+        BackendTestCase.setUp(self)
+        self.mounts = FakeMounts()
+        self.atexit = FakeAtexit()
+        for name, fake in (('subprocess', self.mounts), ('atexit', self.atexit)):
+            self.addCleanup(setattr, recovery_backend, name,
+                            getattr(recovery_backend, name))
+            setattr(recovery_backend, name, fake)
+
+    def _build(self, assemble_image, count, workers):
+        """Runs count jobs with assemble_image standing in for the real one"""
+        self.addCleanup(setattr, recovery_backend.Backend, 'assemble_image',
+                        recovery_backend.Backend.assemble_image)
+        recovery_backend.Backend.assemble_image = assemble_image
+        self.backend.jobs.workers = workers
+        for index in range(count):
+            self.backend.submit_build(os.path.join(self.tmp, 'base.iso'), [],
+                                      {}, '', 'create_ubuntu', 'A00',
+                                      os.path.join(self.tmp, '%d.iso' % index), 0)
+        for attempt in range(500):
+            if not self.backend.jobs.busy():
+                break
+            time.sleep(0.01)
+        self.assertEqual(['done'] * count,
+                         [job.state for job in self.backend.jobs.jobs()])
+
+    def test_jobs_release_mounts(self):
+        used = []
+        def assemble_image(backend, base, driver_fish, application_fish,
+                           dell_recovery_package, create_fn, version, iso):
+            outer = backend.request_mount(base)
+            inner = backend.request_mount(os.path.join(outer, 'ubuntu.iso'))
+            used.extend([outer, inner, backend._mkdtemp()])
+        self._build(assemble_image, 2, 1)
+        self.assertEqual(6, len(used))
+        self.assertEqual({}, self.mounts.mounted)
+        for path in used:
+            self.assertFalse(os.path.exists(path), path)
+        self.assertEqual([], self.atexit.registered)
+
+    def test_jobs_dont_share_mounts(self):
+        used = []
+        first = threading.Event()
+        both = threading.Barrier(2, timeout=5)
+        def assemble_image(backend, base, driver_fish, application_fish,
+                           dell_recovery_package, create_fn, version, iso):
+            #the second job comes along once the first has its mount
+            if not iso.endswith('0.iso'):
+                first.wait(5)
+            used.append(backend.request_mount('/dev/sdz2'))
+            first.set()
+            #neither lets go of its mount before the other has one
+            both.wait()
+        self._build(assemble_image, 2, 2)
+        self.assertEqual(2, len(set(used)))
+        self.assertEqual({}, self.mounts.mounted)
+
+    def test_fish_staging_in_job(self):
+        fishie = os.path.join(self.tmp, 'driver.deb')
+        with open(fishie, 'wb') as wfd:
+            wfd.write(b'deb')
+        def assemble_image(backend, base, driver_fish, application_fish,
+                           dell_recovery_package, create_fn, version, iso):
+            assembly_tmp = backend._mkdtemp()
+            backend._process_driver_fish([fishie] * 4, assembly_tmp)
+            self.assertTrue(os.path.exists(os.path.join(assembly_tmp, 'debs',
+                                                        'driver.deb')))
+        self._build(assemble_image, 1, 1)
+        self.assertEqual([], self.atexit.registered)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import hashlib
+import io
+import os
+import re
+import shutil
+import stat
+import tarfile
+import unittest
+import tempfile
+
+from Dell import recovery_io
+
+class CopyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dst = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dst)
+
+    def _write(self, name, data=b'data', mtime=None):
+        path = os.path.join(self.src, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+class CopyFilesTestCase(CopyTestCase):
+
+    def test_parallel_copy(self):
+        jobs = []
+        for i in range(32):
+            src = self._write(os.path.join('pool', str(i % 4), 'f%d' % i),
+                              b'x' * i, 1000000000 + i)
+            jobs.append((src, os.path.join(self.dst, 'pool', str(i % 4),
+                                           'f%d' % i)))
+        outputs = recovery_io.copy_files(jobs, workers=4)
+        self.assertEqual([dst for src, dst in jobs], outputs)
+        for src, dst in jobs:
+            with open(src, 'rb') as a, open(dst, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+            self.assertEqual(int(os.stat(src).st_mtime),
+                             int(os.stat(dst).st_mtime))
+
+    def test_serial_copy(self):
+        src = self._write('single')
+        dst = os.path.join(self.dst, 'sub', 'single')
+        self.assertEqual([dst], recovery_io.copy_files([(src, dst)], workers=1))
+        self.assertTrue(os.path.exists(dst))
+
+    def test_error_propagates(self):
+        jobs = [(os.path.join(self.src, 'missing%d' % i),
+                 os.path.join(self.dst, 'missing%d' % i)) for i in range(4)]
+        self.assertRaises(Exception, recovery_io.copy_files, jobs, 2)
+
+class CopyFileTestCase(CopyTestCase):
+
+    def _check(self, src, dst):
+        with open(src, 'rb') as a, open(dst, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertEqual(os.stat(src).st_mtime_ns, os.stat(dst).st_mtime_ns)
+        self.assertEqual(os.stat(src).st_mode, os.stat(dst).st_mode)
+
+    def test_copy_into_directory(self):
+        src = self._write('fish.deb', os.urandom(3 * 1024 * 1024 + 17))
+        os.chmod(src, 0o640)
+        dst = recovery_io.copy_file(src, self.dst)
+        self.assertEqual(os.path.join(self.dst, 'fish.deb'), dst)
+        self._check(src, dst)
+
+    def test_fallbacks(self):
+        src = self._write('big', os.urandom(recovery_io.COPY_CHUNK + 4096))
+        dst = os.path.join(self.dst, 'big')
+        with open(src, 'rb') as rfd, open(dst, 'wb') as wfd:
+            offset = 0
+            while True:
+                copied = recovery_io._copy_buffer(rfd.fileno(), wfd.fileno(),
+                                                  offset)
+                if not copied:
+                    break
+                offset += copied
+        self.assertEqual(os.path.getsize(src), offset)
+        with open(src, 'rb') as a, open(dst, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_streaming(self):
+        src = self._write('squashfs', os.urandom(recovery_io.STREAM_WINDOW * 2 + 1))
+        dst = recovery_io.copy_file(src, self.dst, streaming=True)
+        self._check(src, dst)
+
+    def test_update(self):
+        src = self._write('old', b'old', 1000000000)
+        dst = os.path.join(self.dst, 'old')
+        with open(dst, 'wb') as f:
+            f.write(b'newer')
+        recovery_io.copy_file(src, dst, update=True)
+        with open(dst, 'rb') as f:
+            self.assertEqual(b'newer', f.read())
+        recovery_io.copy_file(src, dst)
+        self._check(src, dst)
+
+class TreeManifestTestCase(CopyTestCase):
+
+    def setUp(self):
+        CopyTestCase.setUp(self)
+        self._write('casper/filesystem.squashfs', b'squash')
+        self._write('casper-rw/persistent', b'rw data')
+        self._write('.disk/info', b'Ubuntu')
+        self._write('pool/main/d/dell-recovery/dell-recovery_1.50_all.deb')
+        os.symlink('casper', os.path.join(self.src, 'link'))
+
+    def _files(self, manifest):
+        return sorted(entry.path for entry in manifest.files)
+
+    def test_blacklist(self):
+        manifest = recovery_io.TreeManifest(self.src,
+                                            re.compile('casper-rw|casper-uuid'),
+                                            False)
+        self.assertEqual(['.disk/info', 'casper/filesystem.squashfs',
+                          'pool/main/d/dell-recovery/dell-recovery_1.50_all.deb'],
+                         self._files(manifest))
+
+    def test_whitelist(self):
+        manifest = recovery_io.TreeManifest(self.src, re.compile('^.disk'), True)
+        self.assertEqual(['.disk/info'], self._files(manifest))
+
+    def test_size_and_copy(self):
+        manifest = recovery_io.TreeManifest(self.src, re.compile(''), True)
+        entry = [e for e in manifest.files if e.path == '.disk/info'][0]
+        self.assertEqual(6, entry.size)
+        self.assertEqual(os.stat(os.path.join(self.src, '.disk/info')).st_ino,
+                         entry.inode)
+        self.assertTrue(manifest.size >= sum(e.size for e in manifest.files))
+        outputs = manifest.copy(self.dst)
+        self.assertEqual(4, len(outputs))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'link')))
+        with open(os.path.join(self.dst, 'casper-rw', 'persistent'), 'rb') as f:
+            self.assertEqual(b'rw data', f.read())
+
+    def test_pruned_directory_is_not_listed(self):
+        os.chmod(os.path.join(self.src, 'casper-rw'), 0)
+        try:
+            manifest = recovery_io.TreeManifest(self.src,
+                                                re.compile('casper-rw|casper-uuid'),
+                                                False)
+        finally:
+            os.chmod(os.path.join(self.src, 'casper-rw'), 0o755)
+        self.assertNotIn('casper-rw', manifest.directories)
+
+    def test_resume_with_journal(self):
+        manifest = recovery_io.TreeManifest(self.src, re.compile(''), True)
+        journal_path = os.path.join(self.dst, recovery_io.COPY_JOURNAL)
+        journal = recovery_io.CopyJournal(journal_path)
+        manifest.copy(self.dst, journal=journal)
+        journal.close()
+
+        #interrupted half way through a file
+        partial = os.path.join(self.dst, 'casper', 'filesystem.squashfs')
+        with open(partial, 'wb') as f:
+            f.write(b'squ')
+
+        journal = recovery_io.CopyJournal(journal_path)
+        copied = []
+        original = recovery_io._copy_file
+        def tracking_copy(src, dst, *args):
+            copied.append(dst)
+            return original(src, dst, *args)
+        recovery_io._copy_file = tracking_copy
+        try:
+            outputs = manifest.copy(self.dst, journal=journal)
+        finally:
+            recovery_io._copy_file = original
+        journal.remove()
+        self.assertEqual(4, len(outputs))
+        self.assertEqual([partial], copied)
+        with open(partial, 'rb') as f:
+            self.assertEqual(b'squash', f.read())
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_copy_with_digests(self):
+        manifest = recovery_io.TreeManifest(self.src, re.compile(''), True)
+        manifest.copy(self.dst, algorithms=('md5', 'sha256'))
+        info = os.path.join(self.dst, '.disk', 'info')
+        self.assertEqual(4, len(manifest.digests))
+        self.assertEqual(hashlib.md5(b'Ubuntu').hexdigest(),
+                         manifest.digests.lookup(info)['md5'])
+        self.assertIsNone(manifest.digests.lookup(info, ('sha1',)))
+        with open(info, 'ab') as f:
+            f.write(b' 16.04')
+        self.assertIsNone(manifest.digests.lookup(info))
+
+    def test_copy_counts_bytes(self):
+        manifest = recovery_io.TreeManifest(self.src, re.compile(''), True)
+        counted = []
+        manifest.copy(self.dst, workers=2, counter=counted.append)
+        self.assertEqual(manifest.data_size, sum(counted))
+        #nothing is copied the second time, but it is still counted
+        del counted[:]
+        manifest.copy(self.dst, counter=counted.append)
+        self.assertEqual(manifest.data_size, sum(counted))
+
+class HashTestCase(CopyTestCase):
+
+    def test_hash_file(self):
+        data = os.urandom(recovery_io.COPY_CHUNK + 5)
+        src = self._write('blob', data)
+        self.assertEqual({'md5': hashlib.md5(data).hexdigest(),
+                          'sha256': hashlib.sha256(data).hexdigest()},
+                         recovery_io.hash_file(src, ('md5', 'sha256')))
+
+    def test_copy_file_hashed(self):
+        data = os.urandom(recovery_io.COPY_CHUNK * 2 + 5)
+        src = self._write('blob', data)
+        dst, digests = recovery_io.copy_file_hashed(src, self.dst)
+        self.assertEqual(os.path.join(self.dst, 'blob'), dst)
+        self.assertEqual({'md5': hashlib.md5(data).hexdigest()}, digests)
+        with open(dst, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+class MoveTreeTestCase(CopyTestCase):
+
+    def test_merge(self):
+        self._write('debs/main/new.deb', b'new')
+        self._write('debs/main/both.deb', b'later')
+        os.symlink('main', os.path.join(self.src, 'debs', 'link'))
+        os.makedirs(os.path.join(self.dst, 'debs', 'main'))
+        for name, data in (('both.deb', b'earlier'), ('old.deb', b'old')):
+            with open(os.path.join(self.dst, 'debs', 'main', name), 'wb') as f:
+                f.write(data)
+        recovery_io.move_tree(self.src, self.dst)
+        self.assertEqual(['both.deb', 'new.deb', 'old.deb'],
+                         sorted(os.listdir(os.path.join(self.dst, 'debs', 'main'))))
+        with open(os.path.join(self.dst, 'debs', 'main', 'both.deb'), 'rb') as f:
+            self.assertEqual(b'later', f.read())
+        self.assertTrue(os.path.islink(os.path.join(self.dst, 'debs', 'link')))
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'debs', 'main',
+                                                     'new.deb')))
+
+class ExtractTarTestCase(CopyTestCase):
+
+    def _tar(self, members):
+        path = os.path.join(self.src, 'fish.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o555
+                    archive.addfile(info)
+                else:
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_single_pass(self):
+        path = self._tar([('debs', None), ('debs/a.deb', b'a'),
+                          ('readme.html', b'<html/>')])
+        digests, names = recovery_io.extract_tar(path, self.dst, ('md5',))
+        with open(path, 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), digests['md5'])
+        self.assertEqual(['debs', 'debs/a.deb', 'readme.html'], names)
+        with open(os.path.join(self.dst, 'debs', 'a.deb'), 'rb') as f:
+            self.assertEqual(b'a', f.read())
+        self.assertEqual(0o555, stat.S_IMODE(os.stat(os.path.join(self.dst,
+                                                                  'debs')).st_mode))
+        os.chmod(os.path.join(self.dst, 'debs'), 0o755)
+
+    def test_unsafe(self):
+        path = self._tar([('a.deb', b'a'), ('../escape', b'b')])
+        digests, names = recovery_io.extract_tar(path, self.dst)
+        self.assertEqual({}, digests)
+        self.assertIsNone(names)
+        self.assertEqual([], os.listdir(self.dst))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, '..', 'escape')))
+
+    def test_trusted_members(self):
+        path = os.path.join(self.src, 'fish.tar')
+        with tarfile.open(path, 'w') as archive:
+            info = tarfile.TarInfo('bin/tool')
+            info.size = 4
+            info.mode = 0o4755
+            archive.addfile(info, io.BytesIO(b'tool'))
+            info = tarfile.TarInfo('etc/alternatives')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '../../../etc/alternatives'
+            archive.addfile(info)
+        digests, names = recovery_io.extract_tar(path, self.dst)
+        self.assertEqual(['bin/tool', 'etc/alternatives'], names)
+        self.assertEqual(0o4755, stat.S_IMODE(os.stat(os.path.join(self.dst,
+                                                                  'bin', 'tool')).st_mode))
+        self.assertEqual('../../../etc/alternatives',
+                         os.readlink(os.path.join(self.dst, 'etc', 'alternatives')))
+
+    def test_through_symlink(self):
+        outside = os.path.join(self.src, 'outside')
+        os.mkdir(outside)
+        path = os.path.join(self.src, 'fish.tar')
+        with tarfile.open(path, 'w') as archive:
+            info = tarfile.TarInfo('debs')
+            info.type = tarfile.SYMTYPE
+            info.linkname = outside
+            archive.addfile(info)
+            info = tarfile.TarInfo('debs/a.deb')
+            info.size = 1
+            archive.addfile(info, io.BytesIO(b'a'))
+        digests, names = recovery_io.extract_tar(path, self.dst)
+        self.assertIsNone(names)
+        self.assertEqual([], os.listdir(self.dst))
+        self.assertEqual([], os.listdir(outside))
+
+    def test_links_through_symlink(self):
+        outside = os.path.join(self.src, 'outside')
+        os.mkdir(outside)
+        victim = self._write('outside/victim', b'victim')
+        cases = [
+            #hardlink through a symlink, then written over
+            [('l', tarfile.SYMTYPE, outside), ('h', tarfile.LNKTYPE, 'l/victim'),
+             ('h', tarfile.REGTYPE, b'evil')],
+            #hardlink to a symlink
+            [('l', tarfile.SYMTYPE, victim), ('h', tarfile.LNKTYPE, 'l')],
+            #written over a symlink
+            [('l', tarfile.SYMTYPE, victim), ('l', tarfile.REGTYPE, b'evil')]]
+        for members in cases:
+            path = os.path.join(self.src, 'fish.tar')
+            with tarfile.open(path, 'w') as archive:
+                for name, kind, value in members:
+                    info = tarfile.TarInfo(name)
+                    info.type = kind
+                    if kind == tarfile.REGTYPE:
+                        info.size = len(value)
+                        archive.addfile(info, io.BytesIO(value))
+                    else:
+                        info.linkname = value
+                        archive.addfile(info)
+            digests, names = recovery_io.extract_tar(path, self.dst)
+            self.assertIsNone(names, members)
+            self.assertEqual([], os.listdir(self.dst))
+            with open(victim, 'rb') as rfd:
+                self.assertEqual(b'victim', rfd.read())
+            self.assertEqual(1, os.stat(victim).st_nlink)
+
+class DigestCacheTestCase(CopyTestCase):
+
+    def test_cache(self):
+        src = self._write('filesystem.squashfs', b'squash')
+        path = os.path.join(self.dst, 'cache', 'digests.json')
+        cache = recovery_io.DigestCache(path)
+        self.assertEqual(hashlib.md5(b'squash').hexdigest(),
+                         cache.hash_file(src)['md5'])
+        cache.save()
+
+        cache = recovery_io.DigestCache(path)
+        self.assertEqual(1, len(cache))
+        self.assertIsNotNone(cache.lookup(src))
+        self.assertIsNone(cache.lookup(src, ('sha256',)))
+        self._write('filesystem.squashfs', b'changed', 1000000000)
+        self.assertIsNone(cache.lookup(src))
+
+    def test_identity(self):
+        src = self._write('filesystem.squashfs', b'squash')
+        #the same inode seen from somewhere else
+        link = os.path.join(self.dst, 'filesystem.squashfs')
+        os.link(src, link)
+        cache = recovery_io.DigestCache(os.path.join(self.dst, 'digests.json'))
+        cache.hash_file(src)
+        self.assertIsNotNone(cache.lookup(src))
+        self.assertIsNone(cache.lookup(link))
+        #a changed inode with everything else kept
+        stamp = os.stat(src).st_mtime_ns
+        os.chmod(src, 0o600)
+        os.utime(src, ns=(stamp, stamp))
+        self.assertIsNone(cache.lookup(src))
+
+    def test_lru_limit(self):
+        cache = recovery_io.DigestCache(os.path.join(self.dst, 'digests.json'),
+                                        limit=2)
+        files = [self._write('f%d' % i, b'%d' % i) for i in range(3)]
+        cache.hash_file(files[0])
+        cache.hash_file(files[1])
+        cache.lookup(files[0])
+        cache.hash_file(files[2])
+        self.assertIsNotNone(cache.lookup(files[0]))
+        self.assertIsNone(cache.lookup(files[1]))
+
+class TreeMatcherTestCase(unittest.TestCase):
+
+    def test_prefix_stable(self):
+        for pattern in ('casper-rw|casper-uuid', '^ubuntu.iso|^.disk', '', '.',
+                        r'\Adebs/(main|extra)'):
+            self.assertTrue(recovery_io.TreeMatcher(pattern, False).prefix_stable,
+                            pattern)
+        for pattern in (r'.*\.iso$', r'casper\b', 'pool(?=/main)', r'\Z'):
+            self.assertFalse(recovery_io.TreeMatcher(pattern, False).prefix_stable,
+                             pattern)
+
+    def test_directory_decisions(self):
+        black = recovery_io.TreeMatcher(re.compile('casper-rw|casper-uuid'), False)
+        self.assertIs(False, black.wants_directory('casper-rw'))
+        self.assertIs(None, black.wants_directory('casper'))
+        white = recovery_io.TreeMatcher(re.compile('^.disk'), True)
+        self.assertIs(True, white.wants_directory('.disk'))
+        iso = recovery_io.TreeMatcher(re.compile(r'.*\.iso$'), False)
+        self.assertIs(None, iso.wants_directory('images.iso'))
+        self.assertTrue(iso.wants('images.iso/readme'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import unittest
+import tempfile
+
+from Dell import recovery_fish
+
+class FishCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = recovery_fish.FishCache(os.path.join(self.tmp, 'cache'),
+                                             limit=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _tree(self, name, size):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(path, 'debs'))
+        with open(os.path.join(path, 'debs', name + '.deb'), 'wb') as f:
+            f.write(b'x' * size)
+        os.symlink(name + '.deb', os.path.join(path, 'debs', 'link'))
+        return path
+
+    def test_store_and_fetch(self):
+        self.assertIsNone(self.cache.fetch('a' * 32, self.tmp))
+        self.cache.store('a' * 32, self._tree('a', 4), ['debs', 'debs/a.deb'])
+        out = os.path.join(self.tmp, 'out')
+        info = self.cache.fetch('a' * 32, out)
+        self.assertEqual(['debs', 'debs/a.deb'], info['names'])
+        with open(os.path.join(out, 'debs', 'a.deb'), 'rb') as f:
+            self.assertEqual(b'xxxx', f.read())
+        self.assertEqual('a.deb', os.readlink(os.path.join(out, 'debs', 'link')))
+
+    def test_lru_eviction(self):
+        self.cache.store('a' * 32, self._tree('a', 4), [])
+        self.cache.store('b' * 32, self._tree('b', 4), [])
+        os.utime(os.path.join(self.cache.path, 'a' * 32, 'info.json'),
+                 (2000000000, 2000000000))
+        self.cache.store('c' * 32, self._tree('c', 4), [])
+        self.assertIsNotNone(self.cache.fetch('a' * 32, os.path.join(self.tmp, 'x')))
+        self.assertIsNone(self.cache.fetch('b' * 32, os.path.join(self.tmp, 'y')))
+        #too big to ever fit
+        self.cache.store('d' * 32, self._tree('d', 11), [])
+        self.assertIsNone(self.cache.fetch('d' * 32, os.path.join(self.tmp, 'z')))
+
+class FishCatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.library = os.path.join(self.tmp, 'library')
+        os.makedirs(self.library)
+        self.catalog = recovery_fish.FishCatalog(os.path.join(self.tmp, 'catalog.db'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp)
+
+    def _fish(self, name, release='16.04'):
+        path = os.path.join(self.library, name)
+        xml = ('<?xml version="1.0"?><bto><os>%s</os><driver>%s</driver></bto>'
+               % (release, name)).encode()
+        with tarfile.open(path, 'w:gz') as archive:
+            for member, data in (('debs/a.deb', b'a'), ('prepackage.dell', xml)):
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_index(self):
+        path = self._fish('wifi.fish.tar.gz')
+        with open(os.path.join(self.library, 'plain.deb'), 'wb') as f:
+            f.write(b'deb')
+        entries = self.catalog.index(self.library)
+        self.assertEqual(['plain.deb', 'wifi.fish.tar.gz'],
+                         [os.path.basename(entry.path) for entry in entries])
+        wifi = entries[1]
+        with open(path, 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), wifi.md5)
+        self.assertEqual(('16.04', ['wifi.fish.tar.gz'], True),
+                         (wifi.os, wifi.description, wifi.prepackage))
+        self.assertEqual(['debs/a.deb', 'prepackage.dell'], wifi.members)
+        self.assertFalse(entries[0].prepackage)
+        self.assertEqual(wifi, self.catalog.lookup(path))
+
+    def test_incremental(self):
+        path = self._fish('wifi.fish.tar.gz')
+        self.catalog.index(self.library)
+        self.assertEqual('16.04', self.catalog.lookup(path).os)
+        self._fish('wifi.fish.tar.gz', '18.04')
+        os.utime(path, (2000000000, 2000000000))
+        self.assertIsNone(self.catalog.lookup(path))
+        entry = self.catalog.update(path)
+        self.assertEqual('18.04', entry.os)
+        os.unlink(path)
+        self.assertEqual([], self.catalog.index(self.library))
+        #same size and mtime as before, only a dropped row makes it a miss
+        self._fish('wifi.fish.tar.gz', '18.04')
+        os.utime(path, (entry.mtime_ns // 10 ** 9,) * 2)
+        self.assertIsNone(self.catalog.lookup(path))
+
+    def test_unreadable(self):
+        good = self._fish('wifi.fish.tar.gz')
+        bad = self._fish('video.fish.tar.gz')
+        self.catalog.index(self.library)
+        with open(bad, 'rb') as f:
+            data = f.read()
+        with open(bad, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        os.utime(bad, (2000000000, 2000000000))
+        entries = self.catalog.index(self.library)
+        self.assertEqual([bad, good], [entry.path for entry in entries])
+        self.assertEqual('', entries[0].md5)
+        self.assertEqual('16.04', entries[1].os)
+        self.assertIsNone(self.catalog.lookup(bad))
+        self.assertEqual('16.04', self.catalog.lookup(good).os)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import gzip
+import lzma
+import os
+import shutil
+import struct
+import unittest
+import tempfile
+
+from Dell import recovery_image
+
+SECTOR = 2048
+
+def both(fmt, value):
+    '''Both endian encoding used all over ISO9660'''
+    return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+def record(extent, size, directory, name, system_use=b''):
+    '''Builds a directory record'''
+    body = bytearray(33)
+    body[2:10] = both('I', extent)
+    body[10:18] = both('I', size)
+    body[25] = 2 if directory else 0
+    body[28:32] = both('H', 1)
+    body[32] = len(name)
+    body += name
+    if len(name) % 2 == 0:
+        body += b'\0'
+    body += system_use
+    if len(body) % 2:
+        body += b'\0'
+    body[0] = len(body)
+    return bytes(body)
+
+def build_iso(path, files, joliet=False, rock_ridge=False, system_use=None):
+    '''Writes a minimal ISO9660 image holding files, a dict of path to
+       contents.  Every directory fits in a single sector.  system_use maps
+       paths to extra system use entries for their primary records'''
+    system_use = system_use or {}
+    directories = {'': []}
+    for name in sorted(files):
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            parent, child = '/'.join(parts[:i - 1]), '/'.join(parts[:i])
+            if child not in directories:
+                directories[child] = []
+                directories[parent].append(child)
+        directories['/'.join(parts[:-1])].append(name)
+
+    sector = 19 if joliet else 18
+    trees = [False, True] if joliet else [False]
+    dir_sectors = {}
+    for tree in trees:
+        for directory in sorted(directories):
+            dir_sectors[(tree, directory)] = sector
+            sector += 1
+    file_sectors = {}
+    for name in sorted(files):
+        file_sectors[name] = sector
+        sector += max(1, (len(files[name]) + SECTOR - 1) // SECTOR)
+
+    image = bytearray(sector * SECTOR)
+
+    def encode(name, tree):
+        '''On disk name in one of the trees'''
+        if tree:
+            return name.encode('utf-16-be')
+        if '/' not in name and name in directories:
+            return name.upper().encode('ascii')[:8]
+        return (name.upper()[:12] + ';1').encode('ascii')
+
+    for tree in trees:
+        for directory in directories:
+            offset = dir_sectors[(tree, directory)] * SECTOR
+            dot_use = b''
+            if rock_ridge and not tree and directory == '':
+                dot_use = b'SP\x07\x01\xbe\xef\x00'
+            data = record(dir_sectors[(tree, directory)], SECTOR, True,
+                          b'\0', dot_use)
+            data += record(dir_sectors[(tree, directory)], SECTOR, True,
+                           b'\1')
+            for child in directories[directory]:
+                base = child.split('/')[-1]
+                nm = b''
+                if rock_ridge and not tree:
+                    raw = base.encode('utf-8')
+                    nm = b'NM' + bytes([5 + len(raw), 1, 0]) + raw
+                if not tree:
+                    nm += system_use.get(child, b'')
+                if child in directories:
+                    data += record(dir_sectors[(tree, child)], SECTOR, True,
+                                   encode(base, tree), nm)
+                else:
+                    data += record(file_sectors[child], len(files[child]),
+                                   False, encode(base, tree), nm)
+            image[offset:offset + len(data)] = data
+
+    for name, contents in files.items():
+        offset = file_sectors[name] * SECTOR
+        image[offset:offset + len(contents)] = contents
+
+    for index, tree in enumerate(trees):
+        offset = (16 + index) * SECTOR
+        image[offset] = 2 if tree else 1
+        image[offset + 1:offset + 7] = b'CD001\x01'
+        image[offset + 40:offset + 72] = b'TEST'.ljust(32)
+        image[offset + 128:offset + 132] = both('H', SECTOR)
+        if tree:
+            image[offset + 88:offset + 91] = b'%/E'
+        root = record(dir_sectors[(tree, '')], SECTOR, True, b'\0')
+        image[offset + 156:offset + 156 + len(root)] = root
+    offset = (16 + len(trees)) * SECTOR
+    image[offset:offset + 7] = b'\xffCD001\x01'
+
+    with open(path, 'wb') as wfd:
+        wfd.write(image)
+
+FILES = {'.disk/info': b'Ubuntu 16.04 LTS "Xenial Xerus" - amd64\n',
+         'bto.xml': b'<bto/>\n',
+         'casper/filesystem.manifest': b'dell-recovery 1.50\nbash 4.3\n',
+         'pool/main/d/dell-recovery_1.50_all.deb': b'x' * 5000}
+
+class IsoImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'test.iso')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_tree(self, image):
+        self.assertTrue(image.exists('/bto.xml'))
+        self.assertTrue(image.isdir('/casper'))
+        self.assertFalse(image.exists('/casper/missing'))
+        self.assertFalse(image.exists('/bto.xml/child'))
+        for name, contents in FILES.items():
+            self.assertEqual(image.read('/' + name), contents)
+        self.assertEqual(image.stat('/pool/main/d/dell-recovery_1.50_all.deb').size,
+                         5000)
+        self.assertIsNone(image.read('/casper'))
+
+    def test_joliet(self):
+        build_iso(self.path, FILES, joliet=True)
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertTrue(image.joliet)
+            self.assertEqual(image.volume_id, 'TEST')
+            self.check_tree(image)
+            self.assertEqual(image.listdir('/'),
+                             ['.disk', 'bto.xml', 'casper', 'pool'])
+            self.assertEqual(list(image.walk()),
+                             ['/.disk', '/.disk/info', '/bto.xml', '/casper',
+                              '/casper/filesystem.manifest', '/pool',
+                              '/pool/main', '/pool/main/d',
+                              '/pool/main/d/dell-recovery_1.50_all.deb'])
+
+    def test_rock_ridge(self):
+        build_iso(self.path, FILES, rock_ridge=True)
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertFalse(image.joliet)
+            self.assertTrue(image.rock_ridge)
+            self.check_tree(image)
+
+    def test_rock_ridge_loop(self):
+        #bto.xml continues in the sector of loop, which continues in itself
+        ce = b'CE\x1c\x01' + both('I', 20) + both('I', 0) + both('I', 28)
+        build_iso(self.path, {'bto.xml': b'<bto/>\n', 'loop': ce},
+                  rock_ridge=True, system_use={'bto.xml': ce})
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertEqual(image.listdir('/'), ['bto.xml', 'loop'])
+            self.assertEqual(image.read('/bto.xml'), b'<bto/>\n')
+
+    def test_truncated(self):
+        build_iso(self.path, FILES, rock_ridge=True)
+        with open(self.path, 'r+b') as wfd:
+            wfd.truncate(17 * 2048)
+        self.assertRaises(recovery_image.ImageError, recovery_image.IsoImage,
+                          self.path)
+
+    def test_truncated_directories(self):
+        #the descriptors are there, the directories they point to aren't
+        build_iso(self.path, FILES, joliet=True)
+        with open(self.path, 'r+b') as wfd:
+            wfd.truncate(19 * 2048)
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertRaises(recovery_image.ImageError, image.exists, '/bto.xml')
+            self.assertRaises(recovery_image.ImageError, image.listdir, '/')
+        #a directory that is there but cut short
+        build_iso(self.path, FILES, joliet=True)
+        with open(self.path, 'r+b') as wfd:
+            wfd.truncate(22 * 2048 + 40)
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertRaises(recovery_image.ImageError, list, image.walk())
+
+    def test_plain(self):
+        build_iso(self.path, {'bto.xml': b'<bto/>\n'})
+        with recovery_image.IsoImage(self.path) as image:
+            self.assertFalse(image.rock_ridge)
+            self.assertEqual(image.listdir('/'), ['BTO.XML'])
+            self.assertEqual(image.read('/bto.xml'), b'<bto/>\n')
+
+    def test_stream(self):
+        build_iso(self.path, FILES, joliet=True)
+        with recovery_image.IsoImage(self.path) as image:
+            pieces = [bytes(piece) for piece in
+                      image.stream('/pool/main/d/dell-recovery_1.50_all.deb',
+                                   chunk=2048)]
+            self.assertEqual([len(piece) for piece in pieces],
+                             [2048, 2048, 904])
+            self.assertEqual(b''.join(pieces), b'x' * 5000)
+            self.assertRaises(recovery_image.ImageError, list,
+                              image.stream('/missing'))
+
+    def test_not_an_image(self):
+        with open(self.path, 'wb') as wfd:
+            wfd.write(b'\0' * SECTOR * 20)
+        self.assertRaises(recovery_image.ImageError,
+                          recovery_image.IsoImage, self.path)
+        open(self.path, 'w').close()
+        self.assertRaises(recovery_image.ImageError,
+                          recovery_image.IsoImage, self.path)
+
+class DirectoryImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for name, contents in FILES.items():
+            path = os.path.join(self.tmp, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as wfd:
+                wfd.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_same_view(self):
+        iso = os.path.join(tempfile.mkdtemp(dir=self.tmp), 'test.iso')
+        build_iso(iso, FILES, joliet=True)
+        with recovery_image.IsoImage(iso) as image:
+            expected = list(image.walk())
+        with recovery_image.DirectoryImage(self.tmp) as image:
+            self.assertTrue(image.isdir('/casper'))
+            self.assertIsNone(image.read('/casper'))
+            self.assertIsNone(image.read('/missing'))
+            for name, contents in FILES.items():
+                self.assertEqual(image.read('/' + name), contents)
+                self.assertEqual(b''.join(image.stream('/' + name, chunk=100)),
+                                 contents)
+            found = [name for name in image.walk()
+                     if not name.startswith('/' + os.path.basename(
+                                                   os.path.dirname(iso)))]
+            self.assertEqual(sorted(found), sorted(expected))
+
+def cpio(names, size=3000):
+    '''Builds a newc cpio archive of files named names'''
+    data = b''
+    for index, name in enumerate(list(names) + ['TRAILER!!!']):
+        body = b'' if name == 'TRAILER!!!' else b'y' * size
+        raw = name.encode('utf-8') + b'\0'
+        header = '070701%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X' % (
+            index, 0o100644, 0, 0, 1, 0, len(body), 0, 0, 0, 0, len(raw), 0)
+        data += header.encode('ascii') + raw
+        data += b'\0' * (-len(data) % 4) + body + b'\0' * (-len(body) % 4)
+    return data + b'\0' * (-len(data) % 512)
+
+def chunked(data, size=1000):
+    '''Feeds data the way IsoImage.stream does'''
+    for offset in range(0, len(data), size):
+        yield memoryview(data)[offset:offset + size]
+
+class InitrdTestCase(unittest.TestCase):
+
+    target = 'scripts/casper-bottom/99dell_bootstrap'
+    main = ['init', 'scripts', 'scripts/casper-bottom', './' + target,
+            'usr/lib/late']
+
+    def test_compressions(self):
+        for compress in (lambda data: data, gzip.compress,
+                         lambda data: lzma.compress(data, lzma.FORMAT_ALONE),
+                         lzma.compress):
+            self.assertTrue(recovery_image.initrd_contains(
+                chunked(compress(cpio(self.main))), self.target))
+            self.assertFalse(recovery_image.initrd_contains(
+                chunked(compress(cpio(['init', 'scripts/other']))), self.target))
+
+    def test_early_microcode(self):
+        early = cpio(['kernel', 'kernel/x86/microcode/GenuineIntel.bin'])
+        initrd = early + lzma.compress(cpio(self.main), lzma.FORMAT_ALONE)
+        self.assertTrue(recovery_image.initrd_contains(chunked(initrd),
+                                                       '/' + self.target))
+        initrd = early + gzip.compress(cpio(['init'])) + \
+                 gzip.compress(cpio(self.main))
+        self.assertTrue(recovery_image.initrd_contains(chunked(initrd),
+                                                       self.target))
+
+    def test_stops_early(self):
+        data = gzip.compress(cpio(self.main, size=1024 * 1024))
+        read = []
+
+        def source():
+            for piece in chunked(data, 512):
+                read.append(len(piece))
+                yield piece
+        self.assertTrue(recovery_image.initrd_contains(source(), self.target))
+        self.assertLess(sum(read), len(data))
+
+    def test_damaged(self):
+        data = gzip.compress(cpio(self.main))
+        self.assertFalse(recovery_image.initrd_contains(
+            chunked(data[:len(data) // 4]), 'usr/lib/late'))
+        self.assertFalse(recovery_image.initrd_contains(
+            chunked(b'garbage' * 100), self.target))
+        self.assertFalse(recovery_image.initrd_contains(iter(()), self.target))
+
+class ReadLinesTestCase(unittest.TestCase):
+
+    text = b'Package: dell-recovery\nVersion: 1.50\n\nPackage: bash'
+
+    def test_lines(self):
+        for gzipped in (False, True):
+            data = gzip.compress(self.text) if gzipped else self.text
+            self.assertEqual(list(recovery_image.read_lines(chunked(data, 7),
+                                                            gzipped)),
+                             ['Package: dell-recovery', 'Version: 1.50', '',
+                              'Package: bash'])
+
+    def test_stops_early(self):
+        closed = []
+
+        def source():
+            try:
+                for piece in chunked(self.text, 4):
+                    yield piece
+            finally:
+                closed.append(True)
+        lines = recovery_image.read_lines(source())
+        self.assertEqual(next(lines), 'Package: dell-recovery')
+        lines.close()
+        self.assertEqual(closed, [True])
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmp, 'cache', 'images.json')
+        self.path = os.path.join(self.tmp, 'test.iso')
+        with open(self.path, 'wb') as wfd:
+            wfd.write(b'image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_persists(self):
+        cache = recovery_image.ImageCache(self.store)
+        self.assertIsNone(cache.lookup(self.path, ('bto_version',)))
+        cache.add(self.path, {'bto_version': 'A05', 'bto_date': '2017-01-01'})
+        cache.add(self.path, {'dell_recovery': '1.50'})
+        cache.save()
+        cache = recovery_image.ImageCache(self.store)
+        self.assertEqual(cache.lookup(self.path, ('bto_version', 'dell_recovery')),
+                         {'bto_version': 'A05', 'bto_date': '2017-01-01',
+                          'dell_recovery': '1.50'})
+        self.assertIsNone(cache.lookup(self.path, ('distributor',)))
+
+    def test_changed_image(self):
+        cache = recovery_image.ImageCache(self.store)
+        cache.add(self.path, {'bto_version': 'A05'})
+        with open(self.path, 'ab') as wfd:
+            wfd.write(b'more')
+        self.assertIsNone(cache.lookup(self.path, ('bto_version',)))
+        cache.add(self.path, {'dell_recovery': '1.50'})
+        self.assertIsNone(cache.lookup(self.path, ('bto_version',)))
+
+    def test_not_a_file(self):
+        cache = recovery_image.ImageCache(self.store)
+        cache.add(self.tmp, {'bto_version': 'A05'})
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.lookup(self.tmp, ()))
+
+    def test_limit(self):
+        cache = recovery_image.ImageCache(self.store, limit=2)
+        paths = []
+        for name in ('a.iso', 'b.iso', 'c.iso'):
+            path = os.path.join(self.tmp, name)
+            open(path, 'w').close()
+            cache.add(path, {'bto_version': name})
+            paths.append(path)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.lookup(paths[0], ()))
+        self.assertEqual(cache.lookup(paths[2], ()), {'bto_version': 'c.iso'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import hashlib
+import json
+import os
+import shutil
+import unittest
+import tempfile
+
+try:
+    from Dell import recovery_common
+except ImportError:
+    #needs dbus and gi, like the backend itself
+    recovery_common = None
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+@unittest.skipIf(recovery_common is None, 'dbus and gi are not available')
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sec = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.sec)
+
+    def _write(self, top, name, data):
+        path = os.path.join(top, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as wfd:
+            wfd.write(data)
+        return path
+
+    def _listed(self, manifest='md5sum.txt'):
+        return dict((path, checksum) for checksum, path in
+                    recovery_common.read_manifest(os.path.join(self.root,
+                                                               manifest)))
+
+class RegenerateTestCase(ManifestTestCase):
+
+    def test_md5_only(self):
+        self._write(self.root, 'casper/vmlinuz', b'kernel')
+        self._write(self.root, 'boot/grub/grubenv', b'env')
+        #payload that only happens to share a manifest's name
+        self._write(self.root, 'debs/manifest.json', b'{}')
+        self._write(self.root, 'debs/SHA256SUMS', b'sums')
+        self._write(self.sec, 'SHA256SUMS', b'stale')
+        recovery_common.regenerate_manifests(self.root, self.sec)
+        self.assertEqual({'./casper/vmlinuz': md5(b'kernel'),
+                          './debs/manifest.json': md5(b'{}'),
+                          './debs/SHA256SUMS': md5(b'sums'),
+                          './SHA256SUMS': md5(b'stale')}, self._listed())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'SHA256SUMS')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'manifest.json')))
+
+    def test_optional_manifests(self):
+        self._write(self.root, 'casper/vmlinuz', b'kernel')
+        self._write(self.sec, 'SHA256SUMS', b'stale')
+        self._write(self.sec, 'SHA512SUMS', b'dropped')
+        recovery_common.regenerate_manifests(self.root, self.sec,
+                                             algorithms=('md5', 'sha256'),
+                                             json_manifest=True,
+                                             exclude=['SHA512SUMS'])
+        self.assertEqual({'./casper/vmlinuz': md5(b'kernel')}, self._listed())
+        self.assertEqual({'./casper/vmlinuz': hashlib.sha256(b'kernel').hexdigest()},
+                         self._listed('SHA256SUMS'))
+        with open(os.path.join(self.root, 'manifest.json')) as rfd:
+            manifest = json.load(rfd)
+        self.assertEqual(['md5', 'sha256'], manifest['algorithms'])
+        self.assertEqual(['./casper/vmlinuz'],
+                         [entry['path'] for entry in manifest['files']])
+
+class VerifyTestCase(ManifestTestCase):
+
+    def _manifest(self, entries):
+        with open(os.path.join(self.root, 'md5sum.txt'), 'w') as wfd:
+            wfd.write('This file contains the list of md5 checksums.\n\n')
+            for checksum, path in entries:
+                wfd.write('%s  %s\n' % (checksum, path))
+
+    def test_good(self):
+        self._write(self.root, 'casper/vmlinuz', b'kernel')
+        self._write(self.root, 'README.diskdefines', b'defines')
+        recovery_common.regenerate_manifests(self.root)
+        self.assertEqual([], recovery_common.verify_manifest(self.root))
+
+    def test_corrupted_and_missing(self):
+        self._write(self.root, 'casper/vmlinuz', b'kernel')
+        self._write(self.root, 'casper/initrd', b'initrd')
+        self._manifest([(md5(b'kernel'), './casper/vmlinuz'),
+                        (md5(b'original'), './casper/initrd'),
+                        (md5(b'gone'), './casper/filesystem.squashfs')])
+        self.assertEqual([('casper/filesystem.squashfs', md5(b'gone'), ''),
+                          ('casper/initrd', md5(b'original'), md5(b'initrd'))],
+                         sorted(recovery_common.verify_manifest(self.root)))
+
+    def test_escaping(self):
+        secret = self._write(self.sec, 'shadow', b'secret')
+        os.symlink(self.sec, os.path.join(self.root, 'link'))
+        escape = os.path.relpath(secret, self.root)
+        self._manifest([(md5(b'secret'), escape),
+                        (md5(b'secret'), './link/shadow'),
+                        (md5(b'secret'), secret)])
+        self.assertEqual(sorted([(os.path.normpath(escape), md5(b'secret'), ''),
+                                 ('link/shadow', md5(b'secret'), ''),
+                                 (secret, md5(b'secret'), '')]),
+                         sorted(recovery_common.verify_manifest(self.root)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- encoding:utf-8 -*-
+#
+# This is a free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this software; if not, write to the Free Software Foundation, Inc., 59 Temple
+# Place, Suite 330, Boston, MA 02111-1307 USA
+import threading
+import time
+import unittest
+
+from Dell import recovery_threading
+
+class ByteProgressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.updates = []
+        self.progress = recovery_threading.ByteProgress('Copying', 1000,
+                                                        interval=0)
+        self.progress.progress = lambda text, percent, rate, eta: \
+                                 self.updates.append((text, percent, rate, eta))
+
+    def test_counts_bytes(self):
+        self.progress.add(250)
+        self.progress.add(250)
+        self.assertEqual('Copying', self.updates[-1][0])
+        self.assertEqual(50, self.updates[-1][1])
+        self.assertTrue(self.updates[-1][2] >= 0)
+        self.progress.finish()
+        self.assertEqual((100, 0.0), (self.updates[-1][1], self.updates[-1][3]))
+
+    def test_scale_and_start(self):
+        self.progress.set_scale_factor(85)
+        self.progress.set_starting_value(2)
+        self.progress.set(500)
+        self.assertEqual(2 + 85 / 2, self.updates[-1][1])
+
+    def test_rate_limited(self):
+        self.progress.interval = 3600
+        for i in range(10):
+            self.progress.add(10)
+        self.assertEqual([], self.updates)
+        self.progress.finish()
+        self.assertEqual(1, len(self.updates))
+
+    def test_fraction_only(self):
+        self.progress.reset_write(0)
+        self.progress.set_fraction(0.25)
+        self.assertEqual((25, 0), self.updates[-1][1:3])
+
+class ProgressEmitterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.emitter = recovery_threading.ProgressEmitter(rate=20)
+        self.emitter.progress = lambda text, percent, rate, eta: \
+                                self.sent.append((text, percent))
+
+    def test_coalesces(self):
+        for percent in range(1, 50):
+            self.emitter.update('Building ISO', percent)
+        self.assertEqual([('Building ISO', 1)], self.sent)
+        time.sleep(0.2)
+        self.assertEqual([('Building ISO', 1), ('Building ISO', 49)], self.sent)
+
+    def test_final_always_sent(self):
+        self.emitter.update('Building ISO', 1)
+        self.emitter.update('Building ISO', 50)
+        self.emitter.update('Building ISO', 100)
+        self.assertEqual([('Building ISO', 1), ('Building ISO', 100)], self.sent)
+
+    def test_duplicates_dropped(self):
+        self.emitter.update('Copying', 10)
+        time.sleep(0.1)
+        self.emitter.update('Copying', 10)
+        self.emitter.flush()
+        self.assertEqual([('Copying', 10)], self.sent)
+
+    def test_jobs_are_separate(self):
+        self.emitter.update('Copying', 10, job='a')
+        self.emitter.update('Copying', 10, job='b')
+        self.emitter.update('Copying', 20, job='a')
+        self.emitter.finish('a')
+        self.assertEqual([('Copying', 10), ('Copying', 10), ('Copying', 20)],
+                         self.sent)
+
+    def test_job_progress(self):
+        jobs = []
+        self.emitter.job_progress = lambda job, text, percent, rate, eta: \
+                                    jobs.append((job, text, percent))
+        self.emitter.update('Copying', 10)
+        self.emitter.update('Copying', 20, job=3)
+        self.assertEqual([('Copying', 10)], self.sent)
+        self.assertEqual([(3, 'Copying', 20)], jobs)
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = recovery_threading.JobQueue(workers=1)
+        self.changes = []
+        self.queue.state_changed = lambda job: \
+                                   self.changes.append((job.id, job.state))
+        self.gate = threading.Event()
+        self.order = []
+
+    def tearDown(self):
+        self.gate.set()
+
+    def wait(self, job):
+        for i in range(200):
+            if job.is_finished():
+                return
+            time.sleep(0.01)
+        self.fail('job %d never finished' % job.id)
+
+    def started(self, job):
+        for i in range(200):
+            if job.state != recovery_threading.JOB_QUEUED:
+                return
+            time.sleep(0.01)
+        self.fail('job %d never started' % job.id)
+
+    def blocker(self, job):
+        self.gate.wait(5)
+        self.order.append(job.id)
+
+    def record(self, job):
+        self.order.append(job.id)
+        return job.description
+
+    def test_priority_then_fifo(self):
+        first = self.queue.submit(self.blocker)
+        self.started(first)
+        low = self.queue.submit(self.record, 'low')
+        high = self.queue.submit(self.record, 'high', priority=5)
+        later = self.queue.submit(self.record, 'later')
+        self.gate.set()
+        self.wait(later)
+        self.assertEqual([first.id, high.id, low.id, later.id], self.order)
+        self.assertEqual(recovery_threading.JOB_DONE, high.state)
+        self.assertEqual('high', high.result)
+        self.assertEqual([(high.id, 'queued'), (high.id, 'running'),
+                          (high.id, 'done')],
+                         [change for change in self.changes
+                          if change[0] == high.id])
+
+    def test_concurrency_limit(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(job):
+            with lock:
+                running.append(job.id)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(job.id)
+        self.queue.workers = 2
+        jobs = [self.queue.submit(work) for i in range(6)]
+        for job in jobs:
+            self.wait(job)
+        self.assertEqual(2, max(peak))
+        self.assertFalse(self.queue.busy())
+
+    def test_failure_and_cancel(self):
+        self.started(self.queue.submit(self.blocker))
+
+        def broken(job):
+            raise RuntimeError('no space left')
+        failed = self.queue.submit(broken)
+        dropped = self.queue.submit(self.record)
+        self.assertTrue(self.queue.cancel(dropped.id))
+        self.assertFalse(self.queue.cancel(dropped.id))
+        self.gate.set()
+        self.wait(failed)
+        time.sleep(0.05)
+        self.assertEqual(recovery_threading.JOB_FAILED, failed.state)
+        self.assertEqual('no space left', failed.error)
+        self.assertEqual(recovery_threading.JOB_CANCELLED, dropped.state)
+        self.assertNotIn(dropped.id, self.order)
+        self.assertIs(failed, self.queue.get(failed.id))
+        self.assertIsNone(self.queue.get(1000))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,7 +27,8 @@ from ubiquity.plugin import InstallPlugin, Plugin, PluginUI
 from ubiquity import misc
 from threading import Thread
 import time
-from Dell.recovery_threading import ProgressBySize
+from Dell.recovery_threading import ByteProgress
+from Dell.recovery_io import COPY_JOURNAL, CopyJournal
 import debconf
 import Dell.recovery_common as magic
 from Dell.recovery_xml import BTOxml
@@ -754,7 +755,7 @@ class Page(Plugin):
 
         return Plugin.ok_handler(self)
 
-    def report_progress(self, info, percent):
+    def report_progress(self, info, percent, rate=0, eta=-1):
         """Reports to the frontend an update about th progress"""
         self.frontend.debconf_progress_info(info)
         self.frontend.debconf_progress_set(percent)
@@ -778,19 +779,17 @@ class Page(Plugin):
                 self.sleep_network()
                 self.delete_swap()
 
-                #init progress bar and size thread
+                #init progress bar and byte counter
                 self.frontend.debconf_progress_start(0, 100, "")
-                size_thread = ProgressBySize("Copying Files",
-                                               "/mnt",
-                                               "0")
-                size_thread.progress = self.report_progress
+                copy_progress = ByteProgress("Copying Files", 0)
+                copy_progress.progress = self.report_progress
                 #init builder
                 self.rp_builder = RPbuilder(self.device,
                                             self.device_size,
                                             self.mem,
                                             self.efi,
                                             self.preseed_config,
-                                            size_thread)
+                                            copy_progress)
                 self.rp_builder.exit = self.exit_ui_loops
                 self.rp_builder.status = self.report_progress
                 self.rp_builder.start()
@@ -846,14 +845,14 @@ class Page(Plugin):
 ############################
 class RPbuilder(Thread):
     """The recovery partition builder worker thread"""
-    def __init__(self, device, size, mem, efi, preseed_config, sizing_thread):
+    def __init__(self, device, size, mem, efi, preseed_config, copy_progress):
         self.device = device
         self.device_size = size
         self.mem = mem
         self.efi = efi
         self.preseed_config = preseed_config
         self.exception = None
-        self.file_size_thread = sizing_thread
+        self.copy_progress = copy_progress
         self.xml_obj = BTOxml()
         Thread.__init__(self)
 
@@ -873,72 +872,44 @@ You will need to clear the contents of the recovery partition\n\
 manually to proceed.")
 
         #Calculate RP size
-        rp_size = magic.black_tree("size", black_pattern, magic.CDROM_MOUNT)
+        rp_manifest = magic.black_tree("scan", black_pattern, magic.CDROM_MOUNT)
+        rp_size = rp_manifest.size
         #in mbytes
         rp_size_mb = (rp_size / 1000000) + cushion
 
-        # Build new partition table
-        command = ('parted', '-s', self.device, 'mklabel', 'gpt')
-        result = misc.execute_root(*command)
-        if result is False:
-            raise RuntimeError("Error creating new partition table on %s" % (self.device))
-
-        self.status("Creating Partitions", 1)
-        grub_size = 250
-        commands = [('parted', '-a', 'optimal', '-s', self.device, 'mkpart', 'primary', 'fat16', '0', str(grub_size)),
-                    ('parted', '-s', self.device, 'name', '1', "'EFI System Partition'"),
-                    ('parted', '-s', self.device, 'set', '1', 'boot', 'on')]
         if '/dev/nvme' in self.device or '/dev/mmcblk' in self.device:
-            commands.append(('mkfs.msdos', self.device + 'p' + EFI_ESP_PARTITION))
             rp_part = 'p' + EFI_RP_PARTITION
             esp_part = 'p' + EFI_ESP_PARTITION
         else:
-            commands.append(('mkfs.msdos', self.device + EFI_ESP_PARTITION))
             rp_part = EFI_RP_PARTITION
             esp_part = EFI_ESP_PARTITION
-        for command in commands:
-            #wait for settle
-            if command[0] == 'mkfs.msdos':
-                while not os.path.exists(command[-1]):
-                    time.sleep(1)
-            result = misc.execute_root(*command)
-            if result is False:
-                if self.efi:
-                    raise RuntimeError("Error formatting disk.")
-
-        #Build RP
-        command = ('parted', '-a', 'optimal', '-s', self.device, 'mkpart', "fat32", "fat32", str(grub_size), str(rp_size_mb + grub_size))
-        result = misc.execute_root(*command)
-        if result is False:
-            raise RuntimeError("Error creating new %s mb recovery partition on %s" % (rp_size_mb, self.device))
-
-        #Build RP filesystem
-        self.status("Formatting Partitions", 2)
-        command = ('mkfs.msdos', '-n', 'OS', self.device + rp_part)
-        while not os.path.exists(command[-1]):
-            time.sleep(1)
-        result = misc.execute_root(*command)
-        if result is False:
-            raise RuntimeError("Error creating fat32 filesystem on %s%s" % (self.device, rp_part))
-
-        #Mount RP
-        mount = misc.execute_root('mount', self.device + rp_part, '/mnt')
-        if mount is False:
-            raise RuntimeError("Error mounting %s%s" % (self.device, rp_part))
 
-        #Update status and start the file size thread
-        self.file_size_thread.reset_write(rp_size)
-        self.file_size_thread.set_scale_factor(85)
-        self.file_size_thread.set_starting_value(2)
-        self.file_size_thread.start()
+        #Pick up an interrupted copy if the last attempt left one behind
+        if self.check_resumable_copy(rp_part, rp_size):
+            self.status("Resuming recovery partition copy", 2)
+        else:
+            self.create_partitions(rp_size_mb, rp_part, esp_part)
 
-        #Copy RP Files
+        #Copy RP Files, counting every byte as it lands
         with misc.raised_privileges():
+            iso_manifest = None
+            copy_size = rp_manifest.data_size
             if os.path.exists(magic.ISO_MOUNT):
-                magic.black_tree("copy", re.compile(".*\.iso$"), magic.ISO_MOUNT, '/mnt')
-            magic.black_tree("copy", black_pattern, magic.CDROM_MOUNT, '/mnt')
-
-        self.file_size_thread.join()
+                iso_manifest = magic.black_tree("scan", re.compile(".*\.iso$"),
+                                                magic.ISO_MOUNT)
+                copy_size += iso_manifest.data_size
+            self.copy_progress.reset_write(copy_size)
+            self.copy_progress.set_scale_factor(85)
+            self.copy_progress.set_starting_value(2)
+            journal = CopyJournal(os.path.join('/mnt', COPY_JOURNAL))
+            if iso_manifest:
+                iso_manifest.copy('/mnt', streaming=True, journal=journal,
+                                  counter=self.copy_progress.add)
+            rp_manifest.copy('/mnt', streaming=True, journal=journal,
+                             counter=self.copy_progress.add)
+            journal.remove()
+
+        self.copy_progress.finish()
 
         #find uuid of drive
         with misc.raised_privileges():
@@ -1072,6 +1043,89 @@ manually to proceed.")
             time.sleep(1)
 
 
+    def check_resumable_copy(self, rp_part, rp_size):
+        """Checks if a previous attempt at building the RP was interrupted
+           while copying files.  If the partition layout it created is intact
+           and its copy journal is still there, the RP is left mounted on /mnt
+           so that only the missing files need to be copied"""
+        try:
+            with misc.raised_privileges():
+                output = magic.fetch_output(['parted', '-s', '-m', self.device,
+                                             'unit', 'MB', 'print'])
+        except RuntimeError:
+            return False
+
+        partitions = {}
+        for line in output.split('\n'):
+            fields = line.strip().rstrip(';').split(':')
+            if len(fields) >= 5 and fields[0].isdigit():
+                partitions[fields[0]] = fields
+        if EFI_ESP_PARTITION not in partitions or \
+           EFI_RP_PARTITION not in partitions:
+            return False
+        esp = partitions[EFI_ESP_PARTITION]
+        rp = partitions[EFI_RP_PARTITION]
+        try:
+            rp_size_mb = float(rp[3].rstrip('MB'))
+        except ValueError:
+            return False
+        if not esp[4].startswith('fat') or rp[4] != 'fat32' or \
+           rp_size_mb < rp_size / 1000000:
+            return False
+
+        mount = misc.execute_root('mount', self.device + rp_part, '/mnt')
+        if mount is False:
+            return False
+        if os.path.exists(os.path.join('/mnt', COPY_JOURNAL)):
+            return True
+        misc.execute_root('umount', '/mnt')
+        return False
+
+    def create_partitions(self, rp_size_mb, rp_part, esp_part):
+        """Lays out a fresh partition table with an ESP and an RP, formats
+           them and mounts the RP on /mnt"""
+        # Build new partition table
+        command = ('parted', '-s', self.device, 'mklabel', 'gpt')
+        result = misc.execute_root(*command)
+        if result is False:
+            raise RuntimeError("Error creating new partition table on %s" % (self.device))
+
+        self.status("Creating Partitions", 1)
+        grub_size = 250
+        commands = [('parted', '-a', 'optimal', '-s', self.device, 'mkpart', 'primary', 'fat16', '0', str(grub_size)),
+                    ('parted', '-s', self.device, 'name', '1', "'EFI System Partition'"),
+                    ('parted', '-s', self.device, 'set', '1', 'boot', 'on'),
+                    ('mkfs.msdos', self.device + esp_part)]
+        for command in commands:
+            #wait for settle
+            if command[0] == 'mkfs.msdos':
+                while not os.path.exists(command[-1]):
+                    time.sleep(1)
+            result = misc.execute_root(*command)
+            if result is False:
+                if self.efi:
+                    raise RuntimeError("Error formatting disk.")
+
+        #Build RP
+        command = ('parted', '-a', 'optimal', '-s', self.device, 'mkpart', "fat32", "fat32", str(grub_size), str(rp_size_mb + grub_size))
+        result = misc.execute_root(*command)
+        if result is False:
+            raise RuntimeError("Error creating new %s mb recovery partition on %s" % (rp_size_mb, self.device))
+
+        #Build RP filesystem
+        self.status("Formatting Partitions", 2)
+        command = ('mkfs.msdos', '-n', 'OS', self.device + rp_part)
+        while not os.path.exists(command[-1]):
+            time.sleep(1)
+        result = misc.execute_root(*command)
+        if result is False:
+            raise RuntimeError("Error creating fat32 filesystem on %s%s" % (self.device, rp_part))
+
+        #Mount RP
+        mount = misc.execute_root('mount', self.device + rp_part, '/mnt')
+        if mount is False:
+            raise RuntimeError("Error mounting %s%s" % (self.device, rp_part))
+
     def exit(self):
         """Function to request the builder thread to close"""
         pass
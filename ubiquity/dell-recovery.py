@@ -146,7 +146,7 @@ class Install(InstallPlugin):
         """Outputs a debugging string to /var/log/installer/debug"""
         self.debug("%s: %s" % (NAME, error))
 
-    def _update_progress_gui(self, progress_text, progress_percent):
+    def _update_progress_gui(self, progress_text, progress_percent, rate=0, eta=-1):
         """Function called by the backend to update the progress in frontend"""
         self.progress.substitute('dell-recovery/build_progress', 'MESSAGE', \
                                                                   progress_text)
@@ -156,7 +156,7 @@ class Install(InstallPlugin):
             progress_percent = ROTATIONAL_CHAR[self.index]
             self.index += 1
         else:
-            progress_percent += "%"
+            progress_percent = "%d%%" % float(progress_percent)
         self.progress.substitute('dell-recovery/build_progress', 'PERCENT', \
                                                                progress_percent)
         self.progress.info('dell-recovery/build_progress')